@@ -2,11 +2,15 @@
 import os
 import sys
 import logging
-import json
-from langchain_community.document_loaders import TextLoader, DirectoryLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import SentenceTransformerEmbeddings
-from langchain_community.vectorstores import FAISS
+import functools
+from contextlib import nullcontext
+from dataclasses import asdict
+from embedding_backend import create_embeddings, describe_backend, embedding_model_id
+from embedding_cache import EmbeddingCache, CachedEmbeddings
+from ann_index import INDEX_TYPES, IndexConfig
+from parallel_build import DEFAULT_BUILD_WORKERS, ParallelEmbeddings, embedding_throughput, iter_split_files, list_markdown_files
+from ingest_pipeline import CHECKPOINT_DIR, ingest
+from lorebook_manifest import build_entries, chunk_ids_by_source, save_manifest
 
 # --- Настройка логирования ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -15,41 +19,11 @@ logger = logging.getLogger(__name__)
 # --- Конфигурация ---
 # Базовая директория для хранения векторных баз
 BASE_DB_DIR = os.path.expanduser("~/secure_rag/vector_dbs")
-# Локальный путь к модели эмбеддингов
-EMBEDDING_MODEL_PATH = os.path.expanduser("~/models/embeding/BAAI-bge-m3")
 # Директория по умолчанию для исходных документов
 DEFAULT_SOURCE_DIR = os.path.expanduser("~/secure_rag/current")
 
 # --- Вспомогательные функции ---
 
-def get_added_lorebooks_path(db_path: str) -> str:
-    """Возвращает путь к файлу журнала добавленных книг для данной базы."""
-    return os.path.join(db_path, "added_lorebooks.json")
-
-def load_added_lorebooks(json_path: str) -> list:
-    """Загружает список имен добавленных книг из JSON-файла."""
-    if not os.path.exists(json_path):
-        return []
-    try:
-        with open(json_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except json.JSONDecodeError as e:
-        logger.error(f"Ошибка чтения JSON-файла '{json_path}': {e}. Возвращаю пустой список.")
-        return []
-    except Exception as e:
-        logger.error(f"Непредвиденная ошибка при загрузке '{json_path}': {e}. Возвращаю пустой список.")
-        return []
-
-def save_added_lorebooks(json_path: str, added_files: list):
-    """Сохраняет список имен добавленных книг в JSON-файл."""
-    try:
-        os.makedirs(os.path.dirname(json_path), exist_ok=True)
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(added_files, f, ensure_ascii=False, indent=4)
-        logger.info(f"Список добавленных книг сохранен в: {json_path}")
-    except Exception as e:
-        logger.error(f"Ошибка сохранения списка добавленных книг в '{json_path}': {e}")
-
 def list_existing_dbs() -> list:
     """Возвращает список имен существующих векторных баз данных."""
     if not os.path.exists(BASE_DB_DIR):
@@ -58,6 +32,59 @@ def list_existing_dbs() -> list:
     dbs = [d for d in os.listdir(BASE_DB_DIR) if os.path.isdir(os.path.join(BASE_DB_DIR, d))]
     return dbs
 
+def build_database(source_dir: str, db_path: str, chunk_size: int, chunk_overlap: int,
+                   index_config: IndexConfig, workers: int) -> dict:
+    """Шаги 5-8: потоковая сборка (загрузка -> очистка -> разбиение -> эмбеддинги -> добавление) пакетами
+    с контрольными точками. Возвращает записи манифеста книг (хэш и id чанков каждого файла)."""
+    files = list_markdown_files(source_dir)
+    if not files:
+        logger.error(f"В директории '{source_dir}' не найдено Markdown-файлов. Завершение.")
+        sys.exit(1)
+    logger.info(f"Найдено {len(files)} документов для обработки, процессов: {workers}.")
+    logger.info(f"Разделение на чанки: размер {chunk_size}, перекрытие {chunk_overlap}.")
+
+    # Контрольная точка подходит, только если сборка запущена с теми же параметрами
+    params = {
+        "source_dir": source_dir, "model": embedding_model_id(), "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap, "index": asdict(index_config),
+    }
+
+    def split_stream(remaining):
+        return iter_split_files(remaining, chunk_size, chunk_overlap, workers)
+
+    try:
+        # Бэкенд эмбеддингов - RAG_EMBEDDING_BACKEND (sentence-transformers | int8 | onnx | ...)
+        factory = functools.partial(create_embeddings)
+        parallel = ParallelEmbeddings(factory, workers) if workers > 1 else None
+        # Уже посчитанные чанки берутся из общего кэша эмбеддингов
+        with EmbeddingCache(embedding_model_id()) as cache, (parallel or nullcontext()):
+            embeddings = CachedEmbeddings(parallel or factory(), cache)
+            result = ingest(files, split_stream, embeddings, db_path, params, index_config)
+        logger.info(cache.report())
+    except Exception as e:
+        logger.critical(f"Критическая ошибка при создании векторной базы данных: {e}", exc_info=True)
+        logger.error(f"Убедитесь, что модель эмбеддингов доступна: {describe_backend()}")
+        logger.error("Повторный запуск с теми же параметрами продолжит сборку с последней контрольной точки.")
+        sys.exit(1)
+
+    if result.vector_db is None:
+        logger.error(f"Markdown-файлы в '{source_dir}' не содержат текста. Завершение.")
+        sys.exit(1)
+    if result.resumed_files:
+        logger.info(f"Из контрольной точки взято файлов: {result.resumed_files}.")
+    logger.info(f"Создано {result.chunks} чанков. Тип индекса: {result.index_config.describe()}")
+    logger.info(f"Скорость эмбеддинга: {embedding_throughput(result.chunks, result.timer.stages.get('Эмбеддинги', 0.0))}")
+    logger.info(result.timer.report())
+    return build_entries(files, chunk_ids_by_source([result.vector_db]))
+
+def finalize_database(db_path: str, db_name: str, manifest_entries: dict):
+    # --- Шаг 9: Создание манифеста книг added_lorebooks.json (по нему add_lorebook.py обновляет и удаляет книги) ---
+    save_manifest(db_path, manifest_entries)
+    logger.info(f"Манифест книг для базы '{db_name}' обновлен.")
+
+    logger.info("\n=== Результат ===")
+    logger.info(f"✅ Процесс создания векторной базы '{db_name}' завершен успешно.")
+
 def main():
     logger.info("=== Начало процесса создания векторной базы ===")
     
@@ -78,7 +105,14 @@ def main():
     db_path = os.path.join(BASE_DB_DIR, db_name)
 
     # --- Шаг 2: Защита от перезаписи ---
-    if os.path.exists(db_path):
+    if os.path.exists(os.path.join(db_path, CHECKPOINT_DIR)):
+        # Незавершенная сборка: при тех же параметрах она продолжится с последней контрольной точки
+        logger.warning(f"Найдена прерванная сборка базы '{db_name}'.")
+        resume_choice = input("Продолжить ее? Введите те же параметры, что и в прошлый раз (да/нет): ").strip().lower()
+        if resume_choice != 'да':
+            import shutil
+            shutil.rmtree(os.path.join(db_path, CHECKPOINT_DIR), ignore_errors=True)
+    if os.path.exists(db_path) and not os.path.exists(os.path.join(db_path, CHECKPOINT_DIR)):
         logger.warning(f"Внимание: Директория для базы данных '{db_name}' уже существует: {db_path}")
         overwrite_choice = input("Вы хотите перезаписать ее? Все существующие данные будут потеряны! (да/нет): ").strip().lower()
         if overwrite_choice != 'да':
@@ -119,70 +153,29 @@ def main():
         logger.error(f"Некорректный ввод для размера чанка или перекрытия: {e}. Завершение.")
         sys.exit(1)
 
-    # --- Шаг 5: Загрузка документов ---
-    logger.info(f"Загрузка Markdown-файлов из директории: {source_dir}")
-    try:
-        loader = DirectoryLoader(
-            source_dir,
-            glob="**/*.md", # Ищем все .md файлы, включая поддиректории
-            loader_cls=TextLoader,
-            loader_kwargs={"encoding": "utf-8"},
-            recursive=True # Рекурсивно ищем в поддиректориях
-        )
-        documents = loader.load()
-        if not documents:
-            logger.warning(f"В директории '{source_dir}' не найдено Markdown-файлов. База данных будет пустой.")
-            # sys.exit(0) # Можно выйти, если пустая база не нужна
-        else:
-            logger.info(f"Найдено {len(documents)} документов для обработки.")
-            # Добавляем метаданные для отслеживания источника
-            for doc in documents:
-                doc.metadata["source"] = os.path.basename(doc.metadata.get("source", "unknown_file"))
-
-    except Exception as e:
-        logger.critical(f"Критическая ошибка при загрузке документов из '{source_dir}': {e}", exc_info=True)
-        sys.exit(1)
-
-    # --- Шаг 6: Разделение документов на чанки ---
-    logger.info(f"Разделение документов на чанки (размер: {chunk_size} токенов, перекрытие: {chunk_overlap} токенов)...")
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap,
-        length_function=len, # Простая функция длины, но для токенов лучше использовать токенизатор
-        # Можно добавить `tokenizer=tiktoken.encoding_for_model("gpt-3.5-turbo").encode` для более точного подсчета токенов
-    )
-    texts = text_splitter.split_documents(documents)
-    logger.info(f"Создано {len(texts)} чанков.")
-
-    # --- Шаг 7: Инициализация модели эмбеддингов ---
-    logger.info("Инициализация модели эмбеддингов BAAI/bge-m3 (локально)...")
+    # --- Шаг 4.1: Выбор типа индекса ---
+    # flat - точный поиск; ivf и hnsw - приближенный, быстрее на больших базах (recall проверяется index_recall.py)
+    index_config = IndexConfig.from_env()
+    index_type = input(f"Введите тип индекса {'/'.join(INDEX_TYPES)} (по умолчанию: {index_config.index_type}): ").strip().lower()
+    if index_type:
+        if index_type not in INDEX_TYPES:
+            logger.error(f"Неизвестный тип индекса '{index_type}'. Завершение.")
+            sys.exit(1)
+        index_config.index_type = index_type
+
+    # --- Шаг 4.2: Число процессов сборки ---
+    workers_input = input(f"Введите число процессов сборки (по умолчанию: {DEFAULT_BUILD_WORKERS}, 1 - в одном процессе): ").strip()
     try:
-        embeddings = SentenceTransformerEmbeddings(model_name=EMBEDDING_MODEL_PATH)
-        logger.info("Модель эмбеддингов успешно инициализирована.")
-    except Exception as e:
-        logger.critical(f"Критическая ошибка инициализации модели эмбеддингов: {e}", exc_info=True)
-        logger.error(f"Убедитесь, что модель эмбеддингов доступна по пути: {EMBEDDING_MODEL_PATH}")
-        sys.exit(1)
-
-    # --- Шаг 8: Создание и сохранение векторной базы данных ---
-    logger.info(f"Создание FAISS векторной базы данных из {len(texts)} чанков...")
-    try:
-        # allow_dangerous_deserialization=True необходимо для загрузки FAISS баз, созданных LangChain
-        vector_db = FAISS.from_documents(texts, embeddings)
-        vector_db.save_local(db_path)
-        logger.info(f"Векторная база данных '{db_name}' успешно создана и сохранена в: {db_path}")
-    except Exception as e:
-        logger.critical(f"Критическая ошибка при создании векторной базы данных: {e}", exc_info=True)
-        logger.error("Убедитесь, что `faiss-gpu` или `faiss-cpu` установлен и совместим с вашей версией `numpy`.")
+        build_workers = int(workers_input) if workers_input else DEFAULT_BUILD_WORKERS
+        if build_workers < 1:
+            raise ValueError("Число процессов должно быть положительным.")
+    except ValueError as e:
+        logger.error(f"Некорректное число процессов: {e}. Завершение.")
         sys.exit(1)
 
-    # --- Шаг 9: Создание/обновление журнала added_lorebooks.json ---
-    processed_file_names = [os.path.basename(doc.metadata.get("source", "unknown_file")) for doc in documents]
-    save_added_lorebooks(get_added_lorebooks_path(db_path), processed_file_names)
-    logger.info(f"Журнал добавленных книг для базы '{db_name}' обновлен.")
-
-    logger.info("\n=== Результат ===")
-    logger.info(f"✅ Процесс создания векторной базы '{db_name}' завершен успешно.")
+    manifest_entries = build_database(source_dir, db_path, chunk_size, chunk_overlap, index_config, build_workers)
+    logger.info(f"Векторная база данных '{db_name}' успешно создана и сохранена в: {db_path}")
+    finalize_database(db_path, db_name, manifest_entries)
 
 if __name__ == "__main__":
     main()
@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 import os
 import sys
-from langchain_community.document_loaders import DirectoryLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import SentenceTransformerEmbeddings
-from langchain_community.vectorstores import FAISS
+import functools
+from contextlib import nullcontext
+from dataclasses import asdict
+from embedding_backend import create_embeddings, embedding_model_id
+from embedding_cache import EmbeddingCache, CachedEmbeddings
+from ann_index import IndexConfig
+from parallel_build import DEFAULT_BUILD_WORKERS, ParallelEmbeddings, embedding_throughput, iter_split_files, list_markdown_files
+from ingest_pipeline import ingest
 import logging
 
 # Настройка логгирования
@@ -17,45 +21,53 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def load_documents(doc_path: str):
-    """Загрузка документов с обработкой ошибок"""
-    try:
-        logger.info(f"Загрузка документов из: {doc_path}")
-        loader = DirectoryLoader(doc_path, glob="**/*.md")
-        documents = loader.load()
-        logger.info(f"Успешно загружено документов: {len(documents)}")
-        return documents
-    except Exception as e:
-        logger.error(f"Ошибка загрузки: {str(e)}", exc_info=True)
-        raise
+EMBEDDING_MODEL_PATH = "/home/user/models/embeding/BAAI-bge-m3"
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 100
+SEPARATORS = ["\n\n", "\n", " "]
+# Процессов сборки (RAG_BUILD_WORKERS): разбиение файлов и эмбеддинги; 1 - все в текущем процессе
+BUILD_WORKERS = DEFAULT_BUILD_WORKERS
 
-def create_vector_db(documents, db_path: str):
-    """Создание и сохранение векторной базы"""
+def create_vector_db(doc_path: str, db_path: str, workers: int):
+    """Потоковое создание базы пакетами с контрольными точками.
+
+    Прерванная сборка при следующем запуске продолжается с последней точки.
+    Возвращает число обработанных файлов или None при ошибке.
+    """
     try:
-        os.makedirs(os.path.dirname(db_path), exist_ok=True)
-        
-        logger.info("Инициализация модели эмбеддингов BAAI/bge-m3 (локально)...")
-        # Изменено: Указываем точный локальный путь к модели BAAI-bge-m3
-        embeddings = SentenceTransformerEmbeddings(model_name="/home/user/models/embeding/BAAI-bge-m3")
+        files = list_markdown_files(doc_path)
+        if not files:
+            logger.error("Нет документов для обработки в указанной директории.")
+            return None
+        index_config = IndexConfig.from_env()
+        # Контрольная точка подходит, только если сборка запущена с теми же параметрами
+        params = {
+            "source_dir": doc_path, "model": embedding_model_id(model=EMBEDDING_MODEL_PATH), "chunk_size": CHUNK_SIZE,
+            "chunk_overlap": CHUNK_OVERLAP, "separators": SEPARATORS, "index": asdict(index_config),
+        }
+        logger.info(f"Файлов: {len(files)}, процессов: {workers}, индекс: {index_config.index_type}")
         
-        logger.info("Разбиение документов на чанки...")
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=500,
-            chunk_overlap=100,
-            separators=["\n\n", "\n", " "]
-        )
-        chunks = text_splitter.split_documents(documents)
-        logger.info(f"Документы разбиты на {len(chunks)} чанков.")
+        def split_stream(remaining):
+            return iter_split_files(remaining, CHUNK_SIZE, CHUNK_OVERLAP, workers,
+                                    separators=SEPARATORS, basename_source=False)
         
-        logger.info("Создание векторного хранилища FAISS...")
-        vector_db = FAISS.from_documents(chunks, embeddings)
-        vector_db.save_local(db_path)
+        factory = functools.partial(create_embeddings, model=EMBEDDING_MODEL_PATH)
+        parallel = ParallelEmbeddings(factory, workers) if workers > 1 else None
+        with EmbeddingCache(embedding_model_id(model=EMBEDDING_MODEL_PATH)) as cache, (parallel or nullcontext()):
+            embeddings = CachedEmbeddings(parallel or factory(), cache)
+            result = ingest(files, split_stream, embeddings, db_path, params, index_config)
+        logger.info(cache.report())
         
-        logger.info(f"Векторная база успешно сохранена в: {db_path}")
-        return True
+        if result.vector_db is None:
+            logger.error("Документы не содержат текста.")
+            return None
+        logger.info(f"Скорость эмбеддинга: {embedding_throughput(result.chunks, result.timer.stages.get('Эмбеддинги', 0.0))}")
+        logger.info(result.timer.report())
+        logger.info(f"Векторная база успешно сохранена в: {db_path} ({result.index_config.describe()})")
+        return result.files
     except Exception as e:
         logger.error(f"Ошибка создания базы: {str(e)}", exc_info=True)
-        return False
+        return None
 
 def main():
     DOC_PATH = os.path.expanduser("~/secure_rag/md")
@@ -68,21 +80,16 @@ def main():
             print(f"Пожалуйста, убедитесь, что документы находятся в '{DOC_PATH}'")
             return 1
         
-        docs = load_documents(DOC_PATH)
-        if not docs:
-            logger.error("Нет документов для обработки в указанной директории.")
-            print("Пожалуйста, убедитесь, что в директории есть .md файлы.")
-            return 1
-            
-        if create_vector_db(docs, DB_PATH):
-            print("\n=== Результат ===")
-            print(f"✅ Векторная база успешно создана с моделью: BAAI/bge-m3 (локально)")
-            print(f"• Документов обработано: {len(docs)}")
-            print(f"• Векторная база сохранена по пути: {DB_PATH}")
-            return 0
-        else:
+        processed = create_vector_db(DOC_PATH, DB_PATH, BUILD_WORKERS)
+        if processed is None:
             print("\n❌ Ошибка при создании векторной базы.")
+            print("Если сборка была прервана, повторный запуск продолжит ее с последней контрольной точки.")
             return 1
+        print("\n=== Результат ===")
+        print(f"✅ Векторная база успешно создана с моделью: BAAI/bge-m3 (локально), процессов: {BUILD_WORKERS}")
+        print(f"• Документов обработано: {processed}")
+        print(f"• Векторная база сохранена по пути: {DB_PATH}")
+        return 0
             
     except Exception as e:
         logger.critical(f"Критическая ошибка в основной функции: {str(e)}", exc_info=True)
@@ -1,13 +1,30 @@
 #!/usr/bin/env python3
 import os
 import sys
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import SentenceTransformerEmbeddings
+import argparse
+import numpy as np
+from embedding_backend import create_embeddings, describe_backend
+from delta_segments import load_segments
 
 def main():
     # Конфигурация
     DB_PATH = os.path.expanduser("~/secure_rag/vector_db")
-    
+
+    parser = argparse.ArgumentParser(
+        description="Проверка векторной базы тестовыми запросами",
+        epilog="Остальные аргументы передаются бенчмарку: см. retrieval_benchmark.py --help")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Вместо тестовых запросов - бенчмарк базы (задержки, QPS, recall@k, память)")
+    args, benchmark_args = parser.parse_known_args()
+    if args.benchmark:
+        from retrieval_benchmark import main as run_benchmark
+        # Без --synthetic/--corpus/--db меряется рабочая база
+        if not any(arg.split("=")[0] in ("--db", "--corpus") or arg.startswith("--synthetic") for arg in benchmark_args):
+            benchmark_args = ["--db", DB_PATH, "--mmap"] + benchmark_args
+        sys.exit(run_benchmark(benchmark_args))
+    if benchmark_args:
+        parser.error(f"неизвестные аргументы: {' '.join(benchmark_args)} (они допустимы только с --benchmark)")
+
     print("\n" + "="*50)
     print("🔍 Тестирование векторной базы данных")
     print("="*50)
@@ -23,19 +40,16 @@ def main():
     # 2. Загрузка базы с явным разрешением
     try:
         print("\n🔄 Загрузка векторной базы...")
-        # Изменено: Указываем точный локальный путь к модели BAAI-bge-m3
-        embeddings = SentenceTransformerEmbeddings(model_name="/home/user/models/embeding/BAAI-bge-m3")
-        db = FAISS.load_local(
-            DB_PATH,
-            embeddings,
-            allow_dangerous_deserialization=True  # Ваше решение
-        )
-        print(f"✅ Успешно загружено векторов: {db.index.ntotal}")
+        # Бэкенд эмбеддингов - тот же, что при создании базы (RAG_EMBEDDING_BACKEND)
+        embeddings = create_embeddings()
+        # Основа вместе с дельтами, как у сервера; поиск пропускает надгробия удаленных документов HNSW
+        store = load_segments(DB_PATH, embeddings)
+        print(f"✅ Успешно загружено векторов: {store.ntotal}")
     except Exception as e:
         print(f"\n❌ Ошибка загрузки: {str(e)}")
         print("\nВозможные решения:")
         print(f"1. Удалите и пересоздайте базу: rm -rf {DB_PATH}")
-        print(f"2. Проверьте путь к модели эмбеддингов: /home/user/models/embeding/BAAI-bge-m3")
+        print(f"2. Проверьте модель эмбеддингов: {describe_backend()}")
         sys.exit(1)
 
     # 3. Тестовые запросы
@@ -45,10 +59,11 @@ def main():
     
     for query in test_queries:
         try:
-            results = db.similarity_search(query, k=1)
+            vector = np.asarray([embeddings.embed_query(query)], dtype=np.float32)
+            results = store.search(vector, 1)[0]
             print(f"\nЗапрос: '{query}'")
             if results:
-                doc = results[0]
+                doc, _ = results[0]
                 source_info = doc.metadata.get('source', 'unknown').replace(os.path.expanduser("~/secure_rag/md/"), "")
                 print(f"📄 Источник: {source_info}")
                 print(f"📝 Содержание: {doc.page_content[:200]}...")
@@ -1,20 +1,31 @@
 #!/usr/bin/env python3
-import requests
+import httpx
 import json
 import os
 import sys
+from http_clients import BackendConfig, SyncBackendClient
+from context_packer import pack_context, estimate_tokens
 
 # --- Конфигурация ---
 # URL твоего RAG API сервера (04.integration.py)
-RAG_API_URL = "http://localhost:9000/search"
+RAG_API_BASE_URL = "http://localhost:9000"
+RAG_API_URL = f"{RAG_API_BASE_URL}/search"
 # URL твоего llama-server (обычно 8080)
-LLAMA_SERVER_URL = "http://localhost:8080/completion"
+LLAMA_SERVER_BASE_URL = "http://localhost:8080"
+LLAMA_SERVER_URL = f"{LLAMA_SERVER_BASE_URL}/completion"
 # Количество релевантных чанков, которые нужно получить от RAG
-K_RETRIEVED_CHUNKS = 3
+K_RETRIEVED_CHUNKS = 6
+# Бюджет токенов контекста в промпте (из --ctx-size 8192 llama-server) и порог релевантности чанков
+CONTEXT_TOKEN_BUDGET = 4096
+MIN_RELEVANCE_SCORE = 0.3
 # Модель LLM, которую ты используешь в llama-server
 # Убедись, что это имя соответствует имени модели, загруженной в llama-server
 LLM_MODEL_NAME = "saiga_yandexgpt_8b.Q4_K_M.gguf" # Пример: замени на твою модель
 
+# Соединения с бэкендами переиспользуются между вопросами (keep-alive)
+rag_client = SyncBackendClient(BackendConfig(RAG_API_BASE_URL, max_connections=2, read_timeout=30.0))
+llama_client = SyncBackendClient(BackendConfig(LLAMA_SERVER_BASE_URL, max_connections=2, read_timeout=None, retries=1))
+
 # --- Функции ---
 
 def get_rag_context(query: str) -> list:
@@ -23,7 +34,7 @@ def get_rag_context(query: str) -> list:
     """
     print(f"\n🔎 Отправляю запрос на RAG API: '{query}'...")
     try:
-        response = requests.get(RAG_API_URL, params={"query": query, "k": K_RETRIEVED_CHUNKS})
+        response = rag_client.request("GET", "/search", params={"query": query, "k": K_RETRIEVED_CHUNKS})
         response.raise_for_status() # Вызовет исключение для ошибок HTTP (4xx или 5xx)
         data = response.json()
         
@@ -33,20 +44,34 @@ def get_rag_context(query: str) -> list:
         else:
             print("⚠ RAG API вернул пустые или некорректные результаты.")
             return []
-    except requests.exceptions.ConnectionError:
+    except httpx.ConnectError:
         print(f"❌ Ошибка подключения к RAG API серверу по адресу {RAG_API_URL}.")
         print("Убедитесь, что '04.integration.py' запущен и доступен.")
         return []
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"❌ Ошибка при запросе к RAG API: {e}")
         return []
 
+def count_tokens(texts: list) -> list:
+    """
+    Считает токены токенизатором модели через /tokenize llama-server.
+    Если сервер недоступен, используется грубая оценка.
+    """
+    counts = []
+    for text in texts:
+        try:
+            response = llama_client.request("POST", "/tokenize", json={"content": text})
+            response.raise_for_status()
+            counts.append(len(response.json()["tokens"]))
+        except (httpx.HTTPError, KeyError, ValueError):
+            counts.append(estimate_tokens(text))
+    return counts
+
 def generate_llm_response(prompt: str) -> str:
     """
     Отправляет промпт на llama-server и возвращает ответ.
     """
     print(f"\n🧠 Отправляю промпт на llama-server...")
-    headers = {"Content-Type": "application/json"}
     payload = {
         "prompt": prompt,
         "n_predict": 2048, # Максимальное количество токенов в ответе
@@ -56,7 +81,7 @@ def generate_llm_response(prompt: str) -> str:
     }
     
     try:
-        response = requests.post(LLAMA_SERVER_URL, headers=headers, json=payload, stream=False)
+        response = llama_client.request("POST", "/completion", json=payload)
         response.raise_for_status()
         
         # llama-server возвращает ответ в JSON, где "content" содержит текст
@@ -67,11 +92,11 @@ def generate_llm_response(prompt: str) -> str:
         else:
             print("⚠ llama-server вернул некорректный ответ (отсутствует 'content').")
             return "Не удалось получить ответ от LLM."
-    except requests.exceptions.ConnectionError:
+    except httpx.ConnectError:
         print(f"❌ Ошибка подключения к llama-server по адресу {LLAMA_SERVER_URL}.")
         print("Убедитесь, что llama-server запущен и доступен.")
         return "Не удалось подключиться к LLM серверу."
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"❌ Ошибка при запросе к llama-server: {e}")
         return f"Ошибка при генерации ответа LLM: {e}"
 
@@ -83,6 +108,8 @@ def main():
         user_query = input("\nТвой вопрос (или 'exit'): ").strip()
         if user_query.lower() == 'exit':
             print("Завершение работы RAG-системы. До свидания!")
+            rag_client.close()
+            llama_client.close()
             break
 
         if not user_query:
@@ -91,6 +118,11 @@ def main():
 
         # 1. Получаем контекст из RAG API
         retrieved_docs = get_rag_context(user_query)
+        if retrieved_docs:
+            # Слияние перекрывающихся чанков, отсев нерелевантных и укладка в бюджет токенов
+            packed = pack_context(retrieved_docs, count_tokens, CONTEXT_TOKEN_BUDGET, MIN_RELEVANCE_SCORE)
+            print(f"📦 Сборка контекста: {packed.summary()}")
+            retrieved_docs = packed.docs()
 
         context_text = ""
         if retrieved_docs:
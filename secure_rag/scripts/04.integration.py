@@ -1,63 +1,354 @@
 #!/usr/bin/env python3
 from fastapi import FastAPI, HTTPException
-from langchain_community.vectorstores import FAISS
-from langchain_community.embeddings import SentenceTransformerEmbeddings
+from pydantic import BaseModel
+from typing import List, Optional
+from embedding_backend import create_embeddings, describe_backend
+from query_cache import QueryCaches
+from micro_batcher import MicroBatcher
+from db_router import DatabaseRouter, LoadedDatabase, UnknownDatabaseError
+from reranker import CrossEncoderReranker
+from process_memory import process_memory, format_memory
+from request_metrics import current_trace_id, instrument, span
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import asyncio
+import hashlib
 import os
 import uvicorn # Добавлен явный импорт uvicorn
 
 app = FastAPI()
+# /metrics (гистограммы этапов в формате Prometheus) и trace id из заголовка X-Trace-Id
+instrument(app)
 
 # Конфигурация
 DB_PATH = os.path.expanduser("~/secure_rag/vector_db")
-# Локальный путь к модели эмбеддингов
-EMBEDDING_MODEL_PATH = os.path.expanduser("~/models/embeding/BAAI-bge-m3")
-
-# Инициализация базы при старте сервера
-db = None # Инициализируем db как None
-try:
-    print(f"🔄 Инициализация модели эмбеддингов (локально): {EMBEDDING_MODEL_PATH}...")
-    embeddings = SentenceTransformerEmbeddings(model_name=EMBEDDING_MODEL_PATH)
+# Основная база доступна под этим именем; остальные - подкаталоги VECTOR_DBS_DIR
+DEFAULT_DB = "default"
+VECTOR_DBS_DIR = os.path.expanduser("~/secure_rag/vector_dbs")
+# Потолок суммарного размера загруженных баз (МБ); сверх него давно не использованные выгружаются
+DB_MEMORY_LIMIT_MB = int(os.environ.get("RAG_DB_MEMORY_LIMIT_MB", "4096"))
+# Потоков для параллельного поиска по нескольким базам
+DB_SEARCH_THREADS = 4
+# Предел запросов в одном пакетном поиске
+MAX_BATCH_QUERIES = 128
+# Префикс пути markdown-файлов, который убирается из source в ответах
+MD_SOURCE_PREFIX = os.path.expanduser("~/secure_rag/md/")
+# Как часто (секунд) проверять, не перестроена ли база на диске
+RELOAD_CHECK_INTERVAL = 2.0
+# Микро-пакетирование: одновременные запросы объединяются в одно кодирование и один поиск FAISS
+BATCH_MAX_SIZE = 32  # Максимум запросов в пакете
+BATCH_MAX_WAIT_MS = 5  # Сколько ждать попутчиков после первого запроса пакета
+SEARCH_WORKERS = 2  # Потоков для кодирования и поиска
+# index.faiss отображается в память только для чтения: воркеры и другие серверы делят одни страницы
+MMAP_INDEX = True
+# Процессов uvicorn; каждый держит свою модель эмбеддингов, но индекс общий через page cache
+API_WORKERS = int(os.environ.get("RAG_API_WORKERS", "1"))
+# Переранжирование кросс-энкодером: из RERANK_CANDIDATES кандидатов FAISS остаются k лучших по оценке пары
+RERANK_ENABLED = os.environ.get("RAG_RERANK", "0") == "1"  # По умолчанию для запросов без параметра rerank
+RERANK_MODEL_PATH = os.path.expanduser("~/models/reranker/BAAI-bge-reranker-v2-m3")
+RERANK_CANDIDATES = 20
+RERANK_BATCH_SIZE = 16
+RERANK_BUDGET_MS = 300  # Не уложились - выдача в порядке FAISS
+
+class BatchQuery(BaseModel):
+    query: str
+    k: int = 3
+    source_filter: Optional[str] = None
+    dbs: Optional[List[str]] = None  # Имена баз; по умолчанию основная
+    rerank: Optional[bool] = None  # Переранжировать кросс-энкодером; по умолчанию RERANK_ENABLED
+
+class BatchSearchRequest(BaseModel):
+    queries: List[BatchQuery]
+
+# Кэши эмбеддингов запросов и выдач; ключ выдачи включает поколения опрошенных баз
+query_caches = QueryCaches(max_embeddings=10000, max_results=5000, results_ttl=300)
+
+# Модель загружается в startup каждого воркера (а не при импорте в управляющем процессе uvicorn)
+embeddings = None
+
+# Базы по имени: каталоги VECTOR_DBS_DIR/<имя> и основная база под именем DEFAULT_DB.
+# Загружаются при первом запросе, давно не использованные вытесняются при превышении DB_MEMORY_LIMIT_MB
+db_router = DatabaseRouter(VECTOR_DBS_DIR, lambda: embeddings, DB_MEMORY_LIMIT_MB * 2**20,
+                           fixed={DEFAULT_DB: DB_PATH}, mmap=MMAP_INDEX,
+                           reload_check_interval=RELOAD_CHECK_INTERVAL)
+# Поиск по нескольким базам одного пакета идет параллельно (FAISS отпускает GIL)
+db_search_pool = ThreadPoolExecutor(max_workers=DB_SEARCH_THREADS)
+# Модель кросс-энкодера загружается при старте, если переранжирование включено по умолчанию, иначе - при первом запросе
+reranker = CrossEncoderReranker(RERANK_MODEL_PATH, batch_size=RERANK_BATCH_SIZE)
+
+def init_db():
+    global embeddings
+    try:
+        # Бэкенд, размер пакета и число потоков - RAG_EMBEDDING_BACKEND, RAG_EMBEDDING_BATCH_SIZE, RAG_EMBEDDING_THREADS
+        print(f"🔄 Инициализация модели эмбеддингов ({describe_backend()})...")
+        embeddings = create_embeddings()
+        
+        # Основная база загружается сразу: по ней /health сообщает о готовности
+        print(f"🔄 Загрузка векторной базы из: {DB_PATH}...")
+        db_router.get(DEFAULT_DB)
+        if RERANK_ENABLED:
+            reranker.model
+        print(f"📊 Память: {format_memory(process_memory())}")
+    except Exception as e:
+        print(f"❌ Ошибка загрузки векторной базы: {str(e)}")
+        print("Убедитесь, что база создана с помощью '02.create_vector_db.py' и локальная модель эмбеддингов доступна.")
+
+def query_databases(q: BatchQuery) -> List[str]:
+    """Базы запроса без повторов; без явного списка - основная база"""
+    return list(dict.fromkeys(q.dbs or [DEFAULT_DB]))
+
+def databases_version(databases: List[LoadedDatabase]) -> str:
+    """Версия набора баз для кэша ответов веб-приложения"""
+    if len(databases) == 1:
+        return databases[0].version
+    joined = ",".join(f"{db.name}:{db.version}" for db in databases)
+    return hashlib.sha1(joined.encode()).hexdigest()[:16]
+
+def relevance_score(distance: float) -> float:
+    """Квадрат L2-дистанции между нормированными векторами bge-m3 -> косинусная близость"""
+    return 1.0 - float(distance) / 2.0
+
+def format_document(doc, score: Optional[float] = None, db_name: Optional[str] = None) -> dict:
+    source_info = doc.metadata.get("source", "unknown")
+    source_info = source_info.replace(MD_SOURCE_PREFIX, "") # Обновлен путь для очистки
+    result = {
+        "content": doc.page_content,
+        "source": source_info
+    }
+    if score is not None:
+        result["score"] = score
+    if db_name is not None:
+        result["db"] = db_name
+    return result
+
+def filter_sources(source_filter: Optional[str]) -> Optional[tuple]:
+    """Значения metadata["source"], которые format_document показывает как source_filter"""
+    if not source_filter:
+        return None
+    return (source_filter, MD_SOURCE_PREFIX + source_filter)
+
+def wants_rerank(q: BatchQuery) -> bool:
+    return RERANK_ENABLED if q.rerank is None else q.rerank
+
+def candidate_count(q: BatchQuery) -> int:
+    """Сколько чанков первого этапа нужно запросу: для переранжирования - с запасом"""
+    return max(q.k, RERANK_CANDIDATES) if wants_rerank(q) else q.k
+
+def search_database(loaded: LoadedDatabase, queries: List[BatchQuery], vectors: np.ndarray) -> List[List[dict]]:
+    """Матричный поиск одной базы (основа и дельты); для каждого запроса - до candidate_count лучших чанков.
+
+    Фильтр по источнику применяется внутри FAISS (поиск только по меткам чанков
+    источника), поэтому выдача не обедняется, даже если источник редкий.
+    """
+    fetch = min(max(max(candidate_count(q) for q in queries), 1), loaded.store.ntotal)
+    if fetch == 0:
+        return [[] for _ in queries]
     
-    print(f"🔄 Загрузка векторной базы из: {DB_PATH}...")
-    db = FAISS.load_local(DB_PATH, embeddings, allow_dangerous_deserialization=True)
-    print(f"✅ Векторная база готова. Векторов: {db.index.ntotal}")
-except Exception as e:
-    print(f"❌ Ошибка загрузки векторной базы: {str(e)}")
-    print("Убедитесь, что база создана с помощью '02.create_vector_db.py' и локальная модель эмбеддингов доступна.")
-    # db останется None, что вызовет HTTPException при попытке поиска
+    hits = loaded.store.search(vectors, fetch, [filter_sources(q.source_filter) for q in queries])
+    return [[format_document(doc, relevance_score(distance), loaded.name)
+             for doc, distance in row_hits[:candidate_count(q)]]
+            for q, row_hits in zip(queries, hits)]
+
+def rerank_results(queries: List[BatchQuery], candidates: List[List[dict]]) -> List[Optional[List[dict]]]:
+    """Оценивает кандидатов запросов, которым нужно переранжирование, одним пакетом кросс-энкодера.
+
+    Возвращает для каждого запроса top-k по rerank_score или None, если запрос
+    не переранжируется либо бюджет RERANK_BUDGET_MS исчерпан.
+    """
+    rows = [i for i, q in enumerate(queries) if wants_rerank(q) and candidates[i]]
+    reranked: List[Optional[List[dict]]] = [None] * len(queries)
+    if not rows:
+        return reranked
+    with span("rerank"):
+        scores = reranker.score_batch([queries[i].query for i in rows],
+                                      [[r["content"] for r in candidates[i]] for i in rows],
+                                      budget_seconds=RERANK_BUDGET_MS / 1000)
+    for i, row_scores in zip(rows, scores):
+        if row_scores is None:
+            continue
+        results = [dict(r, rerank_score=float(score)) for r, score in zip(candidates[i], row_scores)]
+        reranked[i] = sorted(results, key=lambda r: r["rerank_score"], reverse=True)[:queries[i].k]
+    return reranked
+
+def batch_search(queries: List[BatchQuery]) -> List[List[dict]]:
+    """Один пакетный вызов модели эмбеддингов на все запросы и по одному матричному поиску на каждую базу.
+
+    Все базы построены одной моделью, поэтому косинусные оценки из разных баз
+    сравнимы, и выдачи сливаются в общий top-k по score.
+    """
+    # Каждая база берется один раз: весь пакет обслуживается одним ее поколением
+    names = list(dict.fromkeys(name for q in queries for name in query_databases(q)))
+    databases = {name: db_router.get(name) for name in names}
+    
+    keys = [query_caches.result_key(tuple((name, databases[name].generation) for name in query_databases(q)),
+                                    q.query, q.k, q.source_filter, wants_rerank(q)) for q in queries]
+    all_results = [query_caches.results.get(key) for key in keys]
+    pending = [i for i, cached in enumerate(all_results) if cached is None]
+    if not pending:
+        return all_results
+    
+    pending_queries = [queries[i] for i in pending]
+    # Этапы меряются на весь пакет: он выполняется в пуле поиска, общий для запросов разных клиентов
+    with span("query_embedding"):
+        vectors = np.asarray(query_caches.embed_queries([q.query for q in pending_queries], embeddings.embed_documents),
+                             dtype=np.float32)
+    
+    # Для каждой базы - только те запросы пакета, что к ней обращены
+    plan = []
+    for name in names:
+        rows = [j for j, q in enumerate(pending_queries) if name in query_databases(q)]
+        if rows:
+            plan.append((name, rows))
+    with span("faiss_search"):
+        if len(plan) == 1:
+            name, rows = plan[0]
+            hits = [search_database(databases[name], [pending_queries[j] for j in rows], vectors[rows])]
+        else:
+            futures = [db_search_pool.submit(search_database, databases[name], [pending_queries[j] for j in rows],
+                                             vectors[rows]) for name, rows in plan]
+            hits = [future.result() for future in futures]
+    
+    merged: List[List[dict]] = [[] for _ in pending_queries]
+    for (_, rows), db_hits in zip(plan, hits):
+        for j, results in zip(rows, db_hits):
+            merged[j].extend(results)
+    merged = [sorted(results, key=lambda r: r["score"], reverse=True)[:candidate_count(q)]
+              for q, results in zip(pending_queries, merged)]
+    reranked = rerank_results(pending_queries, merged)
+    for i, q, results, reranked_results in zip(pending, pending_queries, merged, reranked):
+        fell_back = wants_rerank(q) and results and reranked_results is None
+        results = reranked_results if reranked_results is not None else results[:q.k]
+        if not fell_back:
+            # Выдача в порядке FAISS из-за исчерпанного бюджета не кэшируется: следующий запрос получит переранжированную
+            query_caches.results.put(keys[i], results)
+        all_results[i] = results
+    return all_results
+
+async def resolve_databases(names: Optional[List[str]]) -> List[LoadedDatabase]:
+    """Проверяет имена баз и загружает их (параллельно) до постановки запроса в пакет.
+
+    Ошибка загрузки достается только этому запросу, а не попутчикам по пакету.
+    """
+    names = list(dict.fromkeys(names or [DEFAULT_DB]))
+    try:
+        return list(await asyncio.gather(*(asyncio.to_thread(db_router.get, name) for name in names)))
+    except UnknownDatabaseError as e:
+        raise HTTPException(status_code=404, detail=f"Неизвестная база: {e.args[0]}")
+    except Exception as e:
+        print(f"❌ Ошибка загрузки векторной базы: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка загрузки векторной базы: {str(e)}")
+
+def parse_databases(dbs: Optional[str]) -> Optional[List[str]]:
+    names = [name.strip() for name in (dbs or "").split(",") if name.strip()]
+    return names or None
+
+# Пакетный исполнитель поиска; запускается вместе с сервером
+search_batcher = MicroBatcher(batch_search, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, SEARCH_WORKERS)
+
+@app.on_event("startup")
+async def startup_event():
+    await asyncio.to_thread(init_db)
+    await search_batcher.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await search_batcher.stop()
+    db_search_pool.shutdown(wait=False)
 
 @app.get("/search")
-async def search(query: str, k: int = 3):
+async def search(query: str, k: int = 3, with_embedding: bool = False, dbs: Optional[str] = None,
+                 rerank: Optional[bool] = None):
     """
     Эндпоинт для поиска релевантных документов в векторной базе.
     Принимает поисковый запрос и возвращает k наиболее релевантных чанков.
+    dbs - имена баз через запятую; выдачи баз сливаются в общий top-k.
+    with_embedding=true добавляет в ответ эмбеддинг запроса (для семантического кэша ответов).
+    rerank=true|false включает или отключает переранжирование кросс-энкодером (по умолчанию RAG_RERANK).
     """
-    if db is None:
-        raise HTTPException(status_code=500, detail="Векторная база не загружена. Проверьте логи сервера.")
+    if embeddings is None:
+        raise HTTPException(status_code=500, detail="Модель эмбеддингов не загружена. Проверьте логи сервера.")
+    names = parse_databases(dbs)
+    databases = await resolve_databases(names)
     
     try:
-        print(f"🔎 Получен запрос на поиск: '{query}' (k={k})")
-        results = db.similarity_search(query, k=k)
-        
-        formatted_results = []
-        for doc in results:
-            source_info = doc.metadata.get("source", "unknown")
-            source_info = source_info.replace(os.path.expanduser("~/secure_rag/md/"), "") # Обновлен путь для очистки
-            formatted_results.append({
-                "content": doc.page_content,
-                "source": source_info
-            })
+        print(f"🔎 Получен запрос на поиск: '{query}' (k={k}, базы: {', '.join(db.name for db in databases)}, "
+              f"trace {current_trace_id()})")
+        formatted_results = await search_batcher.submit(BatchQuery(query=query, k=k, dbs=names, rerank=rerank))
         
         print(f"✅ Найдено {len(formatted_results)} релевантных документов.")
-        return {
+        response = {
             "query": query,
-            "results": formatted_results
+            "results": formatted_results,
+            "databases": [db.name for db in databases],
+            "index_version": databases_version(databases)
         }
+        if with_embedding:
+            # Вектор уже лежит в кэше эмбеддингов после поиска, повторного кодирования нет
+            vectors = await search_batcher.run(query_caches.embed_queries, [query], embeddings.embed_documents)
+            response["embedding"] = vectors[0].tolist()
+        return response
     except Exception as e:
         print(f"❌ Ошибка при выполнении поиска: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка при выполнении поиска: {str(e)}")
 
+@app.post("/search/batch")
+async def search_batch(request: BatchSearchRequest):
+    """
+    Пакетный поиск: принимает список запросов с индивидуальными k, фильтром по источнику и списком баз.
+    Результаты возвращаются в порядке запросов.
+    """
+    if embeddings is None:
+        raise HTTPException(status_code=500, detail="Модель эмбеддингов не загружена. Проверьте логи сервера.")
+    if len(request.queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=400, detail=f"Слишком много запросов в пакете (максимум {MAX_BATCH_QUERIES}).")
+    if not request.queries:
+        return {"results": []}
+    await resolve_databases([name for q in request.queries for name in query_databases(q)])
+    
+    try:
+        print(f"🔎 Получен пакет из {len(request.queries)} запросов (trace {current_trace_id()})")
+        results = await search_batcher.run(batch_search, request.queries)
+        return {
+            "queries": [q.query for q in request.queries],
+            "results": results
+        }
+    except Exception as e:
+        print(f"❌ Ошибка при выполнении пакетного поиска: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при выполнении поиска: {str(e)}")
+
+@app.get("/health")
+async def health():
+    """Готовность сервера: 200, когда основная база загружена и можно выполнять поиск"""
+    if embeddings is None:
+        raise HTTPException(status_code=503, detail="Векторная база не загружена.")
+    try:
+        default = await asyncio.to_thread(db_router.get, DEFAULT_DB)
+    except Exception:
+        raise HTTPException(status_code=503, detail="Векторная база не загружена.")
+    return {"status": "ok", "generation": default.generation, "index_version": default.version,
+            "vectors": default.store.ntotal, "databases": db_router.stats(), "memory": process_memory()}
+
+@app.get("/databases")
+async def databases():
+    """Доступные базы, загруженные базы и их суммарный размер относительно потолка"""
+    return {"available": db_router.available(), **db_router.stats()}
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Доля попаданий и занимаемая память кэшей запросов"""
+    stats = query_caches.stats()
+    stats["batcher"] = search_batcher.stats()
+    stats["databases"] = db_router.stats()
+    stats["reranker"] = reranker.stats()
+    stats["embeddings"] = embeddings.stats() if embeddings is not None else None
+    stats["process_memory"] = process_memory()
+    return stats
+
 if __name__ == "__main__":
-    print("🚀 Запуск RAG API сервера...")
-    uvicorn.run(app, host="0.0.0.0", port=9000)
+    print(f"🚀 Запуск RAG API сервера (воркеров: {API_WORKERS})...")
+    if API_WORKERS > 1:
+        # Воркеры импортируют приложение по строке; имя файла начинается с цифры, поэтому через __main__
+        uvicorn.run("__main__:app", host="0.0.0.0", port=9000, workers=API_WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=9000)
 
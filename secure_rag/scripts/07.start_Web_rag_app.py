@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 import uvicorn
 from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from contextlib import asynccontextmanager
-import requests
+import httpx
 import json
+import time
 import os
 import subprocess
 import sys
@@ -15,6 +16,11 @@ import socket
 import threading
 import webbrowser
 import atexit # Для регистрации функции завершения
+from http_clients import AsyncBackendPool, BackendConfig
+from context_packer import apack_context, estimate_tokens
+from answer_cache import SemanticAnswerCache
+from request_metrics import (current_trace_id, format_trace, instrument, observe_stage, record_generation,
+                             span, trace_headers)
 
 # --- 1. Конфигурация приложения ---
 # Пути к скриптам и файлам
@@ -24,17 +30,50 @@ LOG_FILE = "07_rag_web_app.log"
 TEMPLATES_DIR = "." # Директория для index.html
 
 # Сетевые настройки
-RAG_API_URL = "http://localhost:9000/search"
-LLAMA_SERVER_URL = "http://localhost:8080/completion"
+RAG_API_BASE_URL = "http://localhost:9000"
+LLAMA_SERVER_BASE_URL = "http://localhost:8080"
+RAG_API_URL = f"{RAG_API_BASE_URL}/search"
+LLAMA_SERVER_URL = f"{LLAMA_SERVER_BASE_URL}/completion"
 WEB_APP_URL = "http://localhost:8000"
 WEB_APP_HOST = "0.0.0.0"
 RAG_API_PORT = 9000
 LLAMA_SERVER_PORT = 8080
 WEB_APP_PORT = 8000
 
+# Запуск бэкендов: готовность определяется опросом их /health с экспоненциальной паузой
+RAG_API_STARTUP_TIMEOUT = 30  # секунд
+LLAMA_SERVER_STARTUP_TIMEOUT = 60  # секунд
+HEALTH_POLL_INITIAL_DELAY = 0.1
+HEALTH_POLL_MAX_DELAY = 2.0
+HEALTH_POLL_REQUEST_TIMEOUT = 2.0
+
 # Параметры RAG и LLM
-K_RETRIEVED_CHUNKS = 3
+K_RETRIEVED_CHUNKS = 6  # Кандидатов из RAG; в промпт попадает столько, сколько влезет в бюджет
+CONTEXT_TOKEN_BUDGET = 4096  # Токенов контекста из --ctx-size 8192 (остальное - вопрос и ответ)
+MIN_RELEVANCE_SCORE = 0.3  # Чанки с меньшей релевантностью в промпт не попадают
+# Базы RAG API через запятую (RAG_SEARCH_DATABASES); пусто - основная база
+SEARCH_DATABASES = os.environ.get("RAG_SEARCH_DATABASES", "")
+# С переранжированием кросс-энкодером (RAG_SEARCH_RERANK=1) лучшие чанки точнее, и в промпт идет меньше чанков
+SEARCH_RERANK = os.environ.get("RAG_SEARCH_RERANK", "0") == "1"
+K_RERANKED_CHUNKS = 3
 LLM_MODEL_NAME = "mistral-7b-grok-Q4_K_M.gguf"
+LLM_N_PREDICT = 2048
+LLM_TEMPERATURE = 0.7
+LLM_STOP = ["\nUser:", "\n###", "<|im_end|>", "<|endoftext|>"]
+
+# Семантический кэш ответов: перефразированный вопрос с теми же источниками не идет в LLM
+ANSWER_CACHE_DIR = os.path.expanduser("~/secure_rag/answer_cache")
+ANSWER_CACHE_SIZE = 1000  # Максимум ответов, вытеснение по LRU
+ANSWER_CACHE_THRESHOLD = 0.95  # Минимальная косинусная близость вопросов
+
+# Пулы HTTP-соединений к бэкендам: keep-alive, лимиты, таймауты и повторы
+HTTP_BACKENDS = {
+    "rag": BackendConfig(RAG_API_BASE_URL, max_connections=32, max_keepalive=16,
+                         read_timeout=30.0, retries=2),
+    # Генерация может идти минуты, а потоковый ответ читается без таймаута
+    "llama": BackendConfig(LLAMA_SERVER_BASE_URL, max_connections=8, max_keepalive=8,
+                           read_timeout=None, retries=1),
+}
 
 # --- 2. Настройка логирования ---
 # Создаем логгер
@@ -76,56 +115,56 @@ async def check_port_is_free(port: int, host: str = '127.0.0.1'):
         logger.error(f"❌ ПОРТ {port} УЖЕ ЗАНЯТ. Освободите порт и перезапустите приложение.")
         return False
 
-async def read_stream(stream, ready_signal: str, log_prefix: str):
-    """Асинхронно читает поток, логирует и ищет сигнал готовности."""
-    # Используем to_thread для блокирующего вызова readline
-    while line := await asyncio.to_thread(stream.readline):
-        stripped_line = line.strip()
-        logger.info(f"[{log_prefix}] {stripped_line}")
-        if ready_signal in stripped_line:
-            return True
-    return False
-
-async def wait_for_server_ready(process, ready_signal: str, log_prefix: str, timeout: int):
+def pump_stream(stream, log_prefix: str):
+    """Пересылает вывод процесса в лог, пока поток не закроется (иначе переполненный пайп остановит процесс)."""
+    for line in iter(stream.readline, ''):
+        logger.info(f"[{log_prefix}] {line.rstrip()}")
+
+def start_log_pumps(process, log_prefix: str):
+    for stream, suffix in ((process.stdout, "stdout"), (process.stderr, "stderr")):
+        threading.Thread(target=pump_stream, args=(stream, f"{log_prefix}-{suffix}"), daemon=True).start()
+
+async def wait_until_healthy(process, backend: str, health_path: str, log_prefix: str, timeout: float) -> float:
     """
-    Конкурентно отслеживает stdout и stderr процесса в ожидании сигнала готовности.
+    Опрашивает HTTP-эндпоинт здоровья бэкенда с экспоненциальной паузой.
+    Возвращает момент (time.perf_counter) готовности; бросает RuntimeError при падении процесса или таймауте.
     """
-    logger.info(f"Ожидание сигнала готовности ('{ready_signal}') от процесса {log_prefix} (PID: {process.pid}). Таймаут: {timeout}с.")
-    
-    # Создаем две задачи для одновременного чтения stdout и stderr
-    stdout_task = asyncio.create_task(read_stream(process.stdout, ready_signal, f"{log_prefix}-stdout"))
-    stderr_task = asyncio.create_task(read_stream(process.stderr, ready_signal, f"{log_prefix}-stderr"))
-
-    try:
-        # Ждем завершения первой из задач с сигналом готовности
-        done, pending = await asyncio.wait(
-            [stdout_task, stderr_task],
-            timeout=timeout,
-            return_when=asyncio.FIRST_COMPLETED
-        )
-        
-        # Отменяем оставшуюся задачу, она нам больше не нужна
-        for task in pending:
-            task.cancel()
-            
-        if not done:
-            raise asyncio.TimeoutError
-            
-        # Проверяем, был ли результат успешным
-        task_result = done.pop().result()
-        if not task_result:
-            # Задача завершилась (поток закрылся), но сигнал не был найден
-             raise RuntimeError(f"Поток вывода процесса {log_prefix} закрылся без сигнала готовности.")
-
-        logger.info(f"✅ Сигнал готовности от {log_prefix} получен.")
-        return True
+    logger.info(f"Ожидание готовности {log_prefix} (PID: {process.pid}) по {health_path}. Таймаут: {timeout}с.")
+    client = http_pool.client(backend)
+    deadline = time.perf_counter() + timeout
+    delay = HEALTH_POLL_INITIAL_DELAY
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError(f"Процесс {log_prefix} завершился с кодом {process.returncode} до готовности.")
+        try:
+            response = await client.get(health_path, timeout=HEALTH_POLL_REQUEST_TIMEOUT)
+            if response.status_code == 200:
+                logger.info(f"✅ {log_prefix} готов к работе.")
+                return time.perf_counter()
+            # llama-server отвечает 503, пока загружает модель
+            logger.debug(f"{log_prefix}: {health_path} -> {response.status_code}")
+        except httpx.HTTPError:
+            pass  # Сервер еще не слушает порт
+        if time.perf_counter() + delay > deadline:
+            raise RuntimeError(f"Таймаут ожидания готовности {log_prefix} ({timeout}с).")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, HEALTH_POLL_MAX_DELAY)
+
+def launch_rag_api():
+    return subprocess.Popen(
+        [sys.executable, RAG_API_SERVER_SCRIPT],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8'
+    )
 
-    except asyncio.TimeoutError:
-        logger.error(f"❌ Таймаут ожидания запуска процесса {log_prefix}.")
-        return False
-    except Exception as e:
-        logger.error(f"❌ Ошибка при ожидании запуска {log_prefix}: {e}")
-        return False
+def launch_llama_server():
+    # Убедимся, что скрипт исполняемый
+    if not os.access(LLAMA_SERVER_RUN_SCRIPT, os.X_OK):
+         logger.warning(f"Скрипт {LLAMA_SERVER_RUN_SCRIPT} не является исполняемым. Попытка добавить права (chmod +x)...")
+         os.chmod(LLAMA_SERVER_RUN_SCRIPT, 0o755)
+    return subprocess.Popen(
+        [LLAMA_SERVER_RUN_SCRIPT],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8'
+    )
 
 
 # --- 4. Lifespan Manager (Управление жизненным циклом) ---
@@ -141,42 +180,38 @@ async def lifespan(app: FastAPI):
     logger.info("--- Начало этапа запуска фоновых процессов ---")
 
     try:
-        # Шаг 1: Проверка и запуск RAG API сервера
-        logger.info("ШАГ 1: Запуск RAG API сервера")
+        await http_pool.start()
+        t0 = time.perf_counter()
+
+        # Шаг 1: Проверка портов
+        logger.info("ШАГ 1: Проверка портов RAG API и Llama.cpp серверов")
         if not await check_port_is_free(RAG_API_PORT):
             raise RuntimeError("Не удалось запустить RAG API сервер: порт занят.")
-
-        rag_api_process = subprocess.Popen(
-            [sys.executable, RAG_API_SERVER_SCRIPT],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8'
-        )
-
-        if not await wait_for_server_ready(rag_api_process, "Uvicorn running on", "RAG_API", 30):
-            raise RuntimeError("RAG API сервер не смог запуститься в установленное время.")
-        
-        logger.info("Результат: RAG API сервер успешно запущен.")
-        await asyncio.sleep(3) # Даем время на окончательную инициализацию
-
-        # Шаг 2: Проверка и запуск Llama.cpp сервера
-        logger.info("ШАГ 2: Запуск Llama.cpp сервера")
         if not await check_port_is_free(LLAMA_SERVER_PORT):
             raise RuntimeError("Не удалось запустить Llama.cpp сервер: порт занят.")
-            
-        # Убедимся, что скрипт исполняемый
-        if not os.access(LLAMA_SERVER_RUN_SCRIPT, os.X_OK):
-             logger.warning(f"Скрипт {LLAMA_SERVER_RUN_SCRIPT} не является исполняемым. Попытка добавить права (chmod +x)...")
-             os.chmod(LLAMA_SERVER_RUN_SCRIPT, 0o755)
-
-        llama_server_process = subprocess.Popen(
-            [LLAMA_SERVER_RUN_SCRIPT],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8'
+
+        # Шаг 2: Одновременный запуск обоих серверов; готовность определяется по /health
+        logger.info("ШАГ 2: Параллельный запуск RAG API и Llama.cpp серверов")
+        rag_api_process = launch_rag_api()
+        start_log_pumps(rag_api_process, "RAG_API")
+        rag_launched = time.perf_counter()
+        llama_server_process = launch_llama_server()
+        start_log_pumps(llama_server_process, "Llama.cpp")
+        llama_launched = time.perf_counter()
+
+        rag_ready, llama_ready = await asyncio.gather(
+            wait_until_healthy(rag_api_process, "rag", "/health", "RAG_API", RAG_API_STARTUP_TIMEOUT),
+            wait_until_healthy(llama_server_process, "llama", "/health", "Llama.cpp", LLAMA_SERVER_STARTUP_TIMEOUT)
         )
-        
-        if not await wait_for_server_ready(llama_server_process, "server is listening on", "Llama.cpp", 60):
-            raise RuntimeError("Llama.cpp сервер не смог запуститься в установленное время.")
-            
-        logger.info("Результат: Llama.cpp сервер успешно запущен.")
-        await asyncio.sleep(3)
+        logger.info("Результат: RAG API и Llama.cpp серверы успешно запущены.")
+
+        # Разбивка времени холодного старта
+        logger.info("Таймлайн запуска (от начала lifespan):")
+        logger.info(f"  RAG API:   запуск +{rag_launched - t0:.2f}с, готов +{rag_ready - t0:.2f}с "
+                    f"(загрузка {rag_ready - rag_launched:.2f}с)")
+        logger.info(f"  Llama.cpp: запуск +{llama_launched - t0:.2f}с, готов +{llama_ready - t0:.2f}с "
+                    f"(загрузка {llama_ready - llama_launched:.2f}с)")
+        logger.info(f"  Итого до готовности: {max(rag_ready, llama_ready) - t0:.2f}с")
 
         logger.info("--- Все фоновые процессы успешно запущены. Приложение готово. ---")
 
@@ -219,55 +254,159 @@ async def lifespan(app: FastAPI):
                 logger.info("Результат: RAG API сервер принудительно остановлен.")
         
         logger.info("--- Все фоновые процессы остановлены. ---")
+        await http_pool.close()
+        await asyncio.to_thread(answer_cache.save)
 
+http_pool = AsyncBackendPool(HTTP_BACKENDS)
+answer_cache = SemanticAnswerCache(ANSWER_CACHE_DIR, ANSWER_CACHE_SIZE, ANSWER_CACHE_THRESHOLD)
 app = FastAPI(lifespan=lifespan)
+# /metrics (гистограммы этапов в формате Prometheus); trace id запроса передается в RAG API заголовком X-Trace-Id
+instrument(app, log=logger.info)
 templates = Jinja2Templates(directory=TEMPLATES_DIR)
 
 # --- 5. Функции для взаимодействия с API ---
 
-async def get_rag_context_async(query: str) -> list:
-    """Асинхронно получает контекст от RAG API."""
+async def get_rag_context_async(query: str) -> dict:
+    """Асинхронно получает контекст от RAG API: results, а также embedding и index_version для кэша ответов."""
     logger.info(f"Новый шаг: Получение контекста для запроса '{query}'")
     try:
-        # Использование `asyncio.to_thread` для запуска синхронного кода в отдельном потоке
-        response = await asyncio.to_thread(requests.get, RAG_API_URL, params={"query": query, "k": K_RETRIEVED_CHUNKS})
+        params = {"query": query, "k": K_RETRIEVED_CHUNKS, "with_embedding": "true"}
+        if SEARCH_DATABASES:
+            params["dbs"] = SEARCH_DATABASES
+        if SEARCH_RERANK:
+            params.update(k=K_RERANKED_CHUNKS, rerank="true")
+        with span("rag_search"):
+            response = await http_pool.request("rag", "GET", "/search", params=params, headers=trace_headers())
         response.raise_for_status()
         data = response.json()
         
         if data and "results" in data:
             logger.info(f"Исполнено: Получено {len(data['results'])} релевантных документов.")
-            return data["results"]
+            return data
         else:
             logger.warning("Не исполнено: RAG API вернул пустые или некорректные результаты.")
-            return []
-    except requests.exceptions.RequestException as e:
+            return {"results": []}
+    except httpx.HTTPError as e:
         logger.error(f"Не исполнено: Ошибка при запросе к RAG API. Причина: {e}")
-        return []
-
-async def generate_llm_response_async(prompt: str) -> str:
-    """Асинхронно генерирует ответ с помощью LLM."""
+        return {"results": []}
+
+def lookup_cached_answer(retrieval: dict):
+    """Ищет готовый ответ на близкий по смыслу вопрос с тем же набором источников."""
+    if not retrieval.get("embedding"):
+        return None
+    sources = [clean_source(doc) for doc in retrieval["results"]]
+    cached = answer_cache.lookup(retrieval["embedding"], sources, retrieval.get("index_version"))
+    if cached is not None:
+        logger.info(f"Исполнено: Ответ взят из кэша (близость {cached['similarity']:.3f} "
+                    f"к вопросу '{cached['query']}'), Llama-сервер не вызывается.")
+    return cached
+
+def remember_answer(user_query: str, retrieval: dict, answer: str):
+    if not retrieval.get("embedding") or not answer:
+        return
+    sources = [clean_source(doc) for doc in retrieval["results"]]
+    answer_cache.store(user_query, retrieval["embedding"], sources, retrieval.get("index_version"), answer)
+
+async def generate_llm_response_async(prompt: str) -> tuple:
+    """Асинхронно генерирует ответ с помощью LLM. Возвращает (текст, успешно ли)."""
     logger.info("Новый шаг: Отправка промпта на Llama-сервер для генерации ответа.")
-    headers = {"Content-Type": "application/json"}
-    payload = {
-        "prompt": prompt, "n_predict": 2048, "temperature": 0.7,
-        "stop": ["\nUser:", "\n###", "<|im_end|>", "<|endoftext|>"],
-        "model": LLM_MODEL_NAME
-    }
+    payload = build_llm_payload(prompt)
     
     try:
-        response = await asyncio.to_thread(requests.post, LLAMA_SERVER_URL, headers=headers, json=payload)
-        response.raise_for_status()
-        result = response.json()
+        started = time.perf_counter()
+        with span("llm_generation"):
+            response = await http_pool.request("llama", "POST", "/completion", json=payload)
+            response.raise_for_status()
+            result = response.json()
 
         if "content" in result:
             logger.info("Исполнено: Получен ответ от Llama-сервера.")
-            return result["content"].strip()
+            timings = result.get("timings") or {}
+            if timings.get("prompt_ms"):
+                # Без потока первый токен не виден: до него идет обработка промпта
+                observe_stage("llm_ttft", timings["prompt_ms"] / 1000)
+            record_llm_timings(timings, estimate_tokens(result["content"]), time.perf_counter() - started)
+            return result["content"].strip(), True
         else:
             logger.warning("Не исполнено: Llama-сервер вернул ответ без поля 'content'.")
-            return "Не удалось получить корректный ответ от LLM."
-    except requests.exceptions.RequestException as e:
+            return "Не удалось получить корректный ответ от LLM.", False
+    except httpx.HTTPError as e:
         logger.error(f"Не исполнено: Ошибка при запросе к Llama-серверу. Причина: {e}")
-        return f"Ошибка при генерации ответа LLM: {e}"
+        return f"Ошибка при генерации ответа LLM: {e}", False
+
+async def count_tokens_async(texts: list) -> list:
+    """Считает токены токенизатором модели (/tokenize llama-server); при ошибке - грубая оценка."""
+    async def count(text: str) -> int:
+        try:
+            response = await http_pool.request("llama", "POST", "/tokenize", json={"content": text})
+            response.raise_for_status()
+            return len(response.json()["tokens"])
+        except (httpx.HTTPError, KeyError, ValueError):
+            return estimate_tokens(text)
+    return list(await asyncio.gather(*(count(text) for text in texts)))
+
+async def assemble_context_async(retrieved_docs: list) -> list:
+    """Сливает перекрывающиеся чанки, отсеивает нерелевантные и укладывает контекст в бюджет токенов."""
+    if not retrieved_docs:
+        return []
+    with span("context_assembly"):
+        packed = await apack_context(retrieved_docs, count_tokens_async, CONTEXT_TOKEN_BUDGET, MIN_RELEVANCE_SCORE)
+    logger.info(f"Исполнено: Сборка контекста - {packed.summary()}.")
+    return packed.docs()
+
+def build_llm_payload(prompt: str, stream: bool = False) -> dict:
+    """Параметры генерации для llama-server /completion."""
+    return {
+        "prompt": prompt, "n_predict": LLM_N_PREDICT, "temperature": LLM_TEMPERATURE,
+        "stop": LLM_STOP, "model": LLM_MODEL_NAME, "stream": stream
+    }
+
+def record_llm_timings(timings: dict, tokens: int, seconds: float):
+    """Скорость генерации по timings llama-server (predicted_n, predicted_ms); без них - по замеру на клиенте."""
+    if timings.get("predicted_n") and timings.get("predicted_ms"):
+        tokens, seconds = timings["predicted_n"], timings["predicted_ms"] / 1000
+    record_generation(tokens, seconds)
+
+async def stream_llm_response_async(prompt: str, timings: dict = None):
+    """Асинхронно получает ответ LLM по мере генерации (SSE от llama-server), токен за токеном.
+    В timings (если передан) попадает статистика генерации из последнего события llama-server."""
+    logger.info("Новый шаг: Потоковая генерация ответа на Llama-сервере.")
+    client = http_pool.client("llama")
+    async with client.stream("POST", "/completion", json=build_llm_payload(prompt, stream=True)) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            chunk = json.loads(line[len("data: "):])
+            if chunk.get("content"):
+                yield chunk["content"]
+            if chunk.get("stop"):
+                if timings is not None:
+                    timings.update(chunk.get("timings") or {})
+                break
+
+def build_prompt(user_query: str, retrieved_docs: list) -> str:
+    """Собирает промпт для LLM из вопроса и найденного контекста."""
+    context_text = ""
+    if retrieved_docs:
+        context_text = "\n\n### Контекст из документов:\n"
+        for i, doc in enumerate(retrieved_docs):
+            context_text += f"Документ {i+1} (Источник: {clean_source(doc)}):\n{doc.get('content', '')}\n---\n"
+    else:
+        logger.warning("Контекст для запроса не найден. Ответ будет сгенерирован без него.")
+
+    return f"""Ты — полезный ассистент. Ответь на вопрос, используя предоставленный контекст. Если ответ в контексте отсутствует, сообщи об этом.
+{context_text}
+### Вопрос:
+{user_query}
+### Ответ:"""
+
+def clean_source(doc: dict) -> str:
+    return doc.get('source', 'Неизвестно').replace(os.path.expanduser("~/secure_rag/md/"), "")
+
+def sse_event(event: str, data) -> str:
+    """Форматирует одно событие Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 # --- 6. Веб-эндпоинты FastAPI ---
 
@@ -282,29 +421,25 @@ async def read_root(request: Request):
 @app.post("/ask", response_class=HTMLResponse)
 async def ask_question(request: Request, user_query: str = Form(...)):
     """Обрабатывает запрос пользователя: RAG -> LLM -> Ответ."""
-    logger.info(f"==== НАЧАЛО ОБРАБОТКИ ЗАПРОСА ПОЛЬЗОВАТЕЛЯ: '{user_query}' ====")
+    logger.info(f"==== НАЧАЛО ОБРАБОТКИ ЗАПРОСА ПОЛЬЗОВАТЕЛЯ: '{user_query}' (trace {current_trace_id()}) ====")
     
     # 1. Получаем контекст
-    retrieved_docs = await get_rag_context_async(user_query)
-    context_text = ""
-    if retrieved_docs:
-        context_text = "\n\n### Контекст из документов:\n"
-        for i, doc in enumerate(retrieved_docs):
-            source = doc.get('source', 'Неизвестно').replace(os.path.expanduser("~/secure_rag/md/"), "")
-            context_text += f"Документ {i+1} (Источник: {source}):\n{doc.get('content', '')}\n---\n"
-    else:
-        logger.warning("Контекст для запроса не найден. Ответ будет сгенерирован без него.")
+    retrieval = await get_rag_context_async(user_query)
+    retrieved_docs = retrieval["results"]
 
-    # 2. Формируем промпт
-    prompt = f"""Ты — полезный ассистент. Ответь на вопрос, используя предоставленный контекст. Если ответ в контексте отсутствует, сообщи об этом.
-{context_text}
-### Вопрос:
-{user_query}
-### Ответ:"""
-    
-    # 3. Генерируем ответ
-    llm_response = await generate_llm_response_async(prompt)
-    logger.info(f"Результат: Финальный ответ LLM для пользователя сгенерирован.")
+    cached = lookup_cached_answer(retrieval)
+    if cached is not None:
+        llm_response = cached["answer"]
+    else:
+        # 2. Формируем промпт
+        context_docs = await assemble_context_async(retrieved_docs)
+        prompt = build_prompt(user_query, context_docs)
+        
+        # 3. Генерируем ответ
+        llm_response, ok = await generate_llm_response_async(prompt)
+        if ok:
+            remember_answer(user_query, retrieval, llm_response)
+        logger.info(f"Результат: Финальный ответ LLM для пользователя сгенерирован.")
     logger.info(f"==== КОНЕЦ ОБРАБОТКИ ЗАПРОСА '{user_query}' ====")
     
     return templates.TemplateResponse(
@@ -312,6 +447,69 @@ async def ask_question(request: Request, user_query: str = Form(...)):
         {"request": request, "user_query": user_query, "response_text": llm_response}
     )
 
+@app.post("/ask/stream")
+async def ask_question_stream(user_query: str = Form(...)):
+    """Потоковый режим: сначала источники, затем токены ответа по мере генерации (SSE)."""
+    logger.info(f"==== НАЧАЛО ПОТОКОВОЙ ОБРАБОТКИ ЗАПРОСА: '{user_query}' (trace {current_trace_id()}) ====")
+    started = time.perf_counter()
+
+    async def event_stream():
+        retrieval = await get_rag_context_async(user_query)
+        retrieved_docs = retrieval["results"]
+        yield sse_event("sources", [{"source": clean_source(doc)} for doc in retrieved_docs])
+
+        ttft = None
+        n_chunks = 0
+        cached = lookup_cached_answer(retrieval)
+        if cached is not None:
+            ttft = time.perf_counter() - started
+            n_chunks = 1
+            yield sse_event("token", {"content": cached["answer"]})
+        else:
+            context_docs = await assemble_context_async(retrieved_docs)
+            prompt = build_prompt(user_query, context_docs)
+            tokens = []
+            timings = {}
+            llm_started = time.perf_counter()
+            first_token_at = None
+            try:
+                async for token in stream_llm_response_async(prompt, timings):
+                    if ttft is None:
+                        first_token_at = time.perf_counter()
+                        ttft = first_token_at - started
+                        observe_stage("llm_ttft", first_token_at - llm_started)
+                        logger.info(f"Время до первого токена: {ttft * 1000:.0f} мс")
+                    n_chunks += 1
+                    tokens.append(token)
+                    yield sse_event("token", {"content": token})
+                generated = time.perf_counter()
+                observe_stage("llm_generation", generated - llm_started)
+                if first_token_at is not None:
+                    record_llm_timings(timings, n_chunks, generated - first_token_at)
+                remember_answer(user_query, retrieval, "".join(tokens).strip())
+            except (httpx.HTTPError, json.JSONDecodeError) as e:
+                logger.error(f"Не исполнено: Ошибка потоковой генерации. Причина: {e}")
+                yield sse_event("error", {"message": f"Ошибка при генерации ответа LLM: {e}"})
+
+        total = time.perf_counter() - started
+        logger.info(f"Результат: Потоковый ответ завершен за {total:.2f} с ({n_chunks} фрагментов).")
+        # Middleware вернул ответ до генерации, поэтому спаны потокового запроса пишутся здесь
+        logger.info(f"🧭 {format_trace(path='/ask/stream', total_ms=round(total * 1000, 2))}")
+        logger.info(f"==== КОНЕЦ ПОТОКОВОЙ ОБРАБОТКИ ЗАПРОСА '{user_query}' ====")
+        yield sse_event("done", {
+            "ttft_ms": round(ttft * 1000) if ttft is not None else None,
+            "total_ms": round(total * 1000),
+            "chunks": n_chunks,
+            "cached": cached is not None,
+            "trace_id": current_trace_id()
+        })
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # --- 7. Запуск приложения ---
 if __name__ == "__main__":
     logger.info("**** Старт начала записи ****")
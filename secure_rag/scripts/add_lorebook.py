@@ -2,10 +2,15 @@
 import os
 import sys
 import logging
-import json
-from langchain_community.document_loaders import TextLoader
-from langchain_community.embeddings import SentenceTransformerEmbeddings
-from langchain_community.vectorstores import FAISS
+import uuid
+import argparse
+from embedding_backend import create_embeddings, describe_backend, embedding_model_id
+from embedding_cache import EmbeddingCache, CachedEmbeddings
+from ann_index import (MAX_TOMBSTONE_FRACTION, IndexConfig, add_vectors, build_vector_db, drop_tombstones,
+                       load_vector_db, remove_vectors, save_vector_db, tombstone_fraction)
+from parallel_build import DEFAULT_BUILD_WORKERS, iter_split_files, list_markdown_files
+from delta_segments import compact, needs_compaction, write_delta, writer_lock
+from lorebook_manifest import book_key, chunk_ids_by_source, file_hash, load_manifest, save_manifest
 
 # --- Настройка логирования ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -14,61 +19,44 @@ logger = logging.getLogger(__name__)
 # --- Конфигурация ---
 # Базовая директория для хранения векторных баз
 BASE_DB_DIR = os.path.expanduser("~/secure_rag/vector_dbs")
-# Директория, где ожидается один Markdown-файл для добавления
+# Директория по умолчанию с Markdown-файлами для добавления
 LORE_BOOKS_DIR = os.path.expanduser("~/secure_rag/lore_books")
-# Локальный путь к модели эмбеддингов
-EMBEDDING_MODEL_PATH = os.path.expanduser("~/models/embeding/BAAI-bge-m3")
+# Книги режутся на чанки так же, как при создании базы
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 100
 
 # --- Вспомогательные функции ---
 
-def load_single_document(file_path: str) -> list:
-    """
-    Загружает один Markdown-файл как документ.
-    """
-    logger.info(f"Загрузка документа из: {file_path}")
-    try:
-        loader = TextLoader(file_path, encoding="utf-8")
-        documents = loader.load()
-        if documents:
-            # Добавляем метаданные для отслеживания источника
-            for doc in documents:
-                doc.metadata["source"] = os.path.basename(file_path)
-            logger.info(f"Успешно загружен документ: {file_path}")
-            return documents
+def collect_books(paths: list) -> list:
+    """Markdown-файлы из указанных файлов и директорий (директории обходятся рекурсивно)."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(list_markdown_files(path))
+        elif path.endswith(".md") and os.path.isfile(path):
+            files.append(path)
         else:
-            logger.warning(f"Документ пуст или не удалось загрузить: {file_path}")
-            return []
-    except Exception as e:
-        logger.error(f"Ошибка загрузки документа {file_path}: {e}")
-        return []
+            logger.warning(f"Пропускаю '{path}': это не Markdown-файл и не директория.")
+    return list(dict.fromkeys(files))
 
-def get_added_lorebooks_path(db_path: str) -> str:
-    """Возвращает путь к файлу журнала добавленных книг для данной базы."""
-    return os.path.join(db_path, "added_lorebooks.json")
+def load_and_split_books(files: list) -> tuple:
+    """Загружает и режет книги на чанки, каждому чанку назначает id.
 
-def load_added_lorebooks(json_path: str) -> list:
-    """Загружает список имен добавленных книг из JSON-файла."""
-    if not os.path.exists(json_path):
-        return []
-    try:
-        with open(json_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except json.JSONDecodeError as e:
-        logger.error(f"Ошибка чтения JSON-файла '{json_path}': {e}. Возвращаю пустой список.")
-        return []
-    except Exception as e:
-        logger.error(f"Непредвиденная ошибка при загрузке '{json_path}': {e}. Возвращаю пустой список.")
-        return []
-
-def save_added_lorebooks(json_path: str, added_files: list):
-    """Сохраняет список имен добавленных книг в JSON-файл."""
-    try:
-        os.makedirs(os.path.dirname(json_path), exist_ok=True)
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(added_files, f, ensure_ascii=False, indent=4)
-        logger.info(f"Список добавленных книг сохранен в: {json_path}")
-    except Exception as e:
-        logger.error(f"Ошибка сохранения списка добавленных книг в '{json_path}': {e}")
+    Возвращает (чанки, их id, записи манифеста по книгам с текстом; ключ - путь книги).
+    """
+    chunks, chunk_ids, entries = [], [], {}
+    workers = min(len(files), DEFAULT_BUILD_WORKERS)
+    for path, file_chunks in iter_split_files(files, CHUNK_SIZE, CHUNK_OVERLAP, workers):
+        if not file_chunks:
+            logger.warning(f"Документ пуст: {path}")
+            continue
+        key = book_key(path)
+        logger.info(f"Загружен документ '{os.path.basename(path)}': чанков {len(file_chunks)}")
+        ids = [str(uuid.uuid4()) for _ in file_chunks]
+        chunks.extend(file_chunks)
+        chunk_ids.extend(ids)
+        entries[key] = {"hash": file_hash(path), "chunk_ids": ids}
+    return chunks, chunk_ids, entries
 
 def list_existing_dbs() -> list:
     """Возвращает список имен существующих векторных баз данных."""
@@ -78,9 +66,20 @@ def list_existing_dbs() -> list:
     dbs = [d for d in os.listdir(BASE_DB_DIR) if os.path.isdir(os.path.join(BASE_DB_DIR, d))]
     return dbs
 
-def create_new_vector_db_from_documents(db_name: str, documents: list) -> bool:
+def init_embeddings():
+    logger.info(f"Инициализация модели эмбеддингов ({describe_backend()})...")
+    try:
+        embeddings = create_embeddings()
+        logger.info("Модель эмбеддингов успешно инициализирована.")
+        return embeddings
+    except Exception as e:
+        logger.error(f"Ошибка инициализации модели эмбеддингов: {e}")
+        logger.error(f"Убедитесь, что модель эмбеддингов доступна: {describe_backend()}")
+        return None
+
+def create_new_vector_db_from_documents(db_name: str, documents: list, chunk_ids: list) -> bool:
     """
-    Создает новую векторную базу данных FAISS из списка документов.
+    Создает новую векторную базу данных FAISS из списка чанков.
     Эта логика должна быть идентична 02.create_vector_db.py.
     """
     db_path = os.path.join(BASE_DB_DIR, db_name)
@@ -90,124 +89,208 @@ def create_new_vector_db_from_documents(db_name: str, documents: list) -> bool:
         return False
 
     logger.info(f"Создание новой векторной базы данных '{db_name}' в: {db_path}")
-    os.makedirs(db_path, exist_ok=True)
+    embeddings = init_embeddings()
+    if embeddings is None:
+        return False
 
-    logger.info("Инициализация модели эмбеддингов BAAI/bge-m3 (локально)...")
+    logger.info(f"Создание FAISS векторной базы данных из {len(documents)} чанков...")
     try:
-        embeddings = SentenceTransformerEmbeddings(model_name=EMBEDDING_MODEL_PATH)
-        logger.info("Модель эмбеддингов успешно инициализирована.")
+        with writer_lock(db_path), EmbeddingCache(embedding_model_id()) as cache:
+            vector_db, index_config = build_vector_db(documents, CachedEmbeddings(embeddings, cache),
+                                                      IndexConfig.from_env(), ids=chunk_ids)
+            save_vector_db(vector_db, db_path, index_config)
+        logger.info(cache.report())
+        logger.info(f"Векторная база данных '{db_name}' успешно создана и сохранена.")
+        return True
     except Exception as e:
-        logger.error(f"Ошибка инициализации модели эмбеддингов: {e}")
-        logger.error(f"Убедитесь, что модель эмбеддингов доступна по пути: {EMBEDDING_MODEL_PATH}")
+        logger.critical(f"Критическая ошибка при создании векторной базы данных: {e}", exc_info=True)
+        logger.error("Убедитесь, что `faiss-gpu` или `faiss-cpu` установлен и совместим.")
         return False
 
-    logger.info(f"Создание FAISS векторной базы данных из {len(documents)} документа(ов)...")
+def add_to_existing_db(db_name: str, documents: list, chunk_ids: list, force_compaction: bool) -> bool:
+    """
+    Дописывает чанки новых книг в существующую базу отдельной дельтой: основной индекс не загружается
+    и не переписывается, поэтому время добавления зависит только от размера новых книг.
+    Когда дельт накопилось много, они сливаются в основной индекс (компакция).
+    """
+    db_path = os.path.join(BASE_DB_DIR, db_name)
+    embeddings = init_embeddings()
+    if embeddings is None:
+        return False
     try:
-        vector_db = FAISS.from_documents(documents, embeddings)
-        vector_db.save_local(db_path)
-        logger.info(f"Векторная база данных '{db_name}' успешно создана и сохранена.")
+        with writer_lock(db_path):
+            logger.info(f"Добавление {len(documents)} чанков в базу '{db_name}' дельтой...")
+            with EmbeddingCache(embedding_model_id()) as cache:
+                write_delta(db_path, documents, CachedEmbeddings(embeddings, cache), ids=chunk_ids)
+            logger.info(cache.report())
+            if force_compaction or needs_compaction(db_path):
+                logger.info(f"Слияние дельт базы '{db_name}' с основным индексом...")
+                compact(db_path, embeddings)
         return True
     except Exception as e:
-        logger.critical(f"Критическая ошибка при создании векторной базы данных: {e}", exc_info=True)
+        logger.critical(f"Критическая ошибка при добавлении документов в существующую базу '{db_name}': {e}", exc_info=True)
         logger.error("Убедитесь, что `faiss-gpu` или `faiss-cpu` установлен и совместим.")
         return False
 
-def main():
-    logger.info("=== Начало процесса добавления книги в векторную базу ===")
-    
-    # --- Шаг 1: Проверка директории lore_books на наличие одного файла ---
-    if not os.path.exists(LORE_BOOKS_DIR):
-        logger.error(f"Директория '{LORE_BOOKS_DIR}' не найдена.")
-        logger.error("Пожалуйста, создайте эту директорию и поместите в нее Markdown-файл.")
-        sys.exit(1)
+def update_existing_db(db_name: str, manifest: dict, stale_keys: list, documents: list, chunk_ids: list) -> bool:
+    """
+    Обновление и удаление книг без пересборки базы: дельты сливаются с основным индексом,
+    старые чанки книг stale_keys (ключей манифеста) удаляются из FAISS (по меткам) и docstore, затем добавляются
+    новые чанки. Переэмбеддируются только измененные и новые книги.
+    """
+    db_path = os.path.join(BASE_DB_DIR, db_name)
+    embeddings = init_embeddings()
+    if embeddings is None:
+        return False
+    try:
+        with writer_lock(db_path):
+            compact(db_path, embeddings)
+            vector_db, index_config = load_vector_db(db_path, embeddings)
+            # id из манифеста плюс все чанки с тем же source: так вычищаются и книги старого формата журнала
+            stale_ids = {chunk_id for key in stale_keys for chunk_id in (manifest.get(key, {}).get("chunk_ids") or [])}
+            for ids in chunk_ids_by_source([vector_db], stale_keys).values():
+                stale_ids.update(ids)
+            removed = remove_vectors(vector_db, stale_ids)
+            logger.info(f"Удалено устаревших чанков: {removed} (книг: {len(stale_keys)})")
+            if documents:
+                texts = [doc.page_content for doc in documents]
+                with EmbeddingCache(embedding_model_id()) as cache:
+                    vectors = CachedEmbeddings(embeddings, cache).embed_documents(texts)
+                logger.info(cache.report())
+                add_vectors(vector_db, texts, vectors, [doc.metadata for doc in documents], chunk_ids)
+                logger.info(f"Добавлено чанков: {len(documents)}")
+            if tombstone_fraction(vector_db) > MAX_TOMBSTONE_FRACTION:
+                # Граф перестраивается из векторов индекса, книги заново не эмбеддируются
+                drop_tombstones(vector_db, index_config)
+            save_vector_db(vector_db, db_path)
+        return True
+    except Exception as e:
+        logger.critical(f"Критическая ошибка при обновлении базы '{db_name}': {e}", exc_info=True)
+        return False
+
+def compact_db(db_name: str) -> bool:
+    """Компакция по запросу: сливает все дельты базы с основным индексом."""
+    db_path = os.path.join(BASE_DB_DIR, db_name)
+    embeddings = init_embeddings()
+    if embeddings is None:
+        return False
+    try:
+        with writer_lock(db_path):
+            moved = compact(db_path, embeddings)
+        logger.info(f"✅ Компакция базы '{db_name}' завершена, перенесено векторов: {moved}.")
+        return True
+    except Exception as e:
+        logger.critical(f"Критическая ошибка при компакции базы '{db_name}': {e}", exc_info=True)
+        return False
 
-    markdown_files = [f for f in os.listdir(LORE_BOOKS_DIR) if f.endswith(".md") and os.path.isfile(os.path.join(LORE_BOOKS_DIR, f))]
+def parse_args():
+    parser = argparse.ArgumentParser(description="Добавление, обновление и удаление книг (Markdown-файлов) в векторной базе")
+    parser.add_argument("paths", nargs="*",
+                        help=f"Файлы и директории с книгами (по умолчанию: {LORE_BOOKS_DIR})")
+    parser.add_argument("--db", help="Имя базы; если не указано, будет запрошено")
+    parser.add_argument("--delete", nargs="+", default=[], metavar="ПУТЬ",
+                        help="Удалить из базы книги по путям к файлам (в манифесте старого формата - по именам файлов)")
+    parser.add_argument("--compact", action="store_true",
+                        help="Слить дельты с основным индексом (без путей - только компакция)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    logger.info("=== Начало процесса добавления книг в векторную базу ===")
+    # Без путей, но с --compact или --delete, книги с диска не читаются
+    no_books = not args.paths and (args.compact or args.delete)
+    paths = args.paths or [LORE_BOOKS_DIR]
     
-    if not markdown_files:
-        logger.error(f"В директории '{LORE_BOOKS_DIR}' не найдено Markdown-файлов (.md).")
-        logger.error("Пожалуйста, поместите ровно один Markdown-файл, который вы хотите добавить.")
+    # --- Шаг 1: Поиск книг для добавления ---
+    markdown_files = [] if no_books else collect_books(paths)
+    if not no_books and not markdown_files:
+        logger.error(f"Не найдено Markdown-файлов (.md) в: {', '.join(paths)}")
+        logger.error("Пожалуйста, укажите файлы или директории с книгами, которые вы хотите добавить.")
         sys.exit(1)
-    elif len(markdown_files) > 1:
-        logger.error(f"В директории '{LORE_BOOKS_DIR}' найдено более одного Markdown-файла:")
-        for f in markdown_files:
-            logger.error(f"- {f}")
-        logger.error("Пожалуйста, оставьте ровно один Markdown-файл, который вы хотите добавить, и уберите остальные.")
-        sys.exit(1)
-    
-    file_to_add_name = markdown_files[0]
-    file_to_add_path = os.path.join(LORE_BOOKS_DIR, file_to_add_name)
-    logger.info(f"Обнаружен файл для добавления: '{file_to_add_name}'")
+    for path in markdown_files:
+        logger.info(f"Обнаружен файл для добавления: '{path}'")
 
     # --- Шаг 2: Показать список существующих баз и запросить имя базы ---
     existing_dbs = list_existing_dbs()
-    if existing_dbs:
-        logger.info("\nДоступные векторные базы данных:")
-        for db in existing_dbs:
-            logger.info(f"- {db}")
-    else:
-        logger.info("\nВекторные базы данных пока не найдены. Вы можете создать новую.")
-
-    db_name = input("\nВведите имя векторной базы данных (существующей или новой), в которую вы хотите добавить книгу: ").strip()
+    db_name = (args.db or "").strip()
+    if not db_name:
+        if existing_dbs:
+            logger.info("\nДоступные векторные базы данных:")
+            for db in existing_dbs:
+                logger.info(f"- {db}")
+        else:
+            logger.info("\nВекторные базы данных пока не найдены. Вы можете создать новую.")
+        db_name = input("\nВведите имя векторной базы данных (существующей или новой), в которую вы хотите добавить книги: ").strip()
     if not db_name:
         logger.error("Имя базы данных не может быть пустым. Завершение.")
         sys.exit(1)
-
-    # --- Шаг 3: Загрузка документа для добавления/создания ---
-    document_to_add = load_single_document(file_to_add_path)
-    if not document_to_add:
-        logger.error("Не удалось загрузить документ для добавления. Завершение.")
+    if no_books and db_name not in existing_dbs:
+        logger.error(f"База данных '{db_name}' не найдена. Завершение.")
         sys.exit(1)
 
     db_path = os.path.join(BASE_DB_DIR, db_name)
-    lorebooks_json_path = get_added_lorebooks_path(db_path)
     
-    success = False
-    if db_name in existing_dbs:
-        # База существует, добавляем в нее
-        logger.info(f"База данных '{db_name}' найдена. Попытка добавить документ.")
-        
-        # Проверка на дубликат в журнале
-        added_files = load_added_lorebooks(lorebooks_json_path)
-        if file_to_add_name in added_files:
-            logger.warning(f"Файл '{file_to_add_name}' уже присутствует в журнале для базы '{db_name}'. Пропускаю добавление.")
-            logger.warning("Если вы хотите обновить файл, удалите его из директории lore_books, затем добавьте измененную версию. Это добавит новую версию.")
-            sys.exit(0) # Успешное завершение, так как файл уже "добавлен"
-
-        logger.info(f"Загрузка существующей векторной базы данных '{db_name}' из: {db_path}")
-        try:
-            embeddings = SentenceTransformerEmbeddings(model_name=EMBEDDING_MODEL_PATH)
-            vector_db = FAISS.load_local(db_path, embeddings, allow_dangerous_deserialization=True)
-            logger.info(f"Векторная база '{db_name}' успешно загружена.")
-            
-            logger.info(f"Добавление документа '{file_to_add_name}' в базу '{db_name}'...")
-            vector_db.add_documents(document_to_add)
-            vector_db.save_local(db_path)
-            logger.info(f"Документ '{file_to_add_name}' успешно добавлен в базу '{db_name}'.")
-            
-            added_files.append(file_to_add_name)
-            save_added_lorebooks(lorebooks_json_path, added_files)
-            success = True
-        except Exception as e:
-            logger.critical(f"Критическая ошибка при добавлении документа в существующую базу '{db_name}': {e}", exc_info=True)
-            logger.error("Убедитесь, что `faiss-gpu` или `faiss-cpu` установлен и совместим.")
-            success = False
-    else:
-        # База не существует, создаем новую
-        logger.info(f"База данных '{db_name}' не найдена. Создаю новую базу данных.")
-        if create_new_vector_db_from_documents(db_name, document_to_add):
-            # Если новая база успешно создана, добавляем запись в ее журнал
-            added_files = [file_to_add_name]
-            save_added_lorebooks(lorebooks_json_path, added_files)
-            success = True
+    # --- Шаг 3: Сверка книг с манифестом: новые, измененные, без изменений ---
+    manifest = load_manifest(db_path) if db_name in existing_dbs else {}
+    new_files, changed_files, changed_keys = [], [], []
+    for path in markdown_files:
+        key, name = book_key(path), os.path.basename(path)
+        entry = manifest.get(key)
+        if entry is None and name in manifest:
+            # Манифест старого формата: книга записана под именем файла и переиндексируется под своим путем
+            logger.info(f"Книга '{name}' записана в манифесте по имени файла: старые чанки будут заменены новыми.")
+            changed_keys.append(name)
+            changed_files.append(path)
+        elif entry is None:
+            new_files.append(path)
+        elif entry.get("hash") == file_hash(path):
+            logger.info(f"Книга '{name}' не изменилась с прошлого добавления. Пропускаю.")
         else:
+            logger.info(f"Книга '{name}' изменилась: старые чанки будут заменены новыми.")
+            changed_keys.append(key)
+            changed_files.append(path)
+    # Удаляемая книга - по пути к файлу (файла на диске может уже не быть) или по ключу старого манифеста
+    deleted_keys = [key for key in dict.fromkeys(name if name in manifest else book_key(name) for name in args.delete)
+                    if key not in changed_keys]
+    for key in deleted_keys:
+        if key not in manifest:
+            logger.warning(f"Книги '{key}' нет в манифесте базы '{db_name}'; будут удалены чанки с этим источником, если они есть.")
+    if not new_files and not changed_files and not deleted_keys:
+        if args.compact:
+            sys.exit(0 if compact_db(db_name) else 1)
+        logger.info("Новых или измененных книг нет.")
+        sys.exit(0) # Успешное завершение, так как все файлы уже "добавлены"
+
+    # --- Шаг 4: Загрузка и разбиение книг на чанки ---
+    stale_keys = list(dict.fromkeys(changed_keys + deleted_keys))
+    documents, chunk_ids, entries = load_and_split_books(new_files + changed_files)
+    if not documents and not stale_keys:
+        logger.error("Не удалось загрузить документы для добавления. Завершение.")
+        sys.exit(1)
+
+    if db_name not in existing_dbs:
+        logger.info(f"База данных '{db_name}' не найдена. Создаю новую базу данных.")
+        success = create_new_vector_db_from_documents(db_name, documents, chunk_ids)
+        if not success:
             logger.error(f"Не удалось создать новую базу данных '{db_name}'.")
-            success = False
+    elif stale_keys:
+        logger.info(f"База данных '{db_name}' найдена. Новых книг: {len(new_files)}, "
+                    f"измененных: {len(changed_files)}, удаляемых: {len(deleted_keys)}.")
+        success = update_existing_db(db_name, manifest, stale_keys, documents, chunk_ids)
+    else:
+        logger.info(f"База данных '{db_name}' найдена. Добавляю книги: {len(entries)}.")
+        success = add_to_existing_db(db_name, documents, chunk_ids, args.compact)
 
     if success:
+        # Манифест обновляется только после того, как изменения попали в базу
+        for key in stale_keys:
+            manifest.pop(key, None)
+        manifest.update(entries)
+        save_manifest(db_path, manifest)
         logger.info("\n=== Результат ===")
-        logger.info(f"✅ Процесс добавления/создания книги в базу '{db_name}' завершен успешно.")
+        logger.info(f"✅ Книг добавлено/обновлено: {len(entries)}, удалено: {len(deleted_keys)} (база '{db_name}').")
     else:
-        logger.error("\n❌ Процесс добавления/создания книги в векторную базу завершен с ошибкой.")
+        logger.error("\n❌ Процесс изменения книг в векторной базе завершен с ошибкой.")
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+# ann_index.py - Выбор типа индекса FAISS (flat / IVF / HNSW) при построении базы и параметры поиска в каталоге базы
+import os
+import json
+import math
+import pickle
+import shutil
+import logging
+import tempfile
+import threading
+import uuid
+import weakref
+from dataclasses import asdict, dataclass, fields
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from source_index import (HAS_SEARCH_PARAMS, SourceIndex, exact_subset_search, fingerprint, reconstruct_labels,
+                          selector_params)
+
+logger = logging.getLogger(__name__)
+
+INDEX_CONFIG_FILE = "index_config.json"
+INDEX_TYPES = ("flat", "ivf", "hnsw")
+# Меньше точек на центроид FAISS не рекомендует: обучение k-means становится неустойчивым
+MIN_POINTS_PER_CENTROID = 39
+# Чтение index.faiss без копирования в кучу: страницы берутся из page cache и общие для всех процессов.
+# IO_FLAG_MMAP_IFC (FAISS >= 1.9) отображает flat, IVF и HNSW; более старый IO_FLAG_MMAP - только списки IVF
+MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+# Доля «надгробий» HNSW (меток удаленных документов), после которой граф перестраивается из живых векторов.
+# Поиск их не возвращает (селектор внутри FAISS), но обход графа по-прежнему тратит на них время
+MAX_TOMBSTONE_FRACTION = 0.05
+
+
+@dataclass
+class IndexConfig:
+    """Параметры построения (index_type, nlist, hnsw_m, ef_construction) и поиска (nprobe, ef_search)"""
+    index_type: str = "flat"
+    nlist: int = 0  # Число центроидов IVF; 0 - подобрать по размеру корпуса (4 * sqrt(n))
+    nprobe: int = 16  # Сколько кластеров IVF просматривать при поиске
+    hnsw_m: int = 32  # Связей на вершину графа HNSW
+    ef_construction: int = 200
+    ef_search: int = 64  # Ширина поиска по графу HNSW
+
+    def __post_init__(self):
+        if self.index_type not in INDEX_TYPES:
+            raise ValueError(f"Неизвестный тип индекса: {self.index_type} (допустимо: {', '.join(INDEX_TYPES)})")
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "IndexConfig":
+        known = {f.name for f in fields(cls)}
+        return cls(**{key: value for key, value in data.items() if key in known})
+
+    @classmethod
+    def from_env(cls) -> "IndexConfig":
+        """Параметры построения из переменных окружения RAG_INDEX_TYPE, RAG_IVF_NLIST и т.д."""
+        defaults = cls()
+        return cls(
+            index_type=os.environ.get("RAG_INDEX_TYPE", defaults.index_type).lower(),
+            nlist=int(os.environ.get("RAG_IVF_NLIST", defaults.nlist)),
+            nprobe=int(os.environ.get("RAG_IVF_NPROBE", defaults.nprobe)),
+            hnsw_m=int(os.environ.get("RAG_HNSW_M", defaults.hnsw_m)),
+            ef_construction=int(os.environ.get("RAG_HNSW_EF_CONSTRUCTION", defaults.ef_construction)),
+            ef_search=int(os.environ.get("RAG_HNSW_EF_SEARCH", defaults.ef_search)),
+        )
+
+    @property
+    def supports_removal(self) -> bool:
+        # Граф HNSW в FAISS не поддерживает remove_ids: удаленные документы остаются в нем надгробиями
+        return self.index_type != "hnsw"
+
+    def describe(self) -> str:
+        if self.index_type == "ivf":
+            return f"IVF (nlist={self.nlist}, nprobe={self.nprobe})"
+        if self.index_type == "hnsw":
+            return f"HNSW (M={self.hnsw_m}, efConstruction={self.ef_construction}, efSearch={self.ef_search})"
+        return "Flat (точный поиск)"
+
+
+def load_index_config(db_path: str) -> IndexConfig:
+    """Параметры индекса базы; базы без index_config.json построены как flat"""
+    path = os.path.join(db_path, INDEX_CONFIG_FILE)
+    if not os.path.exists(path):
+        return IndexConfig()
+    with open(path, "r", encoding="utf-8") as f:
+        return IndexConfig.from_dict(json.load(f))
+
+
+def save_index_config(db_path: str, config: IndexConfig):
+    os.makedirs(db_path, exist_ok=True)
+    path = os.path.join(db_path, INDEX_CONFIG_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(asdict(config), f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+
+def create_index(config: IndexConfig, dim: int, n: int) -> Tuple[faiss.Index, IndexConfig]:
+    """Пустой индекс выбранного типа; возвращает его и фактические параметры построения.
+
+    Flat оборачивается в IndexIDMap2, а IVF хранит метки сам: удаление векторов
+    не сдвигает метки остальных, и index_to_docstore_id остается верным.
+    """
+    if config.index_type == "ivf":
+        nlist = config.nlist or int(4 * math.sqrt(n))
+        nlist = min(nlist, n // MIN_POINTS_PER_CENTROID)
+        if nlist < 2:
+            logger.warning(f"Слишком мало векторов ({n}) для обучения IVF, используется flat-индекс.")
+            return faiss.IndexIDMap2(faiss.IndexFlatL2(dim)), IndexConfig(index_type="flat")
+        effective = IndexConfig.from_dict(dict(asdict(config), nlist=nlist, nprobe=min(config.nprobe, nlist)))
+        return faiss.IndexIVFFlat(faiss.IndexFlatL2(dim), dim, nlist, faiss.METRIC_L2), effective
+    if config.index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, config.hnsw_m)
+        index.hnsw.efConstruction = config.ef_construction
+        return index, config
+    return faiss.IndexIDMap2(faiss.IndexFlatL2(dim)), config
+
+
+def apply_search_params(index: faiss.Index, config: IndexConfig):
+    """Параметры поиска не хранятся в index.faiss, их нужно выставлять после каждой загрузки"""
+    if config.index_type == "ivf":
+        faiss.extract_index_ivf(index).nprobe = config.nprobe
+    elif config.index_type == "hnsw":
+        index.hnsw.efSearch = config.ef_search
+
+
+def build_vector_db(documents: Sequence, embeddings, config: IndexConfig,
+                    ids: Optional[List[str]] = None) -> Tuple[FAISS, IndexConfig]:
+    """Аналог FAISS.from_documents с индексом заданного типа (IVF обучается на векторах корпуса)"""
+    if not documents:
+        raise ValueError("Нет документов для построения индекса")
+    vectors = embeddings.embed_documents([doc.page_content for doc in documents])
+    return build_vector_db_from_vectors(documents, vectors, embeddings, config, ids)
+
+
+def build_vector_db_from_vectors(documents: Sequence, vectors, embeddings, config: IndexConfig,
+                                 ids: Optional[List[str]] = None) -> Tuple[FAISS, IndexConfig]:
+    """Индекс из уже посчитанных векторов (например, собранных из шардов параллельной сборки)"""
+    texts = [doc.page_content for doc in documents]
+    metadatas = [doc.metadata for doc in documents]
+    vectors = np.asarray(vectors, dtype=np.float32)
+
+    index, effective = create_index(config, vectors.shape[1], vectors.shape[0])
+    if not index.is_trained:
+        logger.info(f"Обучение индекса {effective.describe()} на {len(vectors)} векторах...")
+        index.train(vectors)
+    apply_search_params(index, effective)
+
+    vector_db = FAISS(embedding_function=embeddings, index=index,
+                      docstore=InMemoryDocstore(), index_to_docstore_id={})
+    add_vectors(vector_db, texts, vectors, metadatas, ids)
+    logger.info(f"Построен индекс {effective.describe()}, векторов: {index.ntotal}")
+    return vector_db, effective
+
+
+def is_id_mapped(index: faiss.Index) -> bool:
+    """Индекс хранит явные метки векторов (IndexIDMap2 или IVF) и умеет удалять по ним"""
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return True
+    try:
+        faiss.extract_index_ivf(index)
+        return True
+    except RuntimeError:
+        return False
+
+
+def to_id_mapped(index: faiss.Index) -> faiss.Index:
+    """Flat-индекс старых баз (метка = позиция) -> IndexIDMap2 с теми же метками"""
+    mapped = faiss.IndexIDMap2(faiss.IndexFlatL2(index.d))
+    if index.ntotal:
+        mapped.add_with_ids(index.reconstruct_n(0, index.ntotal), np.arange(index.ntotal, dtype=np.int64))
+    return mapped
+
+
+def next_label(vector_db: FAISS) -> int:
+    return max(max(vector_db.index_to_docstore_id, default=-1) + 1, vector_db.index.ntotal)
+
+
+def add_vectors(vector_db: FAISS, texts: Sequence[str], vectors, metadatas: Optional[Sequence[dict]] = None,
+                ids: Optional[Sequence[str]] = None) -> List[str]:
+    """Аналог FAISS.add_embeddings с явными метками (IndexIDMap2 не принимает add без меток).
+
+    Новые метки идут после наибольшей существующей, поэтому не совпадают с
+    метками удаленных векторов. Возвращает docstore id добавленных документов.
+    """
+    if not texts:
+        return []
+    vectors = np.asarray(vectors, dtype=np.float32)
+    ids = list(ids) if ids is not None else [str(uuid.uuid4()) for _ in texts]
+    metadatas = metadatas if metadatas is not None else [{} for _ in texts]
+    start = next_label(vector_db)
+    labels = np.arange(start, start + len(texts), dtype=np.int64)
+    if is_id_mapped(vector_db.index):
+        vector_db.index.add_with_ids(vectors, labels)
+    else:
+        vector_db.index.add(vectors)  # HNSW и flat старых баз: метка = позиция, start == ntotal
+    vector_db.docstore.add({doc_id: Document(page_content=text, metadata=metadata)
+                            for doc_id, text, metadata in zip(ids, texts, metadatas)})
+    vector_db.index_to_docstore_id.update(zip(labels.tolist(), ids))
+    return ids
+
+
+def remove_vectors(vector_db: FAISS, doc_ids: Iterable[str]) -> int:
+    """Удаляет документы по docstore id из индекса, index_to_docstore_id и docstore без пересборки.
+
+    Flat и IVF удаляют векторы по меткам. Граф HNSW удаления не поддерживает:
+    вектор остается в нем надгробием без документа и пропускается при поиске.
+    Возвращает число удаленных документов.
+    """
+    doc_ids = set(doc_ids)
+    labels = [label for label, doc_id in vector_db.index_to_docstore_id.items() if doc_id in doc_ids]
+    if not labels:
+        return 0
+    if not is_id_mapped(vector_db.index) and not hasattr(vector_db.index, "hnsw"):
+        vector_db.index = to_id_mapped(vector_db.index)
+    if is_id_mapped(vector_db.index):
+        vector_db.index.remove_ids(np.asarray(labels, dtype=np.int64))
+    removed = [vector_db.index_to_docstore_id.pop(label) for label in labels]
+    vector_db.docstore.delete(removed)
+    return len(removed)
+
+
+def tombstone_fraction(vector_db: FAISS) -> float:
+    """Доля векторов индекса, у которых больше нет документа (только HNSW после удалений)"""
+    ntotal = vector_db.index.ntotal
+    return (ntotal - len(vector_db.index_to_docstore_id)) / ntotal if ntotal else 0.0
+
+
+def live_labels(vector_db: FAISS) -> np.ndarray:
+    mapping = vector_db.index_to_docstore_id
+    return np.sort(np.fromiter(mapping, dtype=np.int64, count=len(mapping)))
+
+
+def tombstone_labels(vector_db: FAISS) -> np.ndarray:
+    """Метки надгробий: позиции графа HNSW, у которых больше нет документа"""
+    ntotal = vector_db.index.ntotal
+    if len(vector_db.index_to_docstore_id) >= ntotal:
+        return np.empty(0, dtype=np.int64)
+    return np.setdiff1d(np.arange(ntotal, dtype=np.int64), live_labels(vector_db), assume_unique=True)
+
+
+# База -> (отпечаток, фильтр надгробий): фильтр строится один раз на состояние базы, а не на каждый поиск
+_tombstone_filters: "weakref.WeakKeyDictionary[FAISS, tuple]" = weakref.WeakKeyDictionary()
+_tombstone_filters_lock = threading.Lock()
+
+
+def _tombstone_filter(vector_db: FAISS) -> Optional[tuple]:
+    """(надгробия, живые метки, параметры поиска с селектором, ссылки на селекторы) или None без надгробий"""
+    key = fingerprint(vector_db)
+    with _tombstone_filters_lock:
+        cached = _tombstone_filters.get(vector_db)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    tombstones = tombstone_labels(vector_db)
+    state = None
+    if len(tombstones):
+        live = live_labels(vector_db)
+        params, selectors = None, ()
+        if HAS_SEARCH_PARAMS:
+            # Надгробий обычно меньше, чем живых меток: селектор «не из множества надгробий»
+            if hasattr(faiss, "IDSelectorNot"):
+                excluded = faiss.IDSelectorBatch(tombstones)
+                selectors = (excluded, faiss.IDSelectorNot(excluded))
+            else:
+                selectors = (faiss.IDSelectorBatch(live),)
+            params = selector_params(vector_db.index, selectors[-1])
+        # Селекторы держатся ссылками: параметры поиска FAISS их не владеют
+        state = (tombstones, live, params, selectors)
+    with _tombstone_filters_lock:
+        _tombstone_filters[vector_db] = (key, state)
+    return state
+
+
+def search_live(vector_db: FAISS, vectors: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """index.search, не возвращающий надгробий HNSW: удаленные метки исключаются селектором внутри FAISS,
+    поэтому запрашивается ровно k соседей. Пустые места в выдаче - метка -1.
+
+    На FAISS без SearchParameters (1.7.2) надгробия вычеркиваются из выдачи, а недобравшие
+    k запросы дорешиваются точным перебором живых меток, как в source_index.filtered_search.
+    """
+    index = vector_db.index
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    state = _tombstone_filter(vector_db)
+    if state is None:
+        return index.search(vectors, k)
+    tombstones, live, params, _ = state
+    if params is not None:
+        return index.search(vectors, k, params=params)
+    distances, labels = index.search(vectors, k)
+    dead = np.isin(labels, tombstones)
+    labels[dead], distances[dead] = -1, np.inf
+    short = np.flatnonzero((labels >= 0).sum(axis=1) < min(k, len(live)))
+    if len(short):
+        distances[short], labels[short] = exact_subset_search(index, vectors[short], k, live)
+    return distances, labels
+
+
+def drop_tombstones(vector_db: FAISS, config: IndexConfig, block_size: int = 50000) -> int:
+    """Перестраивает граф HNSW только из живых векторов; метки становятся 0..n-1 в прежнем порядке.
+
+    Векторы берутся из индекса, документы не переэмбеддируются. Возвращает число убранных надгробий.
+    """
+    tombstones = tombstone_labels(vector_db)
+    if not len(tombstones):
+        return 0
+    live = live_labels(vector_db)
+    index, _ = create_index(config, vector_db.index.d, len(live))
+    for start in range(0, len(live), block_size):
+        index.add(reconstruct_labels(vector_db.index, live[start:start + block_size]))
+    apply_search_params(index, config)
+    mapping = vector_db.index_to_docstore_id
+    vector_db.index_to_docstore_id = {position: mapping[int(label)] for position, label in enumerate(live)}
+    vector_db.index = index
+    logger.info(f"Граф {config.describe()} перестроен без надгробий: убрано {len(tombstones)}, векторов {len(live)}")
+    return len(tombstones)
+
+
+def save_vector_db(vector_db: FAISS, db_path: str, config: Optional[IndexConfig] = None):
+    """Сохранение через временный каталог и os.replace, вместе с индексом источников (SourceIndex).
+
+    Процессы, отобразившие старый index.faiss в память, продолжают читать прежний
+    файл (его inode живет, пока открыт), а не обрезанный на середине записи.
+    """
+    os.makedirs(db_path, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".save-", dir=db_path)
+    try:
+        vector_db.save_local(tmp_dir)
+        for name in ("index.pkl", "index.faiss"):
+            os.replace(os.path.join(tmp_dir, name), os.path.join(db_path, name))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    SourceIndex.build(vector_db).save(db_path)
+    if config is not None:
+        save_index_config(db_path, config)
+
+
+def read_index(db_path: str, mmap: bool = False) -> faiss.Index:
+    path = os.path.join(db_path, "index.faiss")
+    return faiss.read_index(path, MMAP_FLAGS) if mmap else faiss.read_index(path)
+
+
+def load_vector_db(db_path: str, embeddings, mmap: bool = False) -> Tuple[FAISS, IndexConfig]:
+    """FAISS.load_local + параметры поиска из index_config.json.
+
+    mmap=True отображает index.faiss в память только для чтения: загрузка не зависит
+    от размера индекса, а несколько серверов или воркеров делят одни страницы.
+    Такую базу нельзя изменять (add_documents / delete).
+    """
+    if mmap:
+        index = read_index(db_path, mmap=True)
+        with open(os.path.join(db_path, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        vector_db = FAISS(embedding_function=embeddings, index=index,
+                          docstore=docstore, index_to_docstore_id=index_to_docstore_id)
+    else:
+        vector_db = FAISS.load_local(db_path, embeddings, allow_dangerous_deserialization=True)
+    config = load_index_config(db_path)
+    apply_search_params(vector_db.index, config)
+    return vector_db, config
+
+
+def reconstruct_all(index: faiss.Index) -> Tuple[np.ndarray, np.ndarray]:
+    """Метки и векторы всех записей индекса (включая надгробия HNSW), в порядке хранения"""
+    if index.ntotal == 0:
+        return np.empty(0, dtype=np.int64), np.empty((0, index.d), dtype=np.float32)
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        # Порядок id_map совпадает с порядком векторов во вложенном индексе
+        inner = faiss.downcast_index(index.index)
+        return faiss.vector_to_array(index.id_map).astype(np.int64), inner.reconstruct_n(0, index.ntotal)
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        ivf = None
+    if ivf is not None:
+        # Метки IVF после удалений идут с пропусками: векторы читаются прямо из списков IVFFlat
+        invlists = ivf.invlists
+        labels, vectors = [], []
+        for list_no in range(ivf.nlist):
+            size = invlists.list_size(list_no)
+            if not size:
+                continue
+            labels.append(faiss.rev_swig_ptr(invlists.get_ids(list_no), size).copy())
+            codes = faiss.rev_swig_ptr(invlists.get_codes(list_no), size * invlists.code_size)
+            vectors.append(np.frombuffer(codes.tobytes(), dtype=np.float32).reshape(size, ivf.d))
+        return np.concatenate(labels).astype(np.int64), np.vstack(vectors)
+    return np.arange(index.ntotal, dtype=np.int64), index.reconstruct_n(0, index.ntotal)
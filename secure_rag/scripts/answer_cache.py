@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# answer_cache.py - Семантический кэш ответов LLM: перефразированный вопрос с теми же источниками получает готовый ответ
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+ANSWERS_FILE = "answers.json"
+EMBEDDINGS_FILE = "embeddings.npy"
+
+
+def _normalize(vector: Sequence[float]) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm > 0 else vector
+
+
+def source_key(sources: Sequence[str]) -> List[str]:
+    """Набор источников выдачи без учета порядка и повторов"""
+    return sorted(set(sources))
+
+
+class SemanticAnswerCache:
+    """LRU-кэш ответов, ключ - эмбеддинг вопроса.
+
+    Попадание: косинусная близость к сохраненному вопросу не ниже threshold,
+    тот же набор источников выдачи и та же версия индекса. При смене версии
+    индекса кэш очищается. Состояние сохраняется в cache_dir (answers.json +
+    embeddings.npy) и загружается при старте.
+    """
+
+    def __init__(self, cache_dir: str, max_entries: int = 1000, threshold: float = 0.95,
+                 autosave_every: int = 10):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.autosave_every = autosave_every
+        self.index_version: Optional[str] = None
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()  # id -> запись (без эмбеддинга)
+        self._vectors: Dict[str, np.ndarray] = {}
+        self._matrix: Optional[np.ndarray] = None  # Эмбеддинги в порядке _entries; пересобирается лениво
+        self._matrix_ids: List[str] = []
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._unsaved = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.load()
+
+    # --- Поиск и запись ---
+
+    def lookup(self, embedding: Sequence[float], sources: Sequence[str],
+               index_version: Optional[str]) -> Optional[dict]:
+        """Возвращает запись {query, answer, similarity, ...} или None"""
+        vector = _normalize(embedding)
+        wanted = source_key(sources)
+        with self._lock:
+            self._sync_version(index_version)
+            if not self._entries:
+                self.misses += 1
+                return None
+            matrix, ids = self._similarity_matrix()
+            if matrix.shape[1] != vector.shape[0]:
+                self.misses += 1
+                return None
+            similarities = matrix @ vector
+            # Кандидаты по убыванию близости; первый с совпадающими источниками - попадание
+            for pos in np.argsort(-similarities):
+                similarity = float(similarities[pos])
+                if similarity < self.threshold:
+                    break
+                entry = self._entries[ids[pos]]
+                if entry["sources"] == wanted:
+                    self._entries.move_to_end(ids[pos])
+                    entry["hits"] += 1
+                    self.hits += 1
+                    return dict(entry, similarity=similarity)
+            self.misses += 1
+            return None
+
+    def store(self, query: str, embedding: Sequence[float], sources: Sequence[str],
+              index_version: Optional[str], answer: str):
+        vector = _normalize(embedding)
+        with self._lock:
+            self._sync_version(index_version)
+            entry_id = str(self._next_id)
+            self._next_id += 1
+            self._entries[entry_id] = {
+                "query": query, "answer": answer, "sources": source_key(sources),
+                "created": time.time(), "hits": 0,
+            }
+            self._vectors[entry_id] = vector
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                del self._vectors[evicted]
+            self._matrix = None
+            self._unsaved += 1
+            autosave = self._unsaved >= self.autosave_every
+        if autosave:
+            self.save()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._vectors.clear()
+            self._matrix = None
+            self._unsaved += 1
+
+    def _sync_version(self, index_version: Optional[str]):
+        # Вызывается под блокировкой: новая версия индекса делает все ответы недействительными
+        if index_version is None or index_version == self.index_version:
+            return
+        if self.index_version is not None and self._entries:
+            self.invalidations += 1
+            self._entries.clear()
+            self._vectors.clear()
+            self._matrix = None
+            self._unsaved += 1
+        self.index_version = index_version
+
+    def _similarity_matrix(self):
+        if self._matrix is None or len(self._matrix_ids) != len(self._entries):
+            self._matrix_ids = list(self._entries.keys())
+            self._matrix = np.stack([self._vectors[i] for i in self._matrix_ids])
+        return self._matrix, self._matrix_ids
+
+    # --- Сохранение на диск ---
+
+    def load(self):
+        answers_path = os.path.join(self.cache_dir, ANSWERS_FILE)
+        vectors_path = os.path.join(self.cache_dir, EMBEDDINGS_FILE)
+        if not (os.path.exists(answers_path) and os.path.exists(vectors_path)):
+            return
+        try:
+            with open(answers_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            vectors = np.load(vectors_path)
+            if len(state["entries"]) != len(vectors):
+                raise ValueError("число ответов не совпадает с числом эмбеддингов")
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️ Кэш ответов поврежден и будет создан заново: {e}")
+            return
+        with self._lock:
+            self.index_version = state.get("index_version")
+            self._entries.clear()
+            self._vectors.clear()
+            # Записи сохранены от самой старой к самой свежей - порядок LRU восстанавливается как есть
+            for (entry_id, entry), vector in zip(state["entries"], vectors):
+                self._entries[entry_id] = entry
+                self._vectors[entry_id] = vector.astype(np.float32)
+            self._next_id = state.get("next_id", len(self._entries))
+            self._matrix = None
+            self._unsaved = 0
+
+    def save(self):
+        """Атомарная запись: сначала во временные файлы, затем замена"""
+        with self._lock:
+            if not self._unsaved:
+                return
+            items = list(self._entries.items())
+            vectors = [self._vectors[entry_id] for entry_id, _ in items]
+            state = {"index_version": self.index_version, "next_id": self._next_id, "entries": items}
+            self._unsaved = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        answers_path = os.path.join(self.cache_dir, ANSWERS_FILE)
+        vectors_path = os.path.join(self.cache_dir, EMBEDDINGS_FILE)
+        matrix = np.stack(vectors) if vectors else np.empty((0, 0), dtype=np.float32)
+        with open(vectors_path + ".tmp", "wb") as f:
+            np.save(f, matrix)
+        with open(answers_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(vectors_path + ".tmp", vectors_path)
+        os.replace(answers_path + ".tmp", answers_path)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "index_version": self.index_version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# context_packer.py - Сборка контекста для промпта: слияние перекрывающихся чанков, отсев по релевантности, бюджет токенов
+import re
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, List, Optional, Sequence
+
+# Минимальная длина совпадения конца одного чанка с началом другого, чтобы считать их перекрывающимися
+MIN_OVERLAP_CHARS = 20
+# Порог сходства (Жаккар по словесным шинглам), выше которого чанки считаются почти одинаковыми
+NEAR_DUPLICATE_JACCARD = 0.9
+SHINGLE_SIZE = 3
+
+_WORDS = re.compile(r"\w+", re.UNICODE)
+
+
+@dataclass
+class Segment:
+    """Фрагмент контекста: один чанк или несколько слитых чанков одного источника"""
+    source: str
+    content: str
+    score: Optional[float]
+    rank: int  # Позиция лучшего из вошедших чанков в исходной выдаче
+    chunks: int = 1
+
+    def as_doc(self) -> dict:
+        return {"source": self.source, "content": self.content, "score": self.score}
+
+
+@dataclass
+class PackResult:
+    segments: List[Segment]
+    prompt_tokens: int  # Токенов контекста после упаковки
+    original_tokens: int  # Токенов, если вставить все чанки как есть
+    dropped_low_score: int = 0
+    dropped_budget: int = 0
+    merged: int = 0
+    duplicates: int = 0
+    token_counts: List[int] = field(default_factory=list)
+
+    @property
+    def saved_tokens(self) -> int:
+        return max(self.original_tokens - self.prompt_tokens, 0)
+
+    def docs(self) -> List[dict]:
+        return [segment.as_doc() for segment in self.segments]
+
+    def summary(self) -> str:
+        return (f"контекст {self.prompt_tokens} токенов вместо {self.original_tokens} "
+                f"(сэкономлено {self.saved_tokens}); фрагментов {len(self.segments)}, "
+                f"слито {self.merged}, дубликатов {self.duplicates}, "
+                f"ниже порога {self.dropped_low_score}, не влезло в бюджет {self.dropped_budget}")
+
+
+def _shingles(text: str) -> set:
+    words = _WORDS.findall(text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def _overlap(left: str, right: str) -> int:
+    """Длина наибольшего суффикса left, совпадающего с префиксом right"""
+    for size in range(min(len(left), len(right)), MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def _try_merge(a: str, b: str) -> Optional[str]:
+    """Сливает два текста одного источника, если один содержит другой или они перекрываются"""
+    if b in a:
+        return a
+    if a in b:
+        return b
+    size = _overlap(a, b)
+    if size:
+        return a + b[size:]
+    size = _overlap(b, a)
+    if size:
+        return b + a[size:]
+    return None
+
+
+def plan_segments(docs: Sequence[dict], min_score: Optional[float] = None):
+    """Отсев по релевантности, слияние перекрывающихся чанков и удаление почти-дубликатов.
+
+    docs - выдача RAG API в порядке убывания релевантности (поля content, source, score).
+    Возвращает (сегменты в порядке ранга, отсеяно по порогу, слито, дубликатов).
+    """
+    dropped = merged = duplicates = 0
+    segments: List[Segment] = []
+    for rank, doc in enumerate(docs):
+        score = doc.get("score")
+        if min_score is not None and score is not None and score < min_score:
+            dropped += 1
+            continue
+        content = doc.get("content", "").strip()
+        if not content:
+            continue
+        source = doc.get("source", "Неизвестно")
+
+        absorbed = False
+        for segment in segments:
+            if segment.source != source:
+                continue
+            combined = _try_merge(segment.content, content)
+            if combined is not None:
+                if combined == segment.content:
+                    duplicates += 1
+                else:
+                    merged += 1
+                segment.content = combined
+                segment.chunks += 1
+                absorbed = True
+                break
+        if not absorbed:
+            shingles = _shingles(content)
+            for segment in segments:
+                other = _shingles(segment.content)
+                union = len(shingles | other)
+                if union and len(shingles & other) / union >= NEAR_DUPLICATE_JACCARD:
+                    duplicates += 1
+                    absorbed = True
+                    break
+        if not absorbed:
+            segments.append(Segment(source=source, content=content, score=score, rank=rank))
+    return segments, dropped, merged, duplicates
+
+
+def select_segments(segments: List[Segment], segment_tokens: Sequence[int], original_tokens: int,
+                    budget: int, dropped: int, merged: int, duplicates: int) -> PackResult:
+    """Жадно заполняет бюджет токенов сегментами в порядке релевантности"""
+    selected, counts, used, over_budget = [], [], 0, 0
+    for segment, tokens in zip(segments, segment_tokens):
+        if used + tokens > budget:
+            over_budget += 1
+            continue
+        selected.append(segment)
+        counts.append(tokens)
+        used += tokens
+    return PackResult(segments=selected, prompt_tokens=used, original_tokens=original_tokens,
+                      dropped_low_score=dropped, dropped_budget=over_budget, merged=merged,
+                      duplicates=duplicates, token_counts=counts)
+
+
+def _texts_to_count(docs: Sequence[dict], segments: List[Segment]) -> List[str]:
+    # Одинаковые тексты (неслитые чанки) отправляются токенизатору один раз
+    return list(dict.fromkeys([doc.get("content", "") for doc in docs] + [s.content for s in segments]))
+
+
+def _finish(docs, segments, texts, counts, budget, dropped, merged, duplicates) -> PackResult:
+    by_text = dict(zip(texts, counts))
+    original_tokens = sum(by_text[doc.get("content", "")] for doc in docs)
+    return select_segments(segments, [by_text[s.content] for s in segments], original_tokens,
+                           budget, dropped, merged, duplicates)
+
+
+def pack_context(docs: Sequence[dict], count_tokens: Callable[[List[str]], List[int]],
+                 budget: int, min_score: Optional[float] = None) -> PackResult:
+    """Синхронная упаковка: count_tokens считает токены для списка текстов"""
+    segments, dropped, merged, duplicates = plan_segments(docs, min_score)
+    texts = _texts_to_count(docs, segments)
+    return _finish(docs, segments, texts, count_tokens(texts), budget, dropped, merged, duplicates)
+
+
+async def apack_context(docs: Sequence[dict], count_tokens: Callable[[List[str]], Awaitable[List[int]]],
+                        budget: int, min_score: Optional[float] = None) -> PackResult:
+    """Асинхронный вариант pack_context для веб-приложения"""
+    segments, dropped, merged, duplicates = plan_segments(docs, min_score)
+    texts = _texts_to_count(docs, segments)
+    return _finish(docs, segments, texts, await count_tokens(texts), budget, dropped, merged, duplicates)
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка на случай недоступности токенизатора модели (~3 символа на токен для кириллицы)"""
+    return max(1, len(text) // 3)
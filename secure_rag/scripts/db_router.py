@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# db_router.py - Именованные векторные базы: ленивая загрузка, перезагрузка при изменении на диске, вытеснение LRU по памяти
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from ann_index import INDEX_CONFIG_FILE, IndexConfig, load_index_config
+from delta_segments import SegmentedStore, list_delta_names, load_segments, segments_size
+
+DB_FILES = ("index.faiss", "index.pkl")
+
+
+class UnknownDatabaseError(KeyError):
+    pass
+
+
+def index_signature(path: str) -> tuple:
+    """Отпечаток файлов базы на диске (время изменения и размер)"""
+    signature = []
+    for name in DB_FILES:
+        stat = os.stat(os.path.join(path, name))
+        signature.append((stat.st_mtime_ns, stat.st_size))
+    # Смена параметров поиска (nprobe, efSearch) тоже приводит к перезагрузке
+    config_path = os.path.join(path, INDEX_CONFIG_FILE)
+    if os.path.exists(config_path):
+        stat = os.stat(config_path)
+        signature.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+class LoadedDatabase:
+    """Одно поколение одной базы (основа и дельты); объект не меняется, перезагрузка создает новый"""
+
+    def __init__(self, name: str, path: str, store: SegmentedStore, index_config: IndexConfig,
+                 signature: tuple, delta_names: tuple, generation: int, load_seconds: float):
+        self.name = name
+        self.path = path
+        self.store = store
+        self.index_config = index_config
+        self.signature = signature
+        self.delta_names = delta_names
+        self.generation = generation
+        # Версия по отпечатку файлов: в отличие от поколения, не меняется при перезапуске сервера
+        self.version = hashlib.sha1(repr((signature, delta_names)).encode()).hexdigest()[:16]
+        # Оценка занимаемой памяти - размер файлов основы и дельт (при mmap это страницы page cache)
+        self.size_bytes = segments_size(path)
+        self.load_seconds = load_seconds
+        self.last_check = time.monotonic()
+
+    def info(self) -> dict:
+        return {
+            "name": self.name,
+            "generation": self.generation,
+            "version": self.version,
+            "vectors": self.store.ntotal,
+            "deltas": len(self.store.deltas),
+            "index": self.index_config.describe(),
+            "size_mb": round(self.size_bytes / 2**20, 1),
+            "load_seconds": round(self.load_seconds, 3),
+        }
+
+
+class DatabaseRouter:
+    """Выдает базы по имени: каталоги base_dir/<имя> плюс явно заданные пути (fixed).
+
+    Базы загружаются при первом обращении. Если суммарный размер загруженных
+    баз превышает memory_limit_bytes, вытесняются давно не использованные.
+    """
+
+    def __init__(self, base_dir: str, embeddings_getter: Callable[[], object], memory_limit_bytes: int,
+                 fixed: Optional[Dict[str, str]] = None, mmap: bool = True, reload_check_interval: float = 2.0):
+        self.base_dir = base_dir
+        self.embeddings_getter = embeddings_getter
+        self.memory_limit_bytes = memory_limit_bytes
+        self.fixed = dict(fixed or {})
+        self.mmap = mmap
+        self.reload_check_interval = reload_check_interval
+        self._loaded: "OrderedDict[str, LoadedDatabase]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._name_locks: Dict[str, threading.Lock] = {}
+        self._generations: Dict[str, int] = {}
+        self.loads = 0
+        self.evictions = 0
+
+    def path_for(self, name: str) -> str:
+        if name in self.fixed:
+            return self.fixed[name]
+        # Имя - только каталог непосредственно в base_dir, без выхода за его пределы
+        if not name or os.path.basename(name) != name or name in (".", ".."):
+            raise UnknownDatabaseError(name)
+        path = os.path.join(self.base_dir, name)
+        if not os.path.exists(os.path.join(path, "index.faiss")):
+            raise UnknownDatabaseError(name)
+        return path
+
+    def available(self) -> List[str]:
+        names = [name for name, path in self.fixed.items() if os.path.exists(os.path.join(path, "index.faiss"))]
+        if os.path.isdir(self.base_dir):
+            names.extend(sorted(
+                name for name in os.listdir(self.base_dir)
+                if name not in self.fixed and os.path.exists(os.path.join(self.base_dir, name, "index.faiss"))
+            ))
+        return names
+
+    def get(self, name: str) -> LoadedDatabase:
+        """Текущее поколение базы; загружает или перезагружает ее при необходимости"""
+        with self._lock:
+            loaded = self._loaded.get(name)
+            if loaded is not None:
+                self._loaded.move_to_end(name)
+                if time.monotonic() - loaded.last_check < self.reload_check_interval:
+                    return loaded
+            name_lock = self._name_locks.setdefault(name, threading.Lock())
+        # Загрузка одной базы не блокирует обращения к остальным
+        with name_lock:
+            with self._lock:
+                loaded = self._loaded.get(name)
+            path = self.path_for(name)
+            if loaded is not None:
+                loaded.last_check = time.monotonic()
+                try:
+                    if (index_signature(path), list_delta_names(path)) == (loaded.signature, loaded.delta_names):
+                        return loaded
+                except OSError:
+                    return loaded  # Файлы переписываются прямо сейчас - обслуживаем старое поколение
+                print(f"🔄 База '{name}' на диске изменилась, перезагрузка...")
+            try:
+                fresh = self._load(name, path, loaded)
+            except Exception as e:
+                if loaded is None:
+                    raise
+                print(f"❌ Ошибка перезагрузки базы '{name}': {e}")
+                return loaded
+            with self._lock:
+                self._loaded[name] = fresh
+                self._loaded.move_to_end(name)
+                self._evict(keep=name)
+            return fresh
+
+    def _load(self, name: str, path: str, previous: Optional[LoadedDatabase] = None) -> LoadedDatabase:
+        signature = index_signature(path)
+        delta_names = list_delta_names(path)
+        started = time.perf_counter()
+        # Основа не менялась (добавились только дельты) - читаются лишь новые дельты
+        reuse = previous.store if previous is not None and previous.signature == signature else None
+        store = load_segments(path, self.embeddings_getter(), mmap=self.mmap, previous=reuse)
+        index_config = load_index_config(path)
+        generation = self._generations.get(name, 0) + 1
+        self._generations[name] = generation
+        self.loads += 1
+        loaded = LoadedDatabase(name, path, store, index_config, signature, delta_names, generation,
+                                time.perf_counter() - started)
+        print(f"✅ База '{name}' загружена (поколение {generation}). Векторов: {store.ntotal}, "
+              f"дельт: {len(store.deltas)}, индекс: {index_config.describe()}, {loaded.load_seconds:.2f} с")
+        return loaded
+
+    def _evict(self, keep: str):
+        # Вызывается под self._lock; только что запрошенная база не вытесняется, даже если одна больше лимита
+        while self.memory_bytes() > self.memory_limit_bytes:
+            victim = next((name for name in self._loaded if name != keep), None)
+            if victim is None:
+                break
+            evicted = self._loaded.pop(victim)
+            self.evictions += 1
+            print(f"♻️ База '{victim}' вытеснена из памяти ({evicted.size_bytes / 2**20:.0f} МБ)")
+
+    def memory_bytes(self) -> int:
+        return sum(db.size_bytes for db in self._loaded.values())
+
+    def loaded(self) -> List[LoadedDatabase]:
+        with self._lock:
+            return list(self._loaded.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "loaded": [db.info() for db in self._loaded.values()],
+                "memory_mb": round(self.memory_bytes() / 2**20, 1),
+                "memory_limit_mb": round(self.memory_limit_bytes / 2**20, 1),
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# delta_segments.py - Добавление книг маленькими дельта-сегментами рядом с основным индексом и их слияние (компакция)
+import os
+import fcntl
+import shutil
+import logging
+import tempfile
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_community.vectorstores import FAISS
+
+from ann_index import (IndexConfig, add_vectors, build_vector_db, load_vector_db, read_index, reconstruct_all,
+                       save_vector_db, search_live)
+from source_index import SourceIndex, filtered_search
+
+logger = logging.getLogger(__name__)
+
+DELTAS_DIR = "deltas"
+DELTA_PREFIX = "delta-"
+WRITER_LOCK_FILE = ".writer.lock"
+# Компакция запускается сама, когда дельт больше MAX_DELTAS или в них больше MAX_DELTA_FRACTION векторов основы
+MAX_DELTAS = 8
+MAX_DELTA_FRACTION = 0.1
+
+
+def deltas_path(db_path: str) -> str:
+    return os.path.join(db_path, DELTAS_DIR)
+
+
+def list_delta_names(db_path: str) -> Tuple[str, ...]:
+    """Готовые дельты в порядке записи; недописанные временные каталоги не видны"""
+    path = deltas_path(db_path)
+    if not os.path.isdir(path):
+        return ()
+    return tuple(sorted(name for name in os.listdir(path)
+                        if name.startswith(DELTA_PREFIX) and os.path.exists(os.path.join(path, name, "index.faiss"))))
+
+
+def segments_size(db_path: str) -> int:
+    """Размер файлов основы и всех дельт в байтах"""
+    paths = [db_path] + [os.path.join(deltas_path(db_path), name) for name in list_delta_names(db_path)]
+    return sum(os.path.getsize(os.path.join(path, name)) for path in paths for name in ("index.faiss", "index.pkl"))
+
+
+@contextmanager
+def writer_lock(db_path: str):
+    """Один писатель на базу: запись дельт и компакция не пересекаются между процессами"""
+    os.makedirs(db_path, exist_ok=True)
+    with open(os.path.join(db_path, WRITER_LOCK_FILE), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class SegmentedStore:
+    """Основной индекс и дельты как одна база: поиск идет по всем сегментам, выдачи сливаются по дистанции"""
+
+    def __init__(self, base: FAISS, deltas: Optional[List[Tuple[str, FAISS]]] = None,
+                 source_indexes: Optional[List[SourceIndex]] = None):
+        self.base = base
+        self.deltas = list(deltas or [])
+        # Индекс источник -> метки для каждого сегмента (в порядке segments)
+        self.source_indexes = (list(source_indexes) if source_indexes is not None
+                               else [SourceIndex.build(segment) for segment in self.segments])
+
+    @property
+    def segments(self) -> List[FAISS]:
+        return [self.base] + [delta for _, delta in self.deltas]
+
+    @property
+    def ntotal(self) -> int:
+        return sum(segment.index.ntotal for segment in self.segments)
+
+    def search(self, vectors: np.ndarray, k: int,
+               source_filters: Optional[Sequence[Optional[Sequence[str]]]] = None) -> List[List[Tuple[object, float]]]:
+        """До k пар (документ, L2-дистанция) на каждый вектор запроса, по возрастанию дистанции.
+
+        source_filters[i] - допустимые metadata["source"] для i-го запроса (None - без фильтра).
+        Фильтр применяется внутри поиска, поэтому отфильтрованные запросы тоже получают k результатов.
+        """
+        hits: List[List[Tuple[object, float]]] = [[] for _ in range(len(vectors))]
+        filters = list(source_filters) if source_filters is not None else [None] * len(vectors)
+        plain = [i for i, sources in enumerate(filters) if sources is None]
+        # Запросы с одинаковым фильтром ищутся одним вызовом
+        grouped: Dict[tuple, List[int]] = {}
+        for i, sources in enumerate(filters):
+            if sources is not None:
+                grouped.setdefault(tuple(sorted(set(sources))), []).append(i)
+        for segment, source_index in zip(self.segments, self.source_indexes):
+            fetch = min(k, segment.index.ntotal)
+            if fetch <= 0:
+                continue
+            if plain:
+                # Надгробия HNSW исключаются внутри FAISS и не занимают мест в выдаче
+                distances, positions = search_live(segment, vectors[plain], fetch)
+                self._collect(segment, hits, plain, distances, positions)
+            for sources, rows in grouped.items():
+                distances, positions = filtered_search(segment.index, vectors[rows], fetch,
+                                                       source_index.labels_for(sources))
+                self._collect(segment, hits, rows, distances, positions)
+        if len(self.segments) > 1:
+            hits = [sorted(row_hits, key=lambda hit: hit[1])[:k] for row_hits in hits]
+        return hits
+
+    @staticmethod
+    def _collect(segment: FAISS, hits: list, rows: List[int], distances: np.ndarray, positions: np.ndarray):
+        for i, row, row_distances in zip(rows, positions, distances):
+            for label, distance in zip(row, row_distances):
+                doc_id = segment.index_to_docstore_id.get(int(label))
+                if doc_id is not None:  # -1 или надгробие удаленного документа HNSW
+                    hits[i].append((segment.docstore.search(doc_id), float(distance)))
+
+
+def _already_compacted(base: FAISS, delta: FAISS) -> bool:
+    # Компакция сохраняет id документов дельты; если они уже в основе, дельта пережила обрыв после слияния
+    return any(doc_id in base.docstore._dict for doc_id in delta.index_to_docstore_id.values())
+
+
+def load_segments(db_path: str, embeddings, mmap: bool = False,
+                  previous: Optional[SegmentedStore] = None) -> SegmentedStore:
+    """Основа и все дельты базы. previous - прежняя загрузка с той же основой: ее дельты не читаются повторно"""
+    if previous is not None:
+        base, base_sources = previous.base, previous.source_indexes[0]
+        loaded = {name: (delta, sources)
+                  for (name, delta), sources in zip(previous.deltas, previous.source_indexes[1:])}
+    else:
+        base, _ = load_vector_db(db_path, embeddings, mmap=mmap)
+        base_sources = SourceIndex.load(db_path, base)
+        loaded = {}
+    deltas, source_indexes = [], [base_sources]
+    for name in list_delta_names(db_path):
+        delta, sources = loaded.get(name, (None, None))
+        if delta is None:
+            delta_path = os.path.join(deltas_path(db_path), name)
+            delta, _ = load_vector_db(delta_path, embeddings, mmap=mmap)
+            sources = SourceIndex.load(delta_path, delta)
+        if _already_compacted(base, delta):
+            continue
+        deltas.append((name, delta))
+        source_indexes.append(sources)
+    return SegmentedStore(base, deltas, source_indexes)
+
+
+def write_delta(db_path: str, documents: Sequence, embeddings, ids: Optional[List[str]] = None) -> str:
+    """Пишет документы отдельным flat-сегментом; основной индекс не читается и не переписывается.
+
+    Сегмент собирается во временном каталоге и появляется в deltas/ одним
+    переименованием, поэтому читатели не видят его недописанным.
+    Вызывать под writer_lock. Возвращает имя дельты.
+    """
+    root = deltas_path(db_path)
+    os.makedirs(root, exist_ok=True)
+    existing = list_delta_names(db_path)
+    sequence = int(existing[-1][len(DELTA_PREFIX):]) + 1 if existing else 1
+    name = f"{DELTA_PREFIX}{sequence:06d}"
+    vector_db, _ = build_vector_db(documents, embeddings, IndexConfig(index_type="flat"), ids=ids)
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=root)
+    try:
+        save_vector_db(vector_db, tmp_dir)
+        os.rename(tmp_dir, os.path.join(root, name))
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    logger.info(f"Записана дельта {name}: векторов {vector_db.index.ntotal}")
+    return name
+
+
+def needs_compaction(db_path: str) -> bool:
+    """Дельт слишком много или в них слишком большая доля векторов (индексы читаются через mmap, без загрузки)"""
+    names = list_delta_names(db_path)
+    if len(names) > MAX_DELTAS:
+        return True
+    if not names:
+        return False
+    base_vectors = read_index(db_path, mmap=True).ntotal
+    delta_vectors = sum(read_index(os.path.join(deltas_path(db_path), name), mmap=True).ntotal for name in names)
+    return delta_vectors > MAX_DELTA_FRACTION * max(base_vectors, 1)
+
+
+def clear_deltas(db_path: str) -> int:
+    """Удаляет все дельты базы (перед полной пересборкой основы: их документы относятся к прежней основе).
+
+    Каталог сначала переименовывается, поэтому читатели не видят его удаленным наполовину.
+    Вызывать под writer_lock. Возвращает число удаленных дельт.
+    """
+    path = deltas_path(db_path)
+    if not os.path.isdir(path):
+        return 0
+    count = len(list_delta_names(db_path))
+    trash = tempfile.mkdtemp(prefix=".deltas-removed-", dir=db_path)
+    os.replace(path, os.path.join(trash, DELTAS_DIR))
+    shutil.rmtree(trash, ignore_errors=True)
+    if count:
+        logger.info(f"Удалено дельт прежней основы: {count}")
+    return count
+
+
+def compact(db_path: str, embeddings) -> int:
+    """Переносит векторы и документы всех дельт в основной индекс и удаляет дельты.
+
+    Основа сохраняется атомарно (save_vector_db) до удаления дельт; если процесс
+    оборвется между этими шагами, уже слитые дельты распознаются по id и
+    пропускаются. Вызывать под writer_lock. Возвращает число перенесенных векторов.
+    """
+    names = list_delta_names(db_path)
+    if not names:
+        return 0
+    base, index_config = load_vector_db(db_path, embeddings)
+    moved = 0
+    for name in names:
+        delta, _ = load_vector_db(os.path.join(deltas_path(db_path), name), embeddings)
+        if _already_compacted(base, delta):
+            continue
+        labels, vectors = reconstruct_all(delta.index)
+        keep = [i for i, label in enumerate(labels) if int(label) in delta.index_to_docstore_id]
+        ids = [delta.index_to_docstore_id[int(labels[i])] for i in keep]
+        docs = [delta.docstore.search(doc_id) for doc_id in ids]
+        add_vectors(base, [doc.page_content for doc in docs], vectors[keep], [doc.metadata for doc in docs], ids)
+        moved += len(ids)
+    if moved:
+        save_vector_db(base, db_path)
+    for name in names:
+        shutil.rmtree(os.path.join(deltas_path(db_path), name), ignore_errors=True)
+    logger.info(f"Компакция: дельт {len(names)}, перенесено векторов {moved}, "
+                f"в основе {base.index.ntotal} ({index_config.describe()})")
+    return moved
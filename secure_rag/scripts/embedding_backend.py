@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# embedding_backend.py - Выбираемый бэкенд эмбеддингов для CPU (sentence-transformers, int8, ONNX, Ollama, fake)
+# с пакетами, собранными из входов близкой длины в токенах
+import os
+import re
+import hashlib
+from functools import lru_cache
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# Локальный путь к модели эмбеддингов (общий для всех скриптов)
+EMBEDDING_MODEL_PATH = os.path.expanduser("~/models/embeding/BAAI-bge-m3")
+# sentence-transformers (torch fp32) | int8 (torch, динамическое квантование Linear) | onnx | ollama | fake
+EMBEDDING_BACKEND = os.environ.get("RAG_EMBEDDING_BACKEND", "sentence-transformers")
+EMBEDDING_BATCH_SIZE = int(os.environ.get("RAG_EMBEDDING_BATCH_SIZE", "32"))
+# Предел токенов пакета с учетом выравнивания (число входов * самый длинный): длинные чанки идут меньшими пакетами
+EMBEDDING_MAX_BATCH_TOKENS = int(os.environ.get("RAG_EMBEDDING_MAX_BATCH_TOKENS", "16384"))
+EMBEDDING_THREADS = int(os.environ.get("RAG_EMBEDDING_THREADS", "0"))  # 0 - решает библиотека (по числу ядер)
+# Файл ONNX внутри каталога модели (например onnx/model_qint8_avx512_vnni.onnx); пусто - onnx/model.onnx
+EMBEDDING_ONNX_FILE = os.environ.get("RAG_EMBEDDING_ONNX_FILE", "")
+OLLAMA_EMBEDDING_MODEL = "bge-m3:567m"  # Модель по умолчанию для бэкенда ollama
+FAKE_DIMENSION = 1024  # Как у bge-m3
+BACKENDS = ("sentence-transformers", "int8", "onnx", "ollama", "fake")
+
+_WORDS = re.compile(r"\w+")
+
+
+def default_model(backend: str) -> str:
+    return OLLAMA_EMBEDDING_MODEL if backend == "ollama" else EMBEDDING_MODEL_PATH
+
+
+def embedding_model_id(backend: Optional[str] = None, model: Optional[str] = None) -> str:
+    """Идентификатор модели для кэша эмбеддингов и контрольных точек: векторы разных бэкендов не смешиваются.
+
+    Для sentence-transformers это просто путь к модели - прежние кэши остаются действительными.
+    """
+    backend = backend or EMBEDDING_BACKEND
+    model = model or default_model(backend)
+    if backend == "sentence-transformers":
+        return model
+    if backend == "onnx":
+        return f"{model}#onnx:{EMBEDDING_ONNX_FILE or 'model.onnx'}"
+    if backend == "ollama":
+        return f"ollama:{model}"
+    if backend == "fake":
+        return f"fake-{FAKE_DIMENSION}"
+    return f"{model}#{backend}"
+
+
+def token_buckets(lengths: np.ndarray, batch_size: int, max_batch_tokens: int) -> List[np.ndarray]:
+    """Позиции входов, разбитые на пакеты по возрастанию длины: в пакете - входы близкой длины,
+    поэтому выравнивание до самого длинного почти ничего не добавляет"""
+    order = np.argsort(lengths, kind="stable")
+    batches, start = [], 0
+    for end in range(1, len(order) + 1):
+        if end == len(order) or end - start >= batch_size:
+            batches.append(order[start:end])
+            start = end
+        # Следующий вход - самый длинный в пакете, по нему выравнивались бы все остальные
+        elif (end - start + 1) * lengths[order[end]] > max_batch_tokens:
+            batches.append(order[start:end])
+            start = end
+    return batches
+
+
+class BucketedEmbeddings(Embeddings):
+    """Общая часть бэкендов: входы сортируются по длине в токенах и кодируются пакетами token_buckets,
+    результат возвращается в исходном порядке"""
+
+    model_id = ""
+
+    def __init__(self, batch_size: int = EMBEDDING_BATCH_SIZE, max_batch_tokens: int = EMBEDDING_MAX_BATCH_TOKENS):
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.texts_embedded = 0
+        self.batches = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+
+    def token_lengths(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        lengths = np.maximum(np.asarray(self.token_lengths(texts), dtype=np.int64), 1)
+        vectors: Optional[np.ndarray] = None
+        for batch in token_buckets(lengths, self.batch_size, self.max_batch_tokens):
+            encoded = np.asarray(self.encode([texts[i] for i in batch]), dtype=np.float32)
+            if vectors is None:
+                vectors = np.empty((len(texts), encoded.shape[1]), dtype=np.float32)
+            vectors[batch] = encoded
+            self.batches += 1
+            self.padded_tokens += len(batch) * int(lengths[batch].max())
+        self.texts_embedded += len(texts)
+        self.tokens += int(lengths.sum())
+        return vectors.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self).__name__,
+            "model_id": self.model_id,
+            "texts": self.texts_embedded,
+            "batches": self.batches,
+            # Доля токенов-заполнителей в пакетах: чем ближе к 0, тем меньше лишних вычислений
+            "padding_ratio": round(1 - self.tokens / self.padded_tokens, 4) if self.padded_tokens else 0.0,
+        }
+
+
+class SentenceTransformerBackend(BucketedEmbeddings):
+    """Локальная модель sentence-transformers на CPU: torch fp32, torch int8 (quantize) или ONNX Runtime"""
+
+    def __init__(self, model_path: str = EMBEDDING_MODEL_PATH, backend: str = "sentence-transformers",
+                 threads: int = EMBEDDING_THREADS, **kwargs):
+        super().__init__(**kwargs)
+        import torch
+        from sentence_transformers import SentenceTransformer
+        if threads > 0:
+            torch.set_num_threads(threads)
+        self.model_id = embedding_model_id(backend, model_path)
+        if backend == "onnx":
+            import onnxruntime
+            session_options = onnxruntime.SessionOptions()
+            if threads > 0:
+                session_options.intra_op_num_threads = threads
+            model_kwargs = {"provider": "CPUExecutionProvider", "session_options": session_options}
+            if EMBEDDING_ONNX_FILE:
+                model_kwargs["file_name"] = EMBEDDING_ONNX_FILE
+            self.model = SentenceTransformer(model_path, device="cpu", backend="onnx", model_kwargs=model_kwargs)
+        else:
+            self.model = SentenceTransformer(model_path, device="cpu")
+            if backend == "int8":
+                # Веса Linear в int8, активации квантуются на лету: в 2-3 раза быстрее fp32 на CPU без GPU
+                self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.max_length = self.model.max_seq_length
+
+    def token_lengths(self, texts: List[str]) -> np.ndarray:
+        encoded = self.model.tokenizer(texts, truncation=True, max_length=self.max_length)
+        return np.array([len(ids) for ids in encoded["input_ids"]])
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        # Перевод строки заменяется пробелом, как в SentenceTransformerEmbeddings: векторы совпадают с прежними базами
+        texts = [text.replace("\n", " ") for text in texts]
+        return self.model.encode(texts, batch_size=len(texts), convert_to_numpy=True, show_progress_bar=False)
+
+
+class OllamaBackend(BucketedEmbeddings):
+    """Модель на сервере Ollama; токенизатора на клиенте нет, длина оценивается по числу символов"""
+
+    def __init__(self, model: str, **kwargs):
+        super().__init__(**kwargs)
+        from langchain_ollama import OllamaEmbeddings
+        self.client = OllamaEmbeddings(model=model)
+        self.model_id = embedding_model_id("ollama", model)
+
+    def token_lengths(self, texts: List[str]) -> np.ndarray:
+        return np.array([len(text) // 4 for text in texts])
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self.client.embed_documents(texts), dtype=np.float32)
+
+
+@lru_cache(maxsize=100000)
+def _fake_word_vector(dimension: int, word: str) -> np.ndarray:
+    """Вектор слова для FakeEmbeddings; кэш общий для всех экземпляров, массив только для чтения"""
+    seed = int.from_bytes(hashlib.sha256(word.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+    vector.setflags(write=False)
+    return vector
+
+
+class FakeEmbeddings(BucketedEmbeddings):
+    """Детерминированные векторы без модели (для тестов): сумма случайных векторов слов, посеянных хэшем слова.
+
+    Тексты с общими словами получают близкие векторы, поэтому поиск по такой базе осмыслен.
+    """
+
+    def __init__(self, dimension: int = FAKE_DIMENSION, **kwargs):
+        super().__init__(**kwargs)
+        self.dimension = dimension
+        self.model_id = embedding_model_id("fake")
+
+    def token_lengths(self, texts: List[str]) -> np.ndarray:
+        return np.array([len(_WORDS.findall(text)) for text in texts])
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        vectors = np.empty((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = _WORDS.findall(text.lower()) or [text]
+            vector = np.sum([_fake_word_vector(self.dimension, word) for word in words], axis=0)
+            vectors[row] = vector / max(float(np.linalg.norm(vector)), 1e-12)
+        return vectors
+
+
+def create_embeddings(backend: Optional[str] = None, model: Optional[str] = None,
+                      batch_size: int = EMBEDDING_BATCH_SIZE, threads: int = EMBEDDING_THREADS,
+                      max_batch_tokens: int = EMBEDDING_MAX_BATCH_TOKENS) -> BucketedEmbeddings:
+    """Бэкенд эмбеддингов по имени (по умолчанию RAG_EMBEDDING_BACKEND).
+
+    model - путь к локальной модели или имя модели Ollama. Функция picklable
+    через functools.partial, поэтому годится как фабрика для ParallelEmbeddings.
+    """
+    backend = backend or EMBEDDING_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Неизвестный бэкенд эмбеддингов: {backend} (допустимы: {', '.join(BACKENDS)})")
+    kwargs = {"batch_size": batch_size, "max_batch_tokens": max_batch_tokens}
+    if backend == "fake":
+        return FakeEmbeddings(**kwargs)
+    model = model or default_model(backend)
+    if backend == "ollama":
+        return OllamaBackend(model, **kwargs)
+    return SentenceTransformerBackend(model, backend=backend, threads=threads, **kwargs)
+
+
+def describe_backend(backend: Optional[str] = None, model: Optional[str] = None) -> str:
+    backend = backend or EMBEDDING_BACKEND
+    if backend == "fake":
+        return "fake (детерминированные векторы без модели)"
+    return f"{backend}: {model or default_model(backend)}"
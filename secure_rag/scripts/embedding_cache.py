@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# embedding_cache.py - Дисковый кэш эмбеддингов, адресуемый по (модель, sha256 текста чанка)
+import os
+import re
+import json
+import fcntl
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+# Каталог кэша по умолчанию, общий для всех скриптов построения баз
+DEFAULT_CACHE_DIR = os.path.expanduser("~/secure_rag/embedding_cache")
+# Предельный размер матрицы векторов одной модели
+DEFAULT_MAX_MB = int(os.environ.get("RAG_EMBED_CACHE_MAX_MB", "2048"))
+# При вытеснении оставляем эту долю лимита, чтобы не уплотнять файл на каждой вставке
+EVICT_TO_RATIO = 0.9
+# Журнал индекса сворачивается в index.json, когда в нем строк больше, чем записей в кэше (и не меньше этого)
+JOURNAL_FOLD_MIN_LINES = 10000
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Кэш векторов одной модели: float32-матрица в файле (memmap), JSON-индекс и журнал к нему.
+
+    Файл векторов только дописывается; индекс хранит для каждого ключа номер
+    строки и отметку последнего использования (для LRU-вытеснения). Новые записи и
+    отметки дописываются строками в журнал и время от времени сворачиваются в
+    index.json. Блокировка каталога берется только на чтение индекса, дописывание
+    строк и запись индекса, поэтому сборки разных баз работают с кэшем одновременно:
+    перед каждой операцией процесс дочитывает изменения, сделанные другими.
+    """
+
+    def __init__(self, model_id: str, cache_dir: str = DEFAULT_CACHE_DIR, max_mb: int = DEFAULT_MAX_MB):
+        self.model_id = model_id
+        slug = re.sub(r"[^A-Za-z0-9._-]+", "_", os.path.basename(model_id.rstrip("/")))[:40]
+        self.path = os.path.join(cache_dir, f"{slug}-{hashlib.sha1(model_id.encode()).hexdigest()[:12]}")
+        self.max_bytes = max_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        self._lock_file = open(os.path.join(self.path, ".lock"), "w")
+        # flock не разделяет потоки одного процесса (блокировка принадлежит открытому файлу)
+        self._thread_lock = threading.Lock()
+        self._index_path = os.path.join(self.path, "index.json")
+        self._touched: Dict[str, int] = {}  # ключ -> tick попадания, еще не записанный в журнал
+        self._reset_state()
+        with self._locked():
+            self._sync()
+
+    def _reset_state(self):
+        self.dim: Optional[int] = None
+        self.rows = 0
+        self.tick = 0
+        self.entries: Dict[str, List[int]] = {}  # ключ -> [строка, последний tick]
+        self.generation = 0
+        # Файлы векторов и журнала текущего поколения; сворачивание и вытеснение переключают их
+        # одной атомарной записью index.json, поэтому индекс никогда не смотрит в чужой файл
+        self._vectors_name = "vectors.f32"
+        self._journal_name = "journal.jsonl"
+        self._index_stamp: Optional[tuple] = None
+        self._journal_offset = 0
+        self._journal_lines = 0
+        self._matrix: Optional[np.memmap] = None
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.path, self._vectors_name)
+
+    @property
+    def _journal_path(self) -> str:
+        return os.path.join(self.path, self._journal_name)
+
+    # --- Жизненный цикл ---
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._lock_file is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self._matrix = None
+            self._lock_file.close()
+            self._lock_file = None
+
+    @contextmanager
+    def _locked(self):
+        if self._lock_file is None:
+            raise RuntimeError("Кэш эмбеддингов закрыт")
+        with self._thread_lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _stamp(path: str) -> Optional[tuple]:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    # --- Синхронизация с диском (все методы ниже вызываются под блокировкой) ---
+
+    def _sync(self):
+        """Дочитывает изменения других процессов: новый index.json целиком, журнал - с места остановки"""
+        stamp = self._stamp(self._index_path)
+        if stamp != self._index_stamp:
+            self._load_index()
+        self._replay_journal()
+        self._check_vectors()
+
+    def _load_index(self):
+        self._reset_state()
+        if os.path.exists(self._index_path):
+            try:
+                with open(self._index_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning(f"Индекс кэша эмбеддингов поврежден ({e}), кэш будет создан заново.")
+                self._reset_files()
+                return
+            self.dim = data.get("dim")
+            self.rows = data.get("rows", 0)
+            self.tick = data.get("tick", 0)
+            self.entries = data.get("entries", {})
+            self.generation = data.get("generation", 0)
+            self._vectors_name = data.get("vectors_file", self._vectors_name)
+            self._journal_name = data.get("journal_file", self._journal_name)
+        self._index_stamp = self._stamp(self._index_path)
+
+    def _replay_journal(self):
+        try:
+            with open(self._journal_path, "rb") as f:
+                f.seek(self._journal_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            # Строка, оборванная падением писателя
+            with open(self._journal_path, "r+b") as f:
+                f.truncate(self._journal_offset + end)
+        lines = data[:end].splitlines()
+        for line in lines:
+            key, row, tick = json.loads(line)
+            entry = self.entries.get(key)
+            self.entries[key] = [row, max(tick, entry[1]) if entry is not None and entry[0] == row else tick]
+            self.rows = max(self.rows, row + 1)
+            self.tick = max(self.tick, tick)
+        self._journal_offset += end
+        self._journal_lines += len(lines)
+
+    def _check_vectors(self):
+        if not self.dim:
+            return
+        expected = self.rows * self.dim * 4
+        actual = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+        if actual < expected:
+            logger.warning("Файл векторов кэша короче индекса, кэш будет создан заново.")
+            self._reset_files()
+        elif actual > expected:
+            # Строки, дописанные без записи в журнал (писатель упал между ними), недостижимы
+            with open(self._vectors_path, "r+b") as f:
+                f.truncate(expected)
+
+    def _reset_files(self):
+        for name in os.listdir(self.path):
+            if name != ".lock":
+                os.remove(os.path.join(self.path, name))
+        self._reset_state()
+
+    def _append_journal(self, lines: List[list]):
+        if not lines:
+            return
+        data = "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8")
+        with open(self._journal_path, "ab") as f:
+            f.write(data)
+        self._journal_offset += len(data)
+        self._journal_lines += len(lines)
+        # Журнал длиннее индекса сворачивается: его разбор при синхронизации остается амортизированно O(1)
+        if self._journal_lines > max(JOURNAL_FOLD_MIN_LINES, len(self.entries)):
+            self._fold()
+
+    def _fold(self, vectors_name: Optional[str] = None):
+        """Пишет index.json нового поколения с пустым журналом; старые файлы удаляются после переключения"""
+        self.generation += 1
+        self._vectors_name = vectors_name or self._vectors_name
+        self._journal_name = f"journal-{self.generation}.jsonl"
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"model_id": self.model_id, "dim": self.dim, "rows": self.rows, "tick": self.tick,
+                       "generation": self.generation, "vectors_file": self._vectors_name,
+                       "journal_file": self._journal_name, "entries": self.entries}, f)
+        os.replace(tmp_path, self._index_path)
+        self._index_stamp = self._stamp(self._index_path)
+        self._journal_offset = 0
+        self._journal_lines = 0
+        for name in os.listdir(self.path):
+            if name.startswith(("vectors", "journal")) and name not in (self._vectors_name, self._journal_name):
+                os.remove(os.path.join(self.path, name))
+
+    def flush(self):
+        """Записывает в журнал отметки попаданий (векторы и новые записи уже на диске)"""
+        if not self._touched or self._lock_file is None:
+            return
+        with self._locked():
+            self._sync()
+            lines = []
+            for key, tick in self._touched.items():
+                entry = self.entries.get(key)
+                if entry is not None and tick > entry[1]:
+                    entry[1] = tick
+                    lines.append([key, entry[0], tick])
+            self._touched.clear()
+            self._append_journal(lines)
+
+    # --- Чтение и запись ---
+
+    def _matrix_view(self) -> np.memmap:
+        if (self._matrix is None or self._matrix.shape[0] != self.rows
+                or self._matrix.filename != os.path.abspath(self._vectors_path)):
+            self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r",
+                                     shape=(self.rows, self.dim))
+        return self._matrix
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        """Возвращает найденные векторы и обновляет счетчики попаданий/промахов"""
+        found = {}
+        with self._locked():
+            self._sync()
+            self.tick += 1
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                self._touched[key] = self.tick
+                found[key] = entry[0]
+            if found:
+                matrix = self._matrix_view()
+                rows = np.fromiter(found.values(), dtype=np.int64, count=len(found))
+                vectors = np.asarray(matrix[rows])
+                found = dict(zip(found.keys(), vectors))
+        return found
+
+    def put_many(self, keys: Sequence[str], vectors: Sequence[Sequence[float]]):
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if matrix.size == 0:
+            return
+        with self._locked():
+            self._sync()
+            new_cache = self.dim is None
+            if new_cache:
+                self.dim = matrix.shape[1]
+            elif matrix.shape[1] != self.dim:
+                raise ValueError(f"Размерность {matrix.shape[1]} не совпадает с кэшем ({self.dim})")
+            self.tick += 1
+            # Те же тексты мог уже посчитать и записать другой процесс
+            fresh = {}
+            for position, key in enumerate(keys):
+                if key not in self.entries and key not in fresh:
+                    fresh[key] = position
+            if fresh:
+                with open(self._vectors_path, "ab") as f:
+                    f.write(matrix[list(fresh.values())].tobytes())
+                lines = [[key, self.rows + offset, self.tick] for offset, key in enumerate(fresh)]
+                for key, row, tick in lines:
+                    self.entries[key] = [row, tick]
+                self.rows += len(lines)
+                if new_cache:
+                    self._fold()  # Размерность хранится только в index.json
+                else:
+                    self._append_journal(lines)
+            self._evict_if_needed()
+
+    def _evict_if_needed(self):
+        """LRU-вытеснение с уплотнением: векторы пишутся в файл нового поколения"""
+        row_bytes = self.dim * 4
+        if self.rows * row_bytes <= self.max_bytes:
+            return
+        for key, tick in self._touched.items():
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[1] = max(entry[1], tick)
+        keep = int(self.max_bytes * EVICT_TO_RATIO) // row_bytes
+        ordered = sorted(self.entries.items(), key=lambda item: item[1][1], reverse=True)
+        kept = ordered[:keep]
+        self.evicted += len(ordered) - len(kept)
+
+        old = self._matrix_view()
+        vectors_name = f"vectors-{self.generation + 1}.f32"
+        with open(os.path.join(self.path, vectors_name), "wb") as f:
+            for new_row, (_, entry) in enumerate(kept):
+                f.write(np.asarray(old[entry[0]]).tobytes())
+                entry[0] = new_row
+        self._matrix = None
+        self.entries = dict(kept)
+        self.rows = len(kept)
+        self._fold(vectors_name)
+
+    def report(self) -> str:
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total else 0.0
+        return (f"Кэш эмбеддингов [{os.path.basename(self.path)}]: попаданий {self.hits}, "
+                f"промахов {self.misses} ({rate:.1f}% попаданий), вытеснено {self.evicted}, "
+                f"записей {len(self.entries)}")
+
+
+class CachedEmbeddings(Embeddings):
+    """Обертка над моделью эмбеддингов: документы берутся из кэша, считаются только промахи"""
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [text_key(text) for text in texts]
+        found = self.cache.get_many(keys)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            self.cache.put_many(list(missing.keys()), vectors)
+            found.update(zip(missing.keys(), np.asarray(vectors, dtype=np.float32)))
+        return [found[key].tolist() for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# http_clients.py - Общие пулы HTTP-соединений к RAG API и llama-server (keep-alive, лимиты, таймауты, повторы)
+import time
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Статусы, при которых идемпотентный запрос имеет смысл повторить
+RETRY_STATUSES = {502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+@dataclass
+class BackendConfig:
+    """Параметры пула соединений к одному бэкенду"""
+    base_url: str
+    max_connections: int = 20
+    max_keepalive: int = 10
+    connect_timeout: float = 5.0
+    read_timeout: Optional[float] = 60.0  # None - без ограничения (потоковая генерация)
+    retries: int = 2
+    backoff: float = 0.2  # Базовая пауза между повторами, секунд
+
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=self.max_connections,
+                            max_keepalive_connections=self.max_keepalive,
+                            keepalive_expiry=30.0)
+
+    def timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(connect=self.connect_timeout, read=self.read_timeout,
+                             write=30.0, pool=self.connect_timeout)
+
+
+def _should_retry(method: str, response: Optional[httpx.Response], error: Optional[Exception]) -> bool:
+    # Ошибки соединения повторяются транспортом httpx; здесь - таймауты и 5xx для идемпотентных запросов
+    if method.upper() not in IDEMPOTENT_METHODS:
+        return False
+    if error is not None:
+        return isinstance(error, (httpx.TimeoutException, httpx.RemoteProtocolError))
+    return response is not None and response.status_code in RETRY_STATUSES
+
+
+class AsyncBackendPool:
+    """Набор httpx.AsyncClient по одному на бэкенд, создается один раз на время жизни приложения"""
+
+    def __init__(self, backends: Dict[str, BackendConfig]):
+        self.backends = backends
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    async def start(self):
+        for name, config in self.backends.items():
+            # Лимиты пула задаются на транспорте: при явном transport httpx игнорирует limits клиента
+            self._clients[name] = httpx.AsyncClient(
+                base_url=config.base_url,
+                timeout=config.timeout(),
+                transport=httpx.AsyncHTTPTransport(retries=config.retries, limits=config.limits()),
+            )
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+    def client(self, name: str) -> httpx.AsyncClient:
+        """Клиент бэкенда (например, для потоковых запросов через client.stream)"""
+        return self._clients[name]
+
+    async def request(self, name: str, method: str, url: str, **kwargs) -> httpx.Response:
+        """Запрос с повторами и экспоненциальной паузой"""
+        config = self.backends[name]
+        client = self._clients[name]
+        for attempt in range(config.retries + 1):
+            response, error = None, None
+            try:
+                response = await client.request(method, url, **kwargs)
+            except httpx.HTTPError as e:
+                error = e
+            if attempt < config.retries and _should_retry(method, response, error):
+                logger.warning(f"Повтор запроса {method} {name}{url} (попытка {attempt + 2}): "
+                               f"{error or response.status_code}")
+                await asyncio.sleep(config.backoff * 2 ** attempt)
+                continue
+            if error is not None:
+                raise error
+            return response
+
+
+class SyncBackendClient:
+    """Синхронный вариант для консольных скриптов: одно keep-alive соединение на бэкенд"""
+
+    def __init__(self, config: BackendConfig):
+        self.config = config
+        self.client = httpx.Client(
+            base_url=config.base_url,
+            timeout=config.timeout(),
+            transport=httpx.HTTPTransport(retries=config.retries, limits=config.limits()),
+        )
+
+    def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        for attempt in range(self.config.retries + 1):
+            response, error = None, None
+            try:
+                response = self.client.request(method, url, **kwargs)
+            except httpx.HTTPError as e:
+                error = e
+            if attempt < self.config.retries and _should_retry(method, response, error):
+                time.sleep(self.config.backoff * 2 ** attempt)
+                continue
+            if error is not None:
+                raise error
+            return response
+
+    def close(self):
+        self.client.close()
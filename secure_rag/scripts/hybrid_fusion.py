@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# hybrid_fusion.py - Векторизованное слияние семантического (FAISS) и лексического (BM25) поиска
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ann_index import search_live
+from lexical_index import LexicalIndex
+from source_index import SourceIndex, filtered_search
+
+FUSION_METHODS = ("weighted", "rrf")
+# Константа сглаживания для Reciprocal Rank Fusion
+RRF_K = 60
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Индексы k наибольших значений по убыванию (argpartition вместо полной сортировки)"""
+    n = scores.shape[0]
+    if n == 0 or k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k >= n:
+        return np.argsort(-scores, kind="stable")
+    part = np.argpartition(-scores, k - 1)[:k]
+    return part[np.argsort(-scores[part], kind="stable")]
+
+
+def min_max_normalize(scores: np.ndarray) -> np.ndarray:
+    """Приводит оценки к диапазону [0, 1]; при нулевом разбросе все оценки равны 1"""
+    if scores.size == 0:
+        return scores.astype(np.float32)
+    lo = scores.min()
+    span = scores.max() - lo
+    if span <= 0:
+        return np.ones_like(scores, dtype=np.float32)
+    return ((scores - lo) / span).astype(np.float32)
+
+
+class FusionIndex:
+    """Выравнивание позиций FAISS и строк BM25 для одного поколения индекса.
+
+    Строки BM25 адресуются по docstore id, поэтому соответствие не зависит
+    от порядка, в котором чанки попали в FAISS.
+    """
+
+    def __init__(self, vector_db, bm25_index: LexicalIndex, source_index: Optional[SourceIndex] = None):
+        self.vector_db = vector_db
+        self.bm25_index = bm25_index
+        self.row_doc_ids = bm25_index.doc_ids
+
+        id_to_row = {doc_id: row for row, doc_id in enumerate(self.row_doc_ids)}
+        # Метки FAISS после удалений идут с пропусками и могут превышать ntotal
+        size = max(vector_db.index.ntotal, max(vector_db.index_to_docstore_id, default=-1) + 1)
+        self.pos_to_row = np.full(size, -1, dtype=np.int64)
+        for pos, doc_id in vector_db.index_to_docstore_id.items():
+            if pos >= 0:
+                self.pos_to_row[pos] = id_to_row.get(doc_id, -1)
+
+        # Метки FAISS каждого источника: фильтр применяется внутри поиска, а не отсевом выдачи
+        self.source_index = source_index if source_index is not None else SourceIndex.build(vector_db)
+
+    def document(self, row: int):
+        return self.vector_db.docstore.search(self.row_doc_ids[row])
+
+    def source_labels(self, source_filter: str) -> np.ndarray:
+        return self.source_index.labels_for([source_filter])
+
+    def source_rows(self, source_filter: str) -> np.ndarray:
+        """Строки BM25 источника, собранные из его меток FAISS (без сравнения строк по всему корпусу)"""
+        rows = self.pos_to_row[self.source_labels(source_filter)]
+        return rows[rows >= 0]
+
+    def semantic(self, query_vector: Sequence[float], n: int,
+                 source_filter: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Поиск в FAISS: возвращает строки BM25 и оценки (чем больше, тем лучше)"""
+        return self.semantic_batch([query_vector], [n], [source_filter])[0]
+
+    def semantic_batch(self, query_vectors: Sequence[Sequence[float]], ns: Sequence[int],
+                       source_filters: Sequence[Optional[str]]) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Один матричный поиск FAISS для пакета запросов с индивидуальными n и фильтрами"""
+        index = self.vector_db.index
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+        if index.ntotal == 0 or not len(query_vectors):
+            return [empty for _ in query_vectors]
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        distances = np.full((len(queries), min(max(max(ns), 1), index.ntotal)), np.inf, dtype=np.float32)
+        positions = np.full(distances.shape, -1, dtype=np.int64)
+        # Запросы без фильтра - одним поиском; с фильтром - поиском только по меткам источника
+        plain = [i for i, source_filter in enumerate(source_filters) if source_filter is None]
+        if plain:
+            # Надгробия HNSW исключаются внутри FAISS: строк BM25 у них нет
+            distances[plain], positions[plain] = search_live(self.vector_db, queries[plain], distances.shape[1])
+        for source_filter in set(source_filters) - {None}:
+            rows = [i for i, f in enumerate(source_filters) if f == source_filter]
+            distances[rows], positions[rows] = filtered_search(index, queries[rows], distances.shape[1],
+                                                               self.source_labels(source_filter))
+
+        results = []
+        for i, n in enumerate(ns):
+            valid = positions[i] >= 0
+            rows = np.full(positions[i].shape, -1, dtype=np.int64)
+            rows[valid] = self.pos_to_row[positions[i][valid]]
+            keep = rows >= 0
+            # Для L2 меньшая дистанция означает большую близость
+            results.append((rows[keep][:n], -distances[i][keep][:n]))
+        return results
+
+    def lexical(self, query: str, n: int,
+                source_filter: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """BM25 только по постингам терминов запроса: строки без единого термина в выдачу не попадают"""
+        rows, scores = self.bm25_index.score(query)
+        if source_filter is not None and rows.size:
+            keep = np.isin(rows, self.source_rows(source_filter))
+            rows, scores = rows[keep], scores[keep]
+        top = top_k_indices(scores, n)
+        return rows[top], scores[top]
+
+
+def fuse(semantic: Tuple[np.ndarray, np.ndarray],
+         lexical: Tuple[np.ndarray, np.ndarray],
+         k: int,
+         method: str = "weighted",
+         semantic_weight: float = 0.7) -> List[Tuple[int, float]]:
+    """Объединяет два ранжированных списка строк и возвращает top-k (строка, оценка)"""
+    if method not in FUSION_METHODS:
+        raise ValueError(f"Неизвестный метод слияния: {method}")
+    sem_rows, sem_scores = semantic
+    lex_rows, lex_scores = lexical
+    candidates = np.union1d(sem_rows, lex_rows)
+    if candidates.size == 0:
+        return []
+
+    sem_pos = np.searchsorted(candidates, sem_rows)
+    lex_pos = np.searchsorted(candidates, lex_rows)
+    fused = np.zeros(candidates.shape[0], dtype=np.float32)
+
+    if method == "weighted":
+        # Кандидат, не найденный одним из ретриверов, получает по нему 0
+        fused[sem_pos] += semantic_weight * min_max_normalize(sem_scores)
+        fused[lex_pos] += (1.0 - semantic_weight) * min_max_normalize(lex_scores)
+    else:
+        # Списки уже отсортированы по убыванию оценок
+        fused[sem_pos] += 1.0 / (RRF_K + 1 + np.arange(sem_rows.shape[0]))
+        fused[lex_pos] += 1.0 / (RRF_K + 1 + np.arange(lex_rows.shape[0]))
+
+    order = top_k_indices(fused, k)
+    return [(int(candidates[i]), float(fused[i])) for i in order]
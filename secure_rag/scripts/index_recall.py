@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# index_recall.py - Recall@k и задержка приближенного индекса (IVF/HNSW) относительно точного flat-поиска
+import os
+import sys
+import logging
+import time
+import argparse
+from dataclasses import asdict
+
+import faiss
+import numpy as np
+
+from ann_index import (IndexConfig, apply_search_params, live_labels, load_vector_db, reconstruct_all,
+                       save_index_config, search_live)
+
+DEFAULT_DB_PATH = os.path.expanduser("~/secure_rag/vector_db")
+# Перебираемые значения параметра поиска
+NPROBE_SWEEP = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+EF_SEARCH_SWEEP = (16, 32, 64, 128, 256, 512)
+
+
+def load_queries(args, vectors: np.ndarray) -> np.ndarray:
+    """Векторы запросов: тексты из файла (через модель эмбеддингов) или случайная выборка векторов базы"""
+    if args.queries:
+        from embedding_backend import create_embeddings
+        with open(args.queries, "r", encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()]
+        print(f"🔄 Кодирование {len(texts)} запросов из {args.queries}...")
+        embeddings = create_embeddings()
+        return np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    rng = np.random.default_rng(args.seed)
+    sample = rng.choice(len(vectors), size=min(args.sample, len(vectors)), replace=False)
+    return vectors[sample]
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(set(row[row >= 0]) & set(expected)) for row, expected in zip(found, truth))
+    return hits / truth.size
+
+
+def measure(vector_db, queries: np.ndarray, k: int, truth: np.ndarray):
+    started = time.perf_counter()
+    _, found = search_live(vector_db, queries, k)  # Надгробия HNSW не попадают в выдачу
+    latency_ms = (time.perf_counter() - started) * 1000 / len(queries)
+    return recall_at_k(found, truth), latency_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение приближенного индекса базы с точным поиском")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="Каталог векторной базы")
+    parser.add_argument("-k", type=int, default=10, help="Глубина recall@k")
+    parser.add_argument("--queries", help="Файл с запросами (по одному на строку); по умолчанию - выборка векторов базы")
+    parser.add_argument("--sample", type=int, default=500, help="Размер выборки векторов базы в качестве запросов")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--target", type=float, default=0.95, help="Целевой recall для рекомендации")
+    parser.add_argument("--write", action="store_true", help="Записать рекомендованный параметр в index_config.json")
+    args = parser.parse_args()
+
+    index_file = os.path.join(args.db, "index.faiss")
+    if not os.path.exists(index_file):
+        print(f"❌ Индекс не найден: {index_file}")
+        return 1
+    # Модель эмбеддингов не нужна (запросы из файла кодируются в load_queries): молчим о ее отсутствии
+    logging.getLogger("langchain_community.vectorstores.faiss").setLevel(logging.ERROR)
+    vector_db, config = load_vector_db(args.db, None)
+    index = vector_db.index
+    live = live_labels(vector_db)
+    print(f"📂 База: {args.db}, векторов: {len(live)} (надгробий: {index.ntotal - len(live)}), "
+          f"индекс: {config.describe()}")
+    if len(live) == 0:
+        print("❌ База пуста.")
+        return 1
+
+    # Эталон строится только по живым меткам, как в retrieval_benchmark.exact_recall
+    labels, vectors = reconstruct_all(index)
+    alive = np.isin(labels, live)
+    labels, vectors = labels[alive], vectors[alive]
+    queries = load_queries(args, vectors)
+    k = min(args.k, len(labels))
+
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    started = time.perf_counter()
+    _, truth = exact.search(queries, k)
+    truth = labels[truth]  # Позиции эталона -> метки индекса базы
+    flat_ms = (time.perf_counter() - started) * 1000 / len(queries)
+    print(f"🎯 Эталон (flat): {len(queries)} запросов, {flat_ms:.3f} мс/запрос\n")
+
+    if config.index_type == "flat":
+        print("Индекс базы точный (flat): recall@k = 1.0. Для сравнения постройте базу с RAG_INDEX_TYPE=ivf или hnsw.")
+        return 0
+
+    if config.index_type == "ivf":
+        param, sweep = "nprobe", [v for v in NPROBE_SWEEP if v <= config.nlist]
+    else:
+        param, sweep = "ef_search", [v for v in EF_SEARCH_SWEEP if v >= k]
+    print(f"{param:>10} | recall@{k} | мс/запрос | ускорение")
+    print("-" * 46)
+    recommended = None
+    for value in sweep:
+        trial = IndexConfig.from_dict(dict(asdict(config), **{param: value}))
+        apply_search_params(index, trial)
+        recall, latency_ms = measure(vector_db, queries, k, truth)
+        marker = ""
+        if recommended is None and recall >= args.target:
+            recommended, marker = trial, "  ◀"
+        print(f"{value:>10} | {recall:9.4f} | {latency_ms:9.3f} | x{flat_ms / max(latency_ms, 1e-9):7.1f}{marker}")
+
+    current = getattr(config, param)
+    print(f"\nТекущее значение {param}: {current}")
+    if recommended is None:
+        print(f"⚠️ Recall {args.target} не достигнут ни при одном значении {param}; увеличьте nlist/M при построении.")
+        return 0
+    print(f"✅ Минимальное {param} для recall@{k} >= {args.target}: {getattr(recommended, param)}")
+    if args.write:
+        save_index_config(args.db, recommended)
+        print(f"💾 Записано в {os.path.join(args.db, 'index_config.json')}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
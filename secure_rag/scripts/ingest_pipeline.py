@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# ingest_pipeline.py - Потоковая сборка базы: загрузка -> очистка -> разбиение -> эмбеддинги -> добавление пакетами с контрольными точками
+import os
+import json
+import uuid
+import shutil
+import logging
+import tempfile
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+from ann_index import IndexConfig, add_vectors, apply_search_params, create_index, save_vector_db
+from delta_segments import clear_deltas, writer_lock
+from lorebook_manifest import clear_manifest
+from parallel_build import StageTimer
+from process_memory import format_memory, process_memory
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = ".ingest_checkpoint"
+STATE_FILE = "state.json"
+SHARD_PREFIX = "shard-"
+VECTORS_FILE = "vectors.npy"
+CHUNKS_FILE = "chunks.jsonl"
+FILES_FILE = "files.json"
+# Чанков в одном пакете эмбеддинга: больше этого в памяти одновременно не бывает
+DEFAULT_BATCH_CHUNKS = 512
+# Сводка прогресса в лог после каждых N пакетов
+PROGRESS_EVERY = 8
+# Векторов на центроид в выборке для обучения IVF
+IVF_TRAIN_POINTS_PER_CENTROID = 256
+
+SplitStream = Callable[[List[str]], Iterator[Tuple[str, list]]]
+
+
+@dataclass
+class IngestResult:
+    vector_db: Optional[FAISS]
+    index_config: IndexConfig
+    files: int  # Обработано файлов за все запуски
+    chunks: int
+    resumed_files: int  # Из них взято из контрольной точки
+    timer: StageTimer
+
+
+def _write_fsynced(path: str, write: Callable):
+    with open(path, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class IngestCheckpoint:
+    """Контрольные точки в db_path/.ingest_checkpoint: append-only шарды, по одному на пакет.
+
+    Шард shard-NNNNNN хранит только свой пакет: векторы (.npy), id, тексты и метаданные
+    чанков (.jsonl) и файлы, ставшие готовыми. Он собирается во временном каталоге и
+    появляется одним os.replace, после чего state.json атомарно получает его номер.
+    Шарды после записанного в state.json - след обрыва и удаляются, поэтому обрыв в
+    любой момент оставляет последнюю целую точку, а запись точки пропорциональна пакету,
+    а не всей базе.
+    """
+
+    def __init__(self, db_path: str, params: dict):
+        self.root = os.path.join(db_path, CHECKPOINT_DIR)
+        self.params = params
+        self.shards = 0  # Номер последнего целого шарда
+
+    @property
+    def state_path(self) -> str:
+        return os.path.join(self.root, STATE_FILE)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.state_path)
+
+    def shard_path(self, number: int) -> str:
+        return os.path.join(self.root, f"{SHARD_PREFIX}{number:06d}")
+
+    def load(self) -> List[str]:
+        """Готовые файлы по целым шардам; [], если точки нет или параметры сборки другие"""
+        self.shards = 0
+        if not self.exists():
+            return []
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state["params"] != self.params:
+                logger.warning("Контрольная точка построена с другими параметрами, сборка начнется заново.")
+                self.clear()
+                return []
+            shards = int(state["shards"])
+            files_done: List[str] = []
+            for number in range(1, shards + 1):
+                with open(os.path.join(self.shard_path(number), FILES_FILE), "r", encoding="utf-8") as f:
+                    files_done.extend(json.load(f))
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Контрольная точка повреждена ({e}), сборка начнется заново.")
+            self.clear()
+            return []
+        self.shards = shards
+        # Недописанные шарды и шарды после отмеченного в state.json - след обрыва
+        for name in os.listdir(self.root):
+            if name.startswith(".shard-") or (name.startswith(SHARD_PREFIX) and int(name[len(SHARD_PREFIX):]) > shards):
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+        return files_done
+
+    def append(self, vectors: Optional[np.ndarray], ids: Sequence[str], texts: Sequence[str],
+               metadatas: Sequence[dict], files: Sequence[str]):
+        """Пишет пакет следующим шардом и отмечает его в state.json"""
+        os.makedirs(self.root, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=".shard-", dir=self.root)
+        try:
+            if vectors is not None and len(vectors):
+                _write_fsynced(os.path.join(tmp_dir, VECTORS_FILE),
+                               lambda f: np.save(f, np.asarray(vectors, dtype=np.float32)))
+            lines = "".join(json.dumps({"id": doc_id, "text": text, "metadata": metadata}, ensure_ascii=False) + "\n"
+                            for doc_id, text, metadata in zip(ids, texts, metadatas))
+            _write_fsynced(os.path.join(tmp_dir, CHUNKS_FILE), lambda f: f.write(lines.encode("utf-8")))
+            _write_fsynced(os.path.join(tmp_dir, FILES_FILE),
+                           lambda f: f.write(json.dumps(list(files), ensure_ascii=False).encode("utf-8")))
+            os.replace(tmp_dir, self.shard_path(self.shards + 1))
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        state = {"params": self.params, "shards": self.shards + 1}
+        tmp_path = self.state_path + ".tmp"
+        _write_fsynced(tmp_path, lambda f: f.write(json.dumps(state, ensure_ascii=False).encode("utf-8")))
+        os.replace(tmp_path, self.state_path)
+        self.shards += 1
+
+    def _shard_vectors(self, number: int) -> Optional[np.ndarray]:
+        path = os.path.join(self.shard_path(number), VECTORS_FILE)
+        return np.load(path, mmap_mode="r") if os.path.exists(path) else None
+
+    def _shard_chunks(self, number: int) -> Tuple[List[str], List[str], List[dict]]:
+        ids, texts, metadatas = [], [], []
+        with open(os.path.join(self.shard_path(number), CHUNKS_FILE), "r", encoding="utf-8") as f:
+            for line in f:
+                chunk = json.loads(line)
+                ids.append(chunk["id"])
+                texts.append(chunk["text"])
+                metadatas.append(chunk["metadata"])
+        return ids, texts, metadatas
+
+    def _train_sample(self, shards: List[Tuple[int, np.ndarray]], size: int) -> np.ndarray:
+        """Равномерная выборка векторов всех шардов (читаются только выбранные строки)"""
+        offsets = np.cumsum([0] + [len(vectors) for _, vectors in shards])
+        positions = np.sort(np.random.default_rng(0).choice(offsets[-1], size=size, replace=False))
+        owners = np.searchsorted(offsets, positions, side="right") - 1
+        return np.vstack([shards[owner][1][positions[owners == owner] - offsets[owner]]
+                          for owner in np.unique(owners)]).astype(np.float32)
+
+    def assemble(self, embeddings, config: IndexConfig) -> Tuple[Optional[FAISS], IndexConfig]:
+        """База из всех шардов: индекс нужного типа строится сразу по всему корпусу
+        (IVF обучается на выборке из всех шардов), шарды читаются по одному"""
+        shards = [(number, vectors) for number in range(1, self.shards + 1)
+                  for vectors in [self._shard_vectors(number)] if vectors is not None]
+        total = sum(len(vectors) for _, vectors in shards)
+        if not total:
+            return None, config
+        index, effective = create_index(config, shards[0][1].shape[1], total)
+        if not index.is_trained:
+            sample_size = min(total, effective.nlist * IVF_TRAIN_POINTS_PER_CENTROID)
+            logger.info(f"Обучение индекса {effective.describe()} на {sample_size} векторах из {total}...")
+            index.train(self._train_sample(shards, sample_size))
+        apply_search_params(index, effective)
+        vector_db = FAISS(embedding_function=embeddings, index=index,
+                          docstore=InMemoryDocstore(), index_to_docstore_id={})
+        for number, vectors in shards:
+            ids, texts, metadatas = self._shard_chunks(number)
+            add_vectors(vector_db, texts, np.asarray(vectors), metadatas, ids)
+        return vector_db, effective
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        self.shards = 0
+
+
+def ingest(files: Iterable[str], split_stream: SplitStream, embeddings, db_path: str, params: dict,
+           index_config: IndexConfig, batch_chunks: int = DEFAULT_BATCH_CHUNKS) -> IngestResult:
+    """Собирает базу в db_path, держа в памяти не больше одного пакета текстов и векторов.
+
+    split_stream(files) выдает (файл, чанки) по одному файлу. Каждый пакет сразу
+    уходит на диск шардом контрольной точки, поэтому память на этапах разбиения и
+    эмбеддингов не растет с корпусом. Файл считается готовым, только когда записан
+    шард со всеми его чанками; после перезапуска с теми же params готовые файлы
+    пропускаются. Индекс и docstore собираются из шардов один раз в конце.
+    """
+    timer = StageTimer()
+    checkpoint = IngestCheckpoint(db_path, params)
+    files_done = checkpoint.load()
+    done = set(files_done)
+    resumed = len(files_done)
+    if resumed:
+        logger.info(f"Продолжение сборки с контрольной точки: готово файлов {resumed}, шардов {checkpoint.shards}")
+    remaining = [path for path in files if path not in done]
+
+    pending_chunks: list = []
+    pending_files: List[str] = []
+    batches = 0
+
+    def flush():
+        nonlocal batches
+        if not pending_files:
+            return
+        texts = [chunk.page_content for chunk in pending_chunks]
+        vectors = None
+        if texts:
+            with timer.stage("Эмбеддинги", log=False):
+                vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+        with timer.stage("Контрольные точки", log=False):
+            checkpoint.append(vectors, [str(uuid.uuid4()) for _ in texts], texts,
+                              [chunk.metadata for chunk in pending_chunks], pending_files)
+        files_done.extend(pending_files)
+        pending_chunks.clear()
+        pending_files.clear()
+        batches += 1
+        if batches % PROGRESS_EVERY == 0:
+            logger.info(f"Контрольная точка: файлов {len(files_done)}, шардов {checkpoint.shards}; "
+                        f"{format_memory(process_memory())}")
+
+    stream = split_stream(remaining)
+    while True:
+        with timer.stage("Загрузка и разбиение", log=False):
+            item = next(stream, None)
+        if item is None:
+            break
+        path, chunks = item
+        pending_chunks.extend(chunks)
+        pending_files.append(path)
+        if len(pending_chunks) >= batch_chunks:
+            flush()
+    flush()
+
+    with timer.stage("Сборка индекса"):
+        vector_db, effective = checkpoint.assemble(embeddings, index_config)
+    if vector_db is not None:
+        # Полная пересборка заменяет основу: дельты и манифест книг прежней основы удаляются под замком писателя,
+        # иначе load_segments наложил бы старые дельты на новую основу (id документов в ней уже другие)
+        with timer.stage("Сохранение"), writer_lock(db_path):
+            clear_deltas(db_path)
+            clear_manifest(db_path)
+            save_vector_db(vector_db, db_path, effective)
+    checkpoint.clear()
+    chunks_total = vector_db.index.ntotal if vector_db is not None else 0
+    logger.info(f"Сборка завершена: файлов {len(files_done)}, чанков {chunks_total}; "
+                f"{format_memory(process_memory())}")
+    return IngestResult(vector_db, effective, len(files_done), chunks_total, resumed, timer)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# lexical_index.py - Лексический индекс BM25: токенизатор для русского текста и инвертированный индекс в CSR-массивах
+import os
+import re
+import json
+from collections import Counter
+from functools import lru_cache
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+from source_index import fingerprint
+
+LEXICAL_META_FILE = "bm25_meta.json"
+LEXICAL_TERMS_FILE = "bm25_terms.npy"
+LEXICAL_OFFSETS_FILE = "bm25_offsets.npy"
+LEXICAL_ROWS_FILE = "bm25_rows.npy"
+LEXICAL_WEIGHTS_FILE = "bm25_weights.npy"
+LEXICAL_VERSION = 1
+# Параметры Okapi BM25 (те же, что по умолчанию в rank_bm25)
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Более длинные токены обрезаются: словарь хранится массивом строк фиксированной ширины
+MAX_TOKEN_LENGTH = 24
+
+TOKEN_PATTERN = re.compile(r"\w+")
+STOPWORDS = frozenset("""
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было вот от
+меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до вас нибудь опять уж вам
+ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя их чем была сам чтоб без будто чего
+раз тоже себе под будет ж тогда кто этот того потому этого какой совсем ним здесь этом один почти мой тем
+чтобы нее сейчас были куда зачем всех никогда можно при наконец два об другой хоть после над больше тот через
+эти нас про всего них какая много разве три эту моя впрочем хорошо свою этой перед иногда лучше чуть том
+нельзя такой им более всегда конечно всю между это
+the a an and or of to in on at is are was were be by for with as it this that from
+""".split())
+
+# Окончания для упрощенного стеммера (если nltk не установлен), от длинных к коротким
+_RUSSIAN_ENDINGS = tuple(sorted(set("""
+ившись ывшись иями ями ами ией ием ого его ому ему ими ыми ее ие ые ое ей ий ый ой ем им ым ом их ых ую юю
+ая яя ою ею ешь ете ишь ите ует уют ют ят ат ет ит ут ила ыла ена ило ыло ено ли ла ло на ны но ов ев ия ья ье
+иям ам ям ах ях ию ью али яли или ыли ала яла ал ял ил ыл а я о е и ы у ю ь й
+""".split()), key=len, reverse=True))
+_MIN_STEM_LENGTH = 3
+
+
+def _suffix_stemmer() -> Callable[[str], str]:
+    def stem(token: str) -> str:
+        for ending in _RUSSIAN_ENDINGS:
+            if token.endswith(ending) and len(token) - len(ending) >= _MIN_STEM_LENGTH:
+                return token[:-len(ending)]
+        return token
+    return stem
+
+
+def make_stemmer() -> Tuple[str, Callable[[str], str]]:
+    """Стеммер Snowball из nltk, если он установлен, иначе упрощенное отсечение окончаний.
+
+    Имя стеммера сохраняется вместе с индексом: индекс, построенный другим стеммером, пересобирается.
+    """
+    try:
+        from nltk.stem.snowball import SnowballStemmer
+    except ImportError:
+        return "suffix", _suffix_stemmer()
+    russian, english = SnowballStemmer("russian"), SnowballStemmer("english")
+
+    def stem(token: str) -> str:
+        return english.stem(token) if token.isascii() else russian.stem(token)
+    return "snowball", stem
+
+
+class Tokenizer:
+    """Нижний регистр, ё -> е, слова по \\w+, без стоп-слов и чисел из одной цифры, со стеммингом"""
+
+    def __init__(self):
+        stemmer_name, stem = make_stemmer()
+        self.name = f"{stemmer_name}-v{LEXICAL_VERSION}"
+        # Формы слов повторяются постоянно, стемминг каждой выполняется один раз
+        self._stem = lru_cache(maxsize=200000)(stem)
+
+    def __call__(self, text: str) -> List[str]:
+        tokens = []
+        for token in TOKEN_PATTERN.findall(text.lower().replace("ё", "е")):
+            if token in STOPWORDS or (len(token) == 1 and not token.isalpha()):
+                continue
+            tokens.append(self._stem(token)[:MAX_TOKEN_LENGTH])
+        return tokens
+
+
+_tokenizer: Optional[Tokenizer] = None
+
+
+def get_tokenizer() -> Tokenizer:
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = Tokenizer()
+    return _tokenizer
+
+
+def _row_doc_ids(vector_db) -> List[str]:
+    # Строки индекса - чанки docstore в порядке меток FAISS (удаленные чанки в него не попадают)
+    return [doc_id for _, doc_id in sorted(vector_db.index_to_docstore_id.items())]
+
+
+class LexicalIndex:
+    """BM25 в виде инвертированного индекса: постинги термина terms[t] - rows/weights[offsets[t]:offsets[t + 1]].
+
+    Вес постинга - готовый вклад BM25 (idf * нормированная частота), поэтому
+    запрос сводится к сумме весов постингов своих терминов: время зависит от
+    длины этих постингов, а не от размера корпуса.
+    """
+
+    def __init__(self, terms: np.ndarray, offsets: np.ndarray, rows: np.ndarray, weights: np.ndarray,
+                 doc_ids: List[str], meta: dict):
+        self.terms = terms
+        self.offsets = offsets
+        self.rows = rows
+        self.weights = weights
+        self.doc_ids = doc_ids
+        self.meta = meta
+        self.tokenizer = get_tokenizer()
+
+    @classmethod
+    def build(cls, vector_db, k1: float = BM25_K1, b: float = BM25_B) -> "LexicalIndex":
+        tokenizer = get_tokenizer()
+        doc_ids = _row_doc_ids(vector_db)
+        vocabulary = {}
+        term_ids, rows, counts = [], [], []
+        lengths = np.zeros(len(doc_ids), dtype=np.float32)
+        for row, doc_id in enumerate(doc_ids):
+            tokens = tokenizer(vector_db.docstore.search(doc_id).page_content)
+            lengths[row] = len(tokens)
+            for token, count in Counter(tokens).items():
+                term_ids.append(vocabulary.setdefault(token, len(vocabulary)))
+                rows.append(row)
+                counts.append(count)
+
+        # Словарь сортируется, чтобы искать термины запроса двоичным поиском
+        terms = np.array(sorted(vocabulary), dtype=f"<U{MAX_TOKEN_LENGTH}")
+        rank = np.empty(len(vocabulary), dtype=np.int64)
+        rank[[vocabulary[term] for term in terms]] = np.arange(len(terms))
+        term_ids = rank[np.asarray(term_ids, dtype=np.int64)]
+        order = np.argsort(term_ids, kind="stable")  # Внутри термина строки остаются по возрастанию
+        term_ids = term_ids[order]
+        rows = np.asarray(rows, dtype=np.int32)[order]
+        tf = np.asarray(counts, dtype=np.float32)[order]
+
+        df = np.bincount(term_ids, minlength=len(terms))
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(df, out=offsets[1:])
+        n = len(doc_ids)
+        avgdl = float(lengths.mean()) if n else 0.0
+        # Неотрицательный idf (как в Lucene): частые термины не штрафуют документ
+        idf = np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        norm = k1 * (1.0 - b + b * lengths[rows] / max(avgdl, 1e-9))
+        weights = (idf[term_ids] * tf * (k1 + 1.0) / (tf + norm)).astype(np.float32)
+
+        meta = {"version": LEXICAL_VERSION, "tokenizer": tokenizer.name, "k1": k1, "b": b,
+                "avgdl": avgdl, "documents": n, "fingerprint": fingerprint(vector_db)}
+        return cls(terms, offsets, rows, weights, doc_ids, meta)
+
+    def save(self, db_path: str):
+        """Массивы пишутся как .npy (читаются через mmap), параметры - JSON последним; каждый файл атомарно"""
+        for name, array in ((LEXICAL_TERMS_FILE, self.terms), (LEXICAL_OFFSETS_FILE, self.offsets),
+                            (LEXICAL_ROWS_FILE, self.rows), (LEXICAL_WEIGHTS_FILE, self.weights)):
+            tmp_path = os.path.join(db_path, name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, os.path.join(db_path, name))
+        tmp_path = os.path.join(db_path, LEXICAL_META_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, os.path.join(db_path, LEXICAL_META_FILE))
+
+    @classmethod
+    def load(cls, db_path: str, vector_db) -> "LexicalIndex":
+        """Индекс с диска через mmap; если его нет, он не совпадает с базой или построен
+        другим токенизатором - строится заново по docstore (и сохраняется)"""
+        try:
+            with open(os.path.join(db_path, LEXICAL_META_FILE), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            terms, offsets, rows, weights = (
+                np.load(os.path.join(db_path, name), mmap_mode="r")
+                for name in (LEXICAL_TERMS_FILE, LEXICAL_OFFSETS_FILE, LEXICAL_ROWS_FILE, LEXICAL_WEIGHTS_FILE)
+            )
+        except (OSError, ValueError):
+            meta = None
+        if (meta is None or meta.get("fingerprint") != fingerprint(vector_db)
+                or meta.get("tokenizer") != get_tokenizer().name
+                or len(offsets) != len(terms) + 1 or not len(rows) == len(weights) == offsets[-1]):
+            print("🔨 Лексический индекс отсутствует или устарел, построение по docstore...")
+            index = cls.build(vector_db)
+            try:
+                index.save(db_path)
+            except OSError as e:
+                print(f"⚠️ Не удалось сохранить лексический индекс: {e}")
+            return index
+        return cls(terms, offsets, rows, weights, _row_doc_ids(vector_db), meta)
+
+    @property
+    def document_count(self) -> int:
+        return len(self.doc_ids)
+
+    def score(self, query: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Строки, содержащие хотя бы один термин запроса, и их оценки BM25 (без сортировки)"""
+        query_terms = Counter(self.tokenizer(query))
+        if not query_terms or not len(self.terms):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        wanted = np.array(list(query_terms), dtype=self.terms.dtype)
+        positions = np.minimum(np.searchsorted(self.terms, wanted), len(self.terms) - 1)
+        rows, weights = [], []
+        for term, position in zip(wanted, positions):
+            if self.terms[position] != term:
+                continue
+            start, end = self.offsets[position], self.offsets[position + 1]
+            rows.append(self.rows[start:end])
+            # Повторенный в запросе термин учитывается столько раз, сколько встречается (как в rank_bm25)
+            weights.append(self.weights[start:end] * query_terms[str(term)])
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        candidates, inverse = np.unique(np.concatenate(rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weights)).astype(np.float32)
+        return candidates.astype(np.int64), scores
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# lorebook_manifest.py - Манифест книг базы (added_lorebooks.json): хэш содержимого и id чанков каждого файла
+import os
+import json
+import hashlib
+import logging
+from typing import Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Поле метаданных чанка с абсолютным путем файла: одноименные книги из разных директорий не смешиваются
+SOURCE_PATH_KEY = "source_path"
+MANIFEST_FILE = "added_lorebooks.json"
+MANIFEST_VERSION = 2
+
+
+def manifest_path(db_path: str) -> str:
+    return os.path.join(db_path, MANIFEST_FILE)
+
+
+def book_key(path: str) -> str:
+    """Ключ книги в манифесте - абсолютный путь без симлинков (имя файла служит только для показа)"""
+    return os.path.realpath(path)
+
+
+def file_hash(path: str) -> str:
+    """sha256 содержимого файла: по нему видно, что книга изменилась"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(db_path: str) -> Dict[str, dict]:
+    """Записи {путь книги: {"hash": ..., "chunk_ids": [...]}}.
+
+    Старый формат (список имен) читается с hash и chunk_ids = None: такие книги
+    при следующем добавлении переиндексируются, а их чанки ищутся по source.
+    В манифестах, записанных до перехода на пути, ключи - имена файлов.
+    """
+    path = manifest_path(db_path)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.error(f"Ошибка чтения манифеста '{path}': {e}. Считаю базу пустой.")
+        return {}
+    if isinstance(data, list):
+        return {name: {"hash": None, "chunk_ids": None} for name in data}
+    return data.get("files", {})
+
+
+def save_manifest(db_path: str, files: Dict[str, dict]):
+    os.makedirs(db_path, exist_ok=True)
+    path = manifest_path(db_path)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": MANIFEST_VERSION, "files": files}, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+    logger.info(f"Манифест книг сохранен в: {path} (книг: {len(files)})")
+
+
+def clear_manifest(db_path: str):
+    """Удаляет манифест книг: после полной пересборки его id чанков больше не существуют"""
+    try:
+        os.remove(manifest_path(db_path))
+        logger.info(f"Манифест книг удален: {manifest_path(db_path)}")
+    except FileNotFoundError:
+        pass
+
+
+def chunk_ids_by_source(stores: Iterable, names: Optional[Iterable[str]] = None) -> Dict[str, List[str]]:
+    """id чанков в docstore каждой базы, сгруппированные по ключу книги (опционально - только names).
+
+    Ключ - metadata["source_path"]; у чанков, добавленных до появления этого поля, - metadata["source"].
+    """
+    wanted = set(names) if names is not None else None
+    grouped: Dict[str, List[str]] = {}
+    for store in stores:
+        for _, doc_id in sorted(store.index_to_docstore_id.items()):
+            metadata = store.docstore.search(doc_id).metadata
+            source = metadata.get(SOURCE_PATH_KEY) or metadata.get("source")
+            if wanted is None or source in wanted:
+                grouped.setdefault(source, []).append(doc_id)
+    return grouped
+
+
+def build_entries(paths: Iterable[str], chunk_ids: Dict[str, List[str]]) -> Dict[str, dict]:
+    """Записи манифеста для файлов, чьи чанки уже в базе (chunk_ids сгруппированы chunk_ids_by_source)"""
+    entries = {}
+    for path in paths:
+        key = book_key(path)
+        entries[key] = {"hash": file_hash(path), "chunk_ids": chunk_ids.get(key, [])}
+    return entries
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# micro_batcher.py - Объединение одновременных запросов в пакеты с выполнением вне event loop
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """Собирает запросы, пришедшие в пределах короткого окна, в один пакет.
+
+    Пакет передается в process_batch (синхронная функция: список элементов ->
+    список результатов в том же порядке), которая выполняется в собственном
+    пуле потоков, поэтому тяжелое кодирование запросов не блокирует event loop.
+    Пока пакет обрабатывается, сборщик уже копит следующий.
+    """
+
+    def __init__(self, process_batch: Callable[[List[Any]], List[Any]],
+                 max_batch_size: int = 32, max_wait_ms: float = 5.0, workers: int = 2):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.workers = workers
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._collector: Optional[asyncio.Task] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._inflight = set()  # Ссылки на задачи пакетов, чтобы их не собрал GC
+        self.batches = 0
+        self.items = 0
+
+    async def start(self):
+        if self._collector is not None:
+            return
+        # Пул создается при каждом запуске: stop() закрывает прежний
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="search")
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.workers)
+        self._collector = asyncio.create_task(self._collect())
+
+    async def stop(self):
+        """Останавливает сборщик; запросы, не попавшие в пакет, завершаются ошибкой, а не висят вечно"""
+        if self._collector is not None:
+            self._collector.cancel()
+            try:
+                await self._collector
+            except asyncio.CancelledError:
+                pass
+            self._collector = None
+        if self._queue is not None:
+            pending = []
+            while not self._queue.empty():
+                pending.append(self._queue.get_nowait())
+            self._queue = None
+            self._fail(pending)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    @staticmethod
+    def _fail(entries: list):
+        for _, future in entries:
+            if not future.done():
+                future.set_exception(RuntimeError("MicroBatcher остановлен"))
+
+    async def submit(self, item: Any) -> Any:
+        """Ставит элемент в очередь и ждет его результата из пакета"""
+        if self._queue is None:
+            raise RuntimeError("MicroBatcher не запущен")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def run(self, func: Callable, *args) -> Any:
+        """Выполняет произвольную синхронную функцию в пуле поиска (для готовых пакетов)"""
+        if self.executor is None:
+            raise RuntimeError("MicroBatcher не запущен")
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            try:
+                while len(batch) < self.max_batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                # Не больше workers пакетов одновременно: остальные продолжают копиться в очереди
+                await self._slots.acquire()
+            except asyncio.CancelledError:
+                # Остановка во время сборки пакета: его запросы уже вынуты из очереди
+                self._fail(batch)
+                raise
+            task = asyncio.create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _dispatch(self, batch: list):
+        items = [item for item, _ in batch]
+        try:
+            results = await self.run(self.process_batch, items)
+            if len(results) != len(items):
+                # Иначе zip молча пропустит лишние запросы, и они будут ждать вечно
+                raise RuntimeError(f"process_batch вернул {len(results)} результатов на {len(items)} запросов")
+            self.batches += 1
+            self.items += len(items)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            logger.error(f"Ошибка обработки пакета из {len(items)} запросов: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._slots.release()
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "workers": self.workers,
+        }
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# parallel_build.py - Параллельная сборка базы: загрузка и разбиение файлов в пуле процессов, эмбеддинги шардами по N воркерам
+import os
+import re
+import time
+import logging
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from langchain_core.embeddings import Embeddings
+from langchain_community.document_loaders import TextLoader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from lorebook_manifest import SOURCE_PATH_KEY, book_key
+
+logger = logging.getLogger(__name__)
+
+# Процессов сборки по умолчанию
+DEFAULT_BUILD_WORKERS = int(os.environ.get("RAG_BUILD_WORKERS", os.cpu_count() or 1))
+# spawn, а не fork: дочерние процессы не наследуют потоки и состояние torch родителя
+_MP_CONTEXT = multiprocessing.get_context("spawn")
+
+
+class StageTimer:
+    """Замер длительности этапов сборки; повторные замеры одного этапа суммируются"""
+
+    def __init__(self):
+        self.stages: "OrderedDict[str, float]" = OrderedDict()
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str, log: bool = True):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+            if log:
+                logger.info(f"Этап '{name}' завершен за {elapsed:.2f} с")
+
+    def report(self) -> str:
+        total = time.perf_counter() - self.started
+        lines = ["Время по этапам:"]
+        for name, elapsed in self.stages.items():
+            share = elapsed / total * 100 if total else 0.0
+            lines.append(f"  {name:<28} {elapsed:8.2f} с  {share:5.1f}%")
+        lines.append(f"  {'Итого':<28} {total:8.2f} с")
+        return "\n".join(lines)
+
+
+# --- Загрузка, очистка и разбиение ---
+
+_TRAILING_SPACES = re.compile(r"[ \t]+\n")
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+
+def clean_text(text: str) -> str:
+    """Единые переводы строк, без хвостовых пробелов и серий пустых строк"""
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = _TRAILING_SPACES.sub("\n", text)
+    return _BLANK_LINES.sub("\n\n", text).strip()
+
+def list_markdown_files(source_dir: str) -> List[str]:
+    files = []
+    for root, _, names in os.walk(source_dir):
+        files.extend(os.path.join(root, name) for name in names if name.endswith(".md"))
+    return sorted(files)
+
+
+def _load_and_split(path: str, chunk_size: int, chunk_overlap: int, separators: Optional[List[str]],
+                    basename_source: bool) -> list:
+    documents = TextLoader(path, encoding="utf-8").load()
+    for doc in documents:
+        doc.page_content = clean_text(doc.page_content)
+        doc.metadata["source"] = os.path.basename(path) if basename_source else path
+        # Ключ книги в манифесте; source может быть только именем файла - для показа
+        doc.metadata[SOURCE_PATH_KEY] = book_key(path)
+    documents = [doc for doc in documents if doc.page_content]
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=separators
+    )
+    return splitter.split_documents(documents)
+
+
+def iter_split_files(files: Iterable[str], chunk_size: int, chunk_overlap: int, workers: int,
+                     separators: Optional[List[str]] = None,
+                     basename_source: bool = True) -> Iterator[Tuple[str, list]]:
+    """Выдает (файл, чанки) в исходном порядке файлов.
+
+    В работе одновременно не больше 2 * workers файлов, поэтому память не растет
+    с размером корпуса, даже если потребитель медленнее разбиения.
+    """
+    if workers <= 1:
+        for path in files:
+            yield path, _load_and_split(path, chunk_size, chunk_overlap, separators, basename_source)
+        return
+    with ProcessPoolExecutor(max_workers=workers, mp_context=_MP_CONTEXT) as pool:
+        window = deque()
+        for path in files:
+            window.append((path, pool.submit(_load_and_split, path, chunk_size, chunk_overlap,
+                                             separators, basename_source)))
+            if len(window) >= 2 * workers:
+                path, future = window.popleft()
+                yield path, future.result()
+        while window:
+            path, future = window.popleft()
+            yield path, future.result()
+
+
+def load_and_split_parallel(source_dir: str, chunk_size: int, chunk_overlap: int, workers: int,
+                            separators: Optional[List[str]] = None,
+                            basename_source: bool = True) -> Tuple[list, List[str]]:
+    """Каждый файл читается и режется на чанки в отдельном процессе; порядок чанков детерминирован.
+
+    Возвращает чанки и список обработанных файлов.
+    """
+    files = list_markdown_files(source_dir)
+    chunks = []
+    for _, file_chunks in iter_split_files(files, chunk_size, chunk_overlap, min(workers, max(len(files), 1)),
+                                           separators, basename_source):
+        chunks.extend(file_chunks)
+    return chunks, files
+
+
+# --- Эмбеддинги ---
+
+def contiguous_shards(count: int, workers: int) -> List[range]:
+    """Индексы текстов, разрезанные на workers подряд идущих шардов почти равного размера"""
+    size = max(1, -(-count // max(1, workers)))
+    return [range(start, min(start + size, count)) for start in range(0, count, size)]
+
+
+_worker_embeddings: Optional[Embeddings] = None
+
+
+def _init_embed_worker(factory: Callable[[], Embeddings], threads: int):
+    global _worker_embeddings
+    try:
+        import torch
+        # Ядра делятся между воркерами, иначе каждый займет все и они будут мешать друг другу
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    _worker_embeddings = factory()
+
+
+def _embed_shard(texts: List[str]) -> List[List[float]]:
+    return _worker_embeddings.embed_documents(texts)
+
+
+def _embed_query(text: str) -> List[float]:
+    return _worker_embeddings.embed_query(text)
+
+
+class ParallelEmbeddings(Embeddings):
+    """Эмбеддинги в N процессах: у каждого своя копия модели и свой непрерывный шард текстов.
+
+    factory - picklable-функция без аргументов, создающая модель
+    (например functools.partial(embedding_backend.create_embeddings, backend="int8")).
+    Пакетирование по длине внутри шарда - дело самой модели (BucketedEmbeddings);
+    векторы шардов склеиваются в исходном порядке текстов.
+    """
+
+    def __init__(self, factory: Callable[[], Embeddings], workers: int = DEFAULT_BUILD_WORKERS):
+        self.factory = factory
+        self.workers = max(1, workers)
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def __enter__(self):
+        threads = max(1, (os.cpu_count() or 1) // self.workers)
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_MP_CONTEXT,
+                                         initializer=_init_embed_worker, initargs=(self.factory, threads))
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        if self._pool is None:
+            raise RuntimeError("ParallelEmbeddings используется вне блока with")
+        futures = [self._pool.submit(_embed_shard, texts[shard.start:shard.stop])
+                   for shard in contiguous_shards(len(texts), self.workers)]
+        return [vector for future in futures for vector in future.result()]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._pool.submit(_embed_query, text).result()
+
+
+def embedding_throughput(n_texts: int, elapsed: float) -> str:
+    return f"{n_texts / elapsed:.1f} чанков/с" if elapsed > 0 else "-"
+
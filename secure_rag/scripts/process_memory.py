@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# process_memory.py - Резидентная память процесса с разделением на общую (page cache, mmap) и частную
+import os
+import resource
+from typing import Dict
+
+_SMAPS_FIELDS = {
+    "Rss": "rss_mb",
+    "Pss": "pss_mb",
+    "Shared_Clean": "shared_mb",
+    "Shared_Dirty": "shared_mb",
+    "Private_Clean": "private_mb",
+    "Private_Dirty": "private_mb",
+}
+
+
+def process_memory(pid: str = "self") -> Dict[str, float]:
+    """RSS, PSS (доля общих страниц, поделенная между процессами), общая и частная память в МБ.
+
+    PSS складывается между воркерами без двойного учета, поэтому именно он
+    показывает, сколько на самом деле стоит еще один процесс с mmap-индексом.
+    """
+    stats = {"pid": os.getpid() if pid == "self" else int(pid)}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                key = _SMAPS_FIELDS.get(name)
+                if key:
+                    stats[key] = stats.get(key, 0.0) + int(value.split()[0]) / 1024
+    except OSError:
+        # Нет smaps_rollup (старое ядро или не Linux): только пиковый RSS
+        stats["rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {key: round(value, 1) if isinstance(value, float) else value for key, value in stats.items()}
+
+
+def format_memory(stats: Dict[str, float]) -> str:
+    parts = [f"RSS {stats['rss_mb']:.0f} МБ"]
+    if "pss_mb" in stats:
+        parts.append(f"PSS {stats['pss_mb']:.0f} МБ")
+        parts.append(f"общая {stats.get('shared_mb', 0.0):.0f} МБ")
+        parts.append(f"частная {stats.get('private_mb', 0.0):.0f} МБ")
+    return f"PID {stats['pid']}: " + ", ".join(parts)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# query_cache.py - Кэши эмбеддингов запросов и результатов поиска с привязкой к поколению индекса
+import re
+import sys
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence
+
+import numpy as np
+
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Нормализация для ключа кэша: схлопываются только пробелы.
+
+    Регистр не трогается: модель эмбеддингов чувствительна к регистру, и запросы,
+    различающиеся только им, получают разные векторы и разные результаты.
+    """
+    return _SPACES.sub(" ", query).strip()
+
+
+def approx_size(obj: Any) -> int:
+    """Грубая оценка занимаемой памяти (байты) для векторов, строк и вложенных коллекций"""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(approx_size(item) for item in obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(approx_size(k) + approx_size(v) for k, v in obj.items())
+    if hasattr(obj, "__dict__"):
+        return sys.getsizeof(obj) + approx_size(vars(obj))
+    return sys.getsizeof(obj)
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш с ограничением по числу записей и учетом памяти"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()  # ключ -> (значение, размер)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.memory_bytes = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or not self._is_fresh(item):
+                if item is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: Hashable, value: Any):
+        size = approx_size(key) + approx_size(value)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = self._make_item(value, size)
+            self.memory_bytes += size
+            while len(self._data) > self.max_entries:
+                self._remove(next(iter(self._data)))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.memory_bytes = 0
+
+    def _remove(self, key: Hashable):
+        item = self._data.pop(key)
+        self.memory_bytes -= item[1]
+
+    def _make_item(self, value: Any, size: int) -> tuple:
+        return (value, size)
+
+    def _is_fresh(self, item: tuple) -> bool:
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "memory_bytes": self.memory_bytes,
+        }
+
+
+class TTLCache(LRUCache):
+    """LRU-кэш, записи которого устаревают через ttl секунд"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        super().__init__(max_entries)
+        self.ttl = ttl
+
+    def _make_item(self, value: Any, size: int) -> tuple:
+        return (value, size, time.monotonic() + self.ttl)
+
+    def _is_fresh(self, item: tuple) -> bool:
+        return item[2] > time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats["ttl_seconds"] = self.ttl
+        return stats
+
+
+class QueryCaches:
+    """Кэш эмбеддингов запросов (LRU) и кэш ранжированных результатов (TTL).
+
+    Оба кэша сбрасываются, как только сервер публикует новое поколение индекса.
+    """
+
+    def __init__(self, max_embeddings: int = 10000, max_results: int = 5000, results_ttl: float = 300.0):
+        self.embeddings = LRUCache(max_embeddings)
+        self.results = TTLCache(max_results, results_ttl)
+        self.generation: Optional[Hashable] = None
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def sync_generation(self, generation: Hashable):
+        """Сбрасывает кэши, если поколение индекса изменилось"""
+        with self._lock:
+            if generation == self.generation:
+                return
+            if self.generation is not None:
+                self.invalidations += 1
+            self.generation = generation
+            self.embeddings.clear()
+            self.results.clear()
+
+    def embed_queries(self, queries: Sequence[str],
+                      embed_many: Callable[[List[str]], List[List[float]]]) -> List[np.ndarray]:
+        """Векторы запросов из кэша; промахи считаются одним пакетным вызовом embed_many"""
+        keys = [normalize_query(q) for q in queries]
+        vectors: Dict[str, np.ndarray] = {}
+        missing: Dict[str, str] = {}
+        for key, query in zip(keys, queries):
+            if key in vectors or key in missing:
+                continue
+            vector = self.embeddings.get(key)
+            if vector is None:
+                missing[key] = query
+            else:
+                vectors[key] = vector
+        if missing:
+            computed = embed_many(list(missing.values()))
+            for key, vector in zip(missing.keys(), computed):
+                vector = np.asarray(vector, dtype=np.float32)
+                self.embeddings.put(key, vector)
+                vectors[key] = vector
+        return [vectors[key] for key in keys]
+
+    @staticmethod
+    def result_key(generation: Hashable, query: str, *params: Hashable) -> tuple:
+        # Поколение входит в ключ: запрос, начатый на старом снимке, не засорит кэш нового
+        return (generation, normalize_query(query)) + params
+
+    def stats(self) -> Dict[str, Any]:
+        embeddings, results = self.embeddings.stats(), self.results.stats()
+        return {
+            "generation": self.generation,
+            "invalidations": self.invalidations,
+            "query_embeddings": embeddings,
+            "results": results,
+            "memory_bytes": embeddings["memory_bytes"] + results["memory_bytes"],
+        }
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# request_metrics.py - Замер этапов запроса (спаны), гистограммы в текстовом формате Prometheus для /metrics
+# и сквозной trace id между веб-приложением и RAG API
+import json
+import time
+import uuid
+import bisect
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence
+
+# Заголовок, в котором trace id передается между сервисами и возвращается клиенту
+TRACE_HEADER = "X-Trace-Id"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Границы корзин гистограмм, секунд: от поиска по индексу (доли мс) до генерации ответа (минуты)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                   60.0, 120.0)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200)
+# Поступивший извне trace id длиннее этого заменяется своим: он попадает в логи и заголовки ответов
+MAX_TRACE_ID_LENGTH = 64
+
+_trace_id: ContextVar[Optional[str]] = ContextVar("trace_id", default=None)
+# Спаны текущего запроса (этап -> секунды); None вне запроса, например в пуле пакетного поиска
+_spans: ContextVar[Optional[Dict[str, float]]] = ContextVar("spans", default=None)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Histogram:
+    """Гистограмма с метками: число наблюдений по корзинам, сумма и количество (как prometheus_client)"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[tuple, list] = {}  # Значения меток -> [счетчики корзин..., +Inf, сумма]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        position = bisect.bisect_left(self.buckets, value)  # Корзина le - наблюдения <= границы
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[position] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        for labels, series in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_number(bound)
+                bucket_labels = _format_labels(self.labelnames, labels, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_number(series[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, *labels: str):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        lines.extend(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_number(value)}"
+                     for labels, value in values)
+        return lines
+
+
+REQUEST_SECONDS = Histogram("rag_request_duration_seconds", "Время обработки HTTP-запроса",
+                            ("method", "path", "status"))
+STAGE_SECONDS = Histogram("rag_stage_duration_seconds", "Время этапа обработки запроса", ("stage",))
+TOKENS_PER_SECOND = Histogram("rag_generation_tokens_per_second", "Скорость генерации ответа LLM, токенов в секунду",
+                              buckets=TOKENS_PER_SECOND_BUCKETS)
+GENERATED_TOKENS = Counter("rag_generated_tokens_total", "Токенов, сгенерированных LLM")
+METRICS = (REQUEST_SECONDS, STAGE_SECONDS, TOKENS_PER_SECOND, GENERATED_TOKENS)
+
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def current_trace_id() -> Optional[str]:
+    return _trace_id.get()
+
+
+def trace_headers() -> Dict[str, str]:
+    """Заголовки для запроса к другому сервису в рамках текущего запроса"""
+    trace_id = _trace_id.get()
+    return {TRACE_HEADER: trace_id} if trace_id else {}
+
+
+def observe_stage(stage: str, seconds: float):
+    """Длительность этапа в гистограмму и в спаны текущего запроса (повторы этапа суммируются)"""
+    STAGE_SECONDS.observe(seconds, stage)
+    spans = _spans.get()
+    if spans is not None:
+        spans[stage] = spans.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def span(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+def record_generation(tokens: int, seconds: float):
+    """Скорость генерации LLM: токены ответа за время от первого до последнего токена"""
+    if tokens <= 0:
+        return
+    GENERATED_TOKENS.inc(tokens)
+    if seconds > 0:
+        TOKENS_PER_SECOND.observe(tokens / seconds)
+
+
+def format_trace(**fields) -> str:
+    """Структурная запись о запросе: trace id, переданные поля и спаны в миллисекундах (одна строка JSON)"""
+    spans = _spans.get() or {}
+    record = {"trace_id": _trace_id.get(), **fields,
+              "spans_ms": {stage: round(seconds * 1000, 2) for stage, seconds in spans.items()}}
+    return json.dumps(record, ensure_ascii=False)
+
+
+def instrument(app, log: Optional[Callable[[str], None]] = print):
+    """Подключает к FastAPI-приложению /metrics и middleware запросов.
+
+    Middleware берет trace id из заголовка X-Trace-Id (или создает новый),
+    возвращает его в ответе, меряет время запроса и, если за запрос были
+    замерены этапы, пишет в log строку format_trace. Поток SSE к этому
+    моменту еще не сгенерирован - его спаны пишет сам обработчик.
+    """
+    from fastapi import Request
+    from fastapi.responses import PlainTextResponse
+
+    @app.middleware("http")
+    async def trace_requests(request: Request, call_next):
+        trace_id = request.headers.get(TRACE_HEADER, "")
+        if not 0 < len(trace_id) <= MAX_TRACE_ID_LENGTH:
+            trace_id = new_trace_id()
+        trace_token = _trace_id.set(trace_id)
+        spans_token = _spans.set({})
+        started = time.perf_counter()
+        try:
+            response = await call_next(request)
+            elapsed = time.perf_counter() - started
+            # Шаблон маршрута, а не фактический путь: число серий не растет с разнообразием запросов
+            route = request.scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            if path != "/metrics":
+                REQUEST_SECONDS.observe(elapsed, request.method, path, str(response.status_code))
+                streaming = response.headers.get("content-type", "").startswith("text/event-stream")
+                if log is not None and _spans.get() and not streaming:
+                    log(f"🧭 {format_trace(path=path, status=response.status_code, total_ms=round(elapsed * 1000, 2))}")
+            response.headers[TRACE_HEADER] = trace_id
+            return response
+        finally:
+            _spans.reset(spans_token)
+            _trace_id.reset(trace_token)
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def metrics():
+        """Гистограммы этапов и запросов в текстовом формате Prometheus"""
+        return PlainTextResponse(render_metrics(), media_type=CONTENT_TYPE)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# reranker.py - Переранжирование кандидатов кросс-энкодером на CPU: пакеты пар, кэш оценок, бюджет времени
+import time
+import hashlib
+import threading
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from query_cache import LRUCache, normalize_query
+
+
+def pair_key(query: str, text: str) -> tuple:
+    # Текст чанка хэшируется: ключ не держит в памяти копию чанка
+    return (normalize_query(query), hashlib.sha1(text.encode("utf-8")).digest())
+
+
+class CrossEncoderReranker:
+    """Оценивает пары (запрос, чанк) локальным кросс-энкодером (sentence-transformers CrossEncoder).
+
+    Модель загружается при первом использовании. Пары всех запросов пакета
+    кодируются вместе пакетами по batch_size; оценки пар кэшируются, поэтому
+    повторный запрос с теми же кандидатами не обращается к модели.
+    """
+
+    def __init__(self, model_path: str, batch_size: int = 16, max_length: int = 512,
+                 cache_size: int = 50000, device: str = "cpu"):
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.device = device
+        self.cache = LRUCache(cache_size)
+        self._model = None
+        self._load_lock = threading.Lock()
+        # Модель и так занимает все ядра: параллельные вызовы только мешали бы друг другу
+        self._predict_lock = threading.Lock()
+        self.pairs_scored = 0
+        self.batches = 0
+        self.model_seconds = 0.0
+        self.timeouts = 0
+        self._pair_seconds = 0.0  # Скользящее среднее времени модели на одну пару
+
+    @property
+    def model(self):
+        with self._load_lock:
+            if self._model is None:
+                from sentence_transformers import CrossEncoder
+                print(f"🔄 Загрузка модели переранжирования (локально): {self.model_path}...")
+                self._model = CrossEncoder(self.model_path, max_length=self.max_length, device=self.device)
+            return self._model
+
+    def _predict(self, pairs: List[tuple]) -> np.ndarray:
+        model = self.model
+        with self._predict_lock:
+            started = time.perf_counter()
+            scores = model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+            elapsed = time.perf_counter() - started
+            self.model_seconds += elapsed
+            per_pair = elapsed / max(len(pairs), 1)
+            self._pair_seconds = per_pair if not self.batches else 0.7 * self._pair_seconds + 0.3 * per_pair
+        self.pairs_scored += len(pairs)
+        self.batches += 1
+        return np.asarray(scores, dtype=np.float32).reshape(-1)
+
+    def score_batch(self, queries: Sequence[str], candidates: Sequence[Sequence[str]],
+                    budget_seconds: Optional[float] = None) -> List[Optional[np.ndarray]]:
+        """Оценки кандидатов каждого запроса (больше - релевантнее).
+
+        Если бюджет времени исчерпан, для еще не оцененных запросов возвращается
+        None - вызывающий оставляет порядок первого этапа. Оценки уже
+        посчитанных пакетов остаются в кэше и пригодятся следующему запросу.
+        """
+        deadline = time.monotonic() + budget_seconds if budget_seconds is not None else None
+        scores = [np.empty(len(texts), dtype=np.float32) for texts in candidates]
+        # Некэшированные пары всех запросов: ключ -> места в выдачах (дубликаты оцениваются один раз)
+        pending: Dict[tuple, List[tuple]] = {}
+        texts_by_key: Dict[tuple, tuple] = {}
+        for i, (query, texts) in enumerate(zip(queries, candidates)):
+            for j, text in enumerate(texts):
+                key = pair_key(query, text)
+                cached = self.cache.get(key) if key not in pending else None
+                if cached is not None:
+                    scores[i][j] = cached
+                    continue
+                pending.setdefault(key, []).append((i, j))
+                texts_by_key[key] = (query, text)
+
+        # Запрос считается оцененным, только когда готовы все его пары
+        remaining = [0] * len(candidates)
+        for places in pending.values():
+            for i, _ in places:
+                remaining[i] += 1
+        keys = list(pending)
+        for start in range(0, len(keys), self.batch_size):
+            batch = keys[start:start + self.batch_size]
+            # Следующий пакет не начинается, если по средней скорости модели он не уложится в остаток бюджета.
+            # Первый пакет выполняется всегда, иначе после одного медленного вызова оценка не обновилась бы
+            if start and deadline is not None and time.monotonic() + self._pair_seconds * len(batch) > deadline:
+                self.timeouts += 1
+                break
+            for key, score in zip(batch, self._predict([texts_by_key[key] for key in batch])):
+                self.cache.put(key, float(score))
+                for i, j in pending[key]:
+                    scores[i][j] = score
+                    remaining[i] -= 1
+        return [row if remaining[i] == 0 else None for i, row in enumerate(scores)]
+
+    def stats(self) -> dict:
+        return {
+            "model": self.model_path,
+            "loaded": self._model is not None,
+            "pairs_scored": self.pairs_scored,
+            "batches": self.batches,
+            "model_seconds": round(self.model_seconds, 3),
+            "timeouts": self.timeouts,
+            "pair_cache": self.cache.stats(),
+        }
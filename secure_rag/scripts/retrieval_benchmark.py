@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# retrieval_benchmark.py - Бенчмарк поиска: построение и загрузка базы, память, задержки p50/p95/p99, QPS под нагрузкой
+# и recall@k относительно точного поиска; результат в JSON и сравнение с прошлым прогоном
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import platform
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+
+from ann_index import (IndexConfig, INDEX_TYPES, build_vector_db_from_vectors, load_index_config,
+                       reconstruct_all, save_vector_db, search_live)
+from delta_segments import SegmentedStore, load_segments
+from embedding_backend import EMBEDDING_BACKEND, BACKENDS, create_embeddings, describe_backend
+from index_recall import recall_at_k
+from process_memory import process_memory
+
+# Синтетический корпус: слова из случайных слогов с частотами по закону Ципфа, как в живом тексте
+SYNTHETIC_VOCABULARY = 20000
+SYNTHETIC_ZIPF = 1.1
+SYNTHETIC_WORDS = (40, 160)  # Длина чанка в словах
+SYNTHETIC_SOURCES = 200
+QUERY_WORDS = (3, 8)  # Запрос - отрывок случайного чанка
+_SYLLABLES = ("ка", "ро", "ми", "ле", "ту", "на", "сво", "пра", "де", "ло", "ви", "за", "бе", "го", "ны", "ст",
+              "ар", "ин", "ол", "ер", "ус", "ям", "ох", "ре")
+# Кто из показателей лучше меньшим, а кто большим значением (для проверки регрессии)
+LOWER_IS_BETTER = ("embed_seconds", "build_seconds", "save_seconds", "load_seconds", "index_mb", "rss_mb",
+                   "pss_mb", "peak_rss_mb", "query_embed_p50_ms", "search_p50_ms", "search_p95_ms",
+                   "search_p99_ms")
+HIGHER_IS_BETTER = ("embed_docs_per_second", "qps")
+RECALL_METRIC = "recall_at_k"
+# Изменения меньше этих абсолютных величин считаются шумом замера, а не регрессией (по суффиксу имени показателя)
+NOISE_FLOOR = {"_seconds": 0.1, "_ms": 0.05, "_mb": 5.0}
+
+
+def synthetic_corpus(n: int, seed: int = 0) -> List[Document]:
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(2, 5, size=SYNTHETIC_VOCABULARY)
+    vocabulary = ["".join(rng.choice(_SYLLABLES, size=length)) for length in lengths]
+    weights = 1.0 / np.arange(1, SYNTHETIC_VOCABULARY + 1) ** SYNTHETIC_ZIPF
+    weights /= weights.sum()
+    documents = []
+    for i in range(n):
+        words = rng.choice(SYNTHETIC_VOCABULARY, size=rng.integers(*SYNTHETIC_WORDS), p=weights)
+        documents.append(Document(page_content=" ".join(vocabulary[w] for w in words),
+                                  metadata={"source": f"synthetic_{i % SYNTHETIC_SOURCES:04d}.md"}))
+    return documents
+
+
+def corpus_from_dir(source_dir: str, chunk_size: int, chunk_overlap: int, limit: int) -> List[Document]:
+    from parallel_build import DEFAULT_BUILD_WORKERS, iter_split_files, list_markdown_files
+    files = list_markdown_files(source_dir)
+    documents = []
+    for _, chunks in iter_split_files(files, chunk_size, chunk_overlap, min(DEFAULT_BUILD_WORKERS, max(len(files), 1))):
+        documents.extend(chunks)
+        if limit and len(documents) >= limit:
+            return documents[:limit]
+    return documents
+
+
+def sample_queries(texts: List[str], n: int, seed: int = 0) -> List[str]:
+    """Отрывки случайных чанков: у каждого запроса есть хотя бы один заведомо релевантный чанк"""
+    rng = np.random.default_rng(seed + 1)
+    queries = []
+    for row in rng.choice(len(texts), size=n, replace=len(texts) < n):
+        words = texts[row].split()
+        size = min(len(words), int(rng.integers(*QUERY_WORDS)))
+        start = int(rng.integers(0, len(words) - size + 1)) if words else 0
+        queries.append(" ".join(words[start:start + size]) or texts[row][:100])
+    return queries
+
+
+def load_embeddings(backend: str):
+    """Модель эмбеддингов; если ее нет (не скачана, не установлены библиотеки, не отвечает Ollama) -
+    детерминированные fake-векторы, чтобы бенчмарк индекса запускался где угодно"""
+    if backend != "fake":
+        try:
+            embeddings = create_embeddings(backend)
+            embeddings.embed_query("проверка")
+            return backend, embeddings
+        except Exception as e:
+            print(f"⚠️ Бэкенд {describe_backend(backend)} недоступен ({type(e).__name__}: {e}), используются fake-векторы")
+    return "fake", create_embeddings("fake")
+
+
+def percentiles(samples_ms: List[float], prefix: str) -> Dict[str, float]:
+    values = np.percentile(np.asarray(samples_ms), (50, 95, 99))
+    return {f"{prefix}_p{p}_ms": round(float(v), 4) for p, v in zip((50, 95, 99), values)}
+
+
+def concurrent_qps(store: SegmentedStore, vectors: np.ndarray, k: int, concurrency: int, duration: float) -> float:
+    """Запросов в секунду, когда concurrency потоков непрерывно ищут по базе (FAISS отпускает GIL)"""
+    deadline = time.perf_counter() + duration
+
+    def worker(offset: int) -> int:
+        done = 0
+        while time.perf_counter() < deadline:
+            row = (offset + done) % len(vectors)
+            store.search(vectors[row:row + 1], k)
+            done += 1
+        return done
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        total = sum(pool.map(worker, range(0, concurrency * 7919, 7919)))
+    return total / (time.perf_counter() - started)
+
+
+def exact_recall(vector_db, queries: np.ndarray, k: int) -> float:
+    """recall@k основного индекса относительно точного flat-поиска по тем же векторам (без надгробий HNSW)"""
+    labels, vectors = reconstruct_all(vector_db.index)
+    live = np.isin(labels, np.fromiter(vector_db.index_to_docstore_id, dtype=np.int64))
+    labels, vectors = labels[live], vectors[live]
+    k = min(k, len(labels))
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+    _, found = search_live(vector_db, queries, k)
+    return recall_at_k(found, labels[truth])
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_benchmark(args) -> dict:
+    backend, embeddings = load_embeddings(args.backend)
+    metrics: Dict[str, float] = {}
+    work_dir = None
+    if args.db:
+        db_path = args.db
+        print(f"📂 Существующая база: {db_path}")
+    else:
+        if args.corpus:
+            print(f"📚 Корпус: {args.corpus} (чанки {args.chunk_size}/{args.chunk_overlap})")
+            documents = corpus_from_dir(args.corpus, args.chunk_size, args.chunk_overlap, args.synthetic)
+        else:
+            print(f"🧪 Синтетический корпус: {args.synthetic} чанков")
+            documents = synthetic_corpus(args.synthetic, args.seed)
+        if not documents:
+            raise ValueError("Корпус пуст")
+
+        started = time.perf_counter()
+        vectors = embeddings.embed_documents([doc.page_content for doc in documents])
+        metrics["embed_seconds"] = round(time.perf_counter() - started, 3)
+        metrics["embed_docs_per_second"] = round(len(documents) / max(metrics["embed_seconds"], 1e-9), 1)
+        print(f"🧮 Эмбеддинги: {len(documents)} чанков за {metrics['embed_seconds']} с")
+
+        config = IndexConfig(index_type=args.index, nlist=args.nlist, nprobe=args.nprobe, ef_search=args.ef_search)
+        started = time.perf_counter()
+        vector_db, config = build_vector_db_from_vectors(documents, vectors, embeddings, config)
+        metrics["build_seconds"] = round(time.perf_counter() - started, 3)
+        print(f"🔨 Индекс {config.describe()} построен за {metrics['build_seconds']} с")
+
+        work_dir = tempfile.mkdtemp(prefix="rag-bench-", dir=args.work_dir)
+        db_path = os.path.join(work_dir, "vector_db")
+        started = time.perf_counter()
+        save_vector_db(vector_db, db_path, config)
+        metrics["save_seconds"] = round(time.perf_counter() - started, 3)
+        del vector_db, vectors
+
+    try:
+        started = time.perf_counter()
+        # Основа и дельты, как их загружает сервер; поиск пропускает надгробия удаленных документов HNSW
+        store = load_segments(db_path, embeddings, mmap=args.mmap)
+        metrics["load_seconds"] = round(time.perf_counter() - started, 3)
+        config = load_index_config(db_path)
+        index = store.base.index
+        if index.ntotal == 0:
+            raise ValueError("База пуста")
+        if index.d != len(embeddings.embed_query("проверка")):
+            raise ValueError(f"Размерность базы ({index.d}) не совпадает с бэкендом {backend}; "
+                             f"укажите --backend, которым строилась база")
+        metrics["index_mb"] = round(os.path.getsize(os.path.join(db_path, "index.faiss")) / 2 ** 20, 2)
+        metrics.update({key: value for key, value in process_memory().items() if key in ("rss_mb", "pss_mb")})
+        print(f"📥 Загрузка {metrics['load_seconds']} с, индекс {metrics['index_mb']} МБ")
+
+        texts = [segment.docstore.search(doc_id).page_content
+                 for segment in store.segments for doc_id in segment.index_to_docstore_id.values()]
+        if args.queries_file:
+            with open(args.queries_file, "r", encoding="utf-8") as f:
+                queries = [line.strip() for line in f if line.strip()]
+        else:
+            queries = sample_queries(texts, args.queries, args.seed)
+        k = min(args.k, len(texts))
+
+        # Одиночные запросы по одному: эмбеддинг запроса и поиск по базе меряются отдельно
+        embed_ms, search_ms, query_vectors = [], [], []
+        for query in queries:
+            started = time.perf_counter()
+            vector = embeddings.embed_query(query)
+            embed_ms.append((time.perf_counter() - started) * 1000)
+            started = time.perf_counter()
+            store.search(np.asarray([vector], dtype=np.float32), k)
+            search_ms.append((time.perf_counter() - started) * 1000)
+            query_vectors.append(vector)
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        metrics["query_embed_p50_ms"] = round(float(np.median(embed_ms)), 4)
+        metrics.update(percentiles(search_ms, "search"))
+        print(f"⏱️ Поиск: p50 {metrics['search_p50_ms']} мс, p95 {metrics['search_p95_ms']} мс, "
+              f"p99 {metrics['search_p99_ms']} мс (эмбеддинг запроса p50 {metrics['query_embed_p50_ms']} мс)")
+
+        metrics["qps"] = round(concurrent_qps(store, query_vectors, k, args.concurrency, args.duration), 1)
+        print(f"🚀 Потоков: {args.concurrency}, {metrics['qps']} запросов/с")
+
+        metrics[RECALL_METRIC] = round(exact_recall(store.base, query_vectors, k), 4)
+        print(f"🎯 recall@{k} относительно точного поиска: {metrics[RECALL_METRIC]}")
+        metrics["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+        meta = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": git_commit(),
+            "host": platform.node(),
+            "cpu_count": os.cpu_count(),
+            "corpus": args.db or args.corpus or "synthetic",
+            "documents": len(texts),
+            "dimension": index.d,
+            "queries": len(queries),
+            "k": k,
+            "backend": backend,
+            "index": asdict(config),
+            "mmap": args.mmap,
+            "concurrency": args.concurrency,
+        }
+        return {"meta": meta, "metrics": metrics}
+    finally:
+        if work_dir and not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def compare(current: dict, baseline: dict, threshold: float, recall_tolerance: float) -> List[Tuple[str, str]]:
+    """Показатели, ухудшившиеся относительно baseline больше допустимого: (имя, описание).
+
+    Времена, память и QPS сравниваются относительно (threshold - доля), recall - абсолютно;
+    рост времени или памяти в пределах NOISE_FLOOR регрессией не считается.
+    """
+    regressions = []
+    old, new = baseline.get("metrics", {}), current["metrics"]
+    for key in ("corpus", "documents", "k", "backend", "index", "mmap", "concurrency"):
+        if baseline.get("meta", {}).get(key) != current["meta"].get(key):
+            print(f"⚠️ Прогоны не сравнимы напрямую: {key} = {baseline.get('meta', {}).get(key)} -> {current['meta'].get(key)}")
+    for name in sorted(set(old) & set(new)):
+        before, after = old[name], new[name]
+        if name == RECALL_METRIC:
+            worse = after < before - recall_tolerance
+        elif name in LOWER_IS_BETTER:
+            noise = next((floor for suffix, floor in NOISE_FLOOR.items() if name.endswith(suffix)), 0.0)
+            worse = after > before * (1 + threshold) and after - before > noise
+        elif name in HIGHER_IS_BETTER:
+            worse = after < before * (1 - threshold)
+        else:
+            continue
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+        print(f"{'❌' if worse else '  '} {name:>22}: {before:>12} -> {after:<12} ({change})")
+        if worse:
+            regressions.append((name, f"{before} -> {after}"))
+    return regressions
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Бенчмарк векторного поиска (скорость, память, recall@k)")
+    corpus = parser.add_mutually_exclusive_group()
+    corpus.add_argument("--corpus", help="Каталог с .md файлами (реальный корпус)")
+    corpus.add_argument("--db", help="Готовая векторная база (только загрузка и поиск)")
+    parser.add_argument("--synthetic", type=int, default=10000,
+                        help="Размер синтетического корпуса в чанках (для --corpus - предел числа чанков, 0 - все)")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--chunk-overlap", type=int, default=50)
+    parser.add_argument("--backend", default=EMBEDDING_BACKEND, choices=BACKENDS,
+                        help="Бэкенд эмбеддингов; недоступная модель заменяется fake")
+    parser.add_argument("--index", default=IndexConfig.from_env().index_type, choices=INDEX_TYPES)
+    parser.add_argument("--nlist", type=int, default=0)
+    parser.add_argument("--nprobe", type=int, default=IndexConfig.nprobe)
+    parser.add_argument("--ef-search", type=int, default=IndexConfig.ef_search)
+    parser.add_argument("--mmap", action="store_true", help="Загружать индекс через mmap, как сервер")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=300, help="Число запросов-отрывков из корпуса")
+    parser.add_argument("--queries-file", help="Файл с запросами (по одному на строку)")
+    parser.add_argument("--concurrency", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--duration", type=float, default=5.0, help="Длительность замера QPS, с")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", help="Где строить временную базу (по умолчанию - системный tmp)")
+    parser.add_argument("--keep", action="store_true", help="Не удалять временную базу")
+    parser.add_argument("--output", help="Записать результат в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для проверки регрессии")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Допустимое относительное ухудшение времен, памяти и QPS")
+    parser.add_argument("--recall-tolerance", type=float, default=0.01, help="Допустимое падение recall@k")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    try:
+        result = run_benchmark(args)
+    except (OSError, ValueError) as e:
+        print(f"❌ Ошибка бенчмарка: {e}")
+        return 2
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 Результат записан в {args.output}")
+    else:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"\n📊 Сравнение с {args.baseline} (commit {baseline.get('meta', {}).get('commit')}):")
+        regressions = compare(result, baseline, args.threshold, args.recall_tolerance)
+        if regressions:
+            print(f"❌ Регрессия: {', '.join(name for name, _ in regressions)}")
+            return 1
+        print("✅ Регрессий нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# source_index.py - Индекс источник -> метки FAISS (CSR-массивы рядом с базой) и поиск только по подмножеству меток
+import os
+import json
+import threading
+from typing import List, Sequence, Tuple
+
+import faiss
+import numpy as np
+
+SOURCE_INDEX_FILE = "source_index.json"
+SOURCE_LABELS_FILE = "source_labels.npy"
+SOURCE_OFFSETS_FILE = "source_offsets.npy"
+# До стольких векторов подмножество перебирается точно (время пропорционально размеру подмножества);
+# больше - поиск по индексу с IDSelector, недобравшие k запросы дорешиваются точным перебором
+EXACT_SUBSET_LIMIT = 50000
+# Векторов подмножества, восстанавливаемых за один шаг точного перебора (ограничивает память)
+EXACT_BLOCK_SIZE = 4096
+
+_direct_map_lock = threading.Lock()
+# SearchParameters с IDSelector, reconstruct_batch и faiss.knn появились в FAISS 1.7.3; на более старых
+# версиях (faiss-gpu==1.7.2 из requirements.txt) подмножество всегда перебирается точно
+HAS_SEARCH_PARAMS = hasattr(faiss, "SearchParameters")
+
+
+def fingerprint(vector_db) -> list:
+    """Число документов и наибольшая метка: новые метки всегда больше прежних, поэтому
+    любое добавление или удаление меняет отпечаток"""
+    mapping = vector_db.index_to_docstore_id
+    return [len(mapping), max(mapping, default=-1)]
+
+
+class SourceIndex:
+    """Метки FAISS каждого источника в формате CSR: labels[offsets[i]:offsets[i + 1]] - метки sources[i]"""
+
+    def __init__(self, sources: List[str], offsets: np.ndarray, labels: np.ndarray, fingerprint: list):
+        self.sources = sources
+        self.offsets = offsets
+        self.labels = labels
+        self.fingerprint = fingerprint
+        self._positions = {source: i for i, source in enumerate(sources)}
+
+    @classmethod
+    def build(cls, vector_db) -> "SourceIndex":
+        grouped = {}
+        for label, doc_id in vector_db.index_to_docstore_id.items():
+            doc = vector_db.docstore.search(doc_id)
+            source = doc.metadata.get("source") if not isinstance(doc, str) else None
+            grouped.setdefault(source, []).append(label)
+        sources = sorted(source for source in grouped if source is not None)
+        sizes = [len(grouped[source]) for source in sources]
+        offsets = np.zeros(len(sources) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        labels = (np.concatenate([np.sort(np.asarray(grouped[source], dtype=np.int64)) for source in sources])
+                  if sources else np.empty(0, dtype=np.int64))
+        return cls(sources, offsets, labels, fingerprint(vector_db))
+
+    def save(self, db_path: str):
+        """Массивы пишутся как .npy (читаются через mmap), список источников - JSON; каждый файл атомарно"""
+        for name, array in ((SOURCE_LABELS_FILE, self.labels), (SOURCE_OFFSETS_FILE, self.offsets)):
+            tmp_path = os.path.join(db_path, name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, os.path.join(db_path, name))
+        tmp_path = os.path.join(db_path, SOURCE_INDEX_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"fingerprint": self.fingerprint, "sources": self.sources}, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(db_path, SOURCE_INDEX_FILE))
+
+    @classmethod
+    def load(cls, db_path: str, vector_db) -> "SourceIndex":
+        """Индекс с диска; для баз без него или не совпадающего с базой - строится по docstore"""
+        try:
+            with open(os.path.join(db_path, SOURCE_INDEX_FILE), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            labels = np.load(os.path.join(db_path, SOURCE_LABELS_FILE), mmap_mode="r")
+            offsets = np.load(os.path.join(db_path, SOURCE_OFFSETS_FILE), mmap_mode="r")
+        except (OSError, ValueError):
+            return cls.build(vector_db)
+        if meta.get("fingerprint") != fingerprint(vector_db) or len(offsets) != len(meta["sources"]) + 1:
+            return cls.build(vector_db)
+        return cls(meta["sources"], offsets, labels, meta["fingerprint"])
+
+    def labels_for(self, sources: Sequence[str]) -> np.ndarray:
+        """Метки всех чанков указанных источников"""
+        parts = []
+        for source in sources:
+            i = self._positions.get(source)
+            if i is not None:
+                parts.append(np.asarray(self.labels[self.offsets[i]:self.offsets[i + 1]]))
+        if not parts:
+            return np.empty(0, dtype=np.int64)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+def reconstruct_labels(index: faiss.Index, labels: np.ndarray) -> np.ndarray:
+    """Векторы по меткам; для IVF один раз строится хэш-таблица метка -> позиция в списке"""
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        ivf = None
+    if ivf is not None and ivf.direct_map.type != faiss.DirectMap.Hashtable:
+        with _direct_map_lock:
+            if ivf.direct_map.type != faiss.DirectMap.Hashtable:
+                ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+    labels = np.ascontiguousarray(labels, dtype=np.int64)
+    if hasattr(index, "reconstruct_batch"):
+        return index.reconstruct_batch(labels)
+    vectors = np.empty((len(labels), index.d), dtype=np.float32)
+    for i, label in enumerate(labels):
+        vectors[i] = index.reconstruct(int(label))
+    return vectors
+
+
+def _knn(vectors: np.ndarray, base: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    if hasattr(faiss, "knn"):
+        return faiss.knn(vectors, base, k)
+    flat = faiss.IndexFlatL2(base.shape[1])
+    flat.add(base)
+    return flat.search(vectors, k)
+
+
+def exact_subset_search(index: faiss.Index, vectors: np.ndarray, k: int,
+                        labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Точный top-k по L2 только среди векторов labels, блоками по EXACT_BLOCK_SIZE"""
+    n = len(vectors)
+    best_d = np.full((n, k), np.inf, dtype=np.float32)
+    best_l = np.full((n, k), -1, dtype=np.int64)
+    for start in range(0, len(labels), EXACT_BLOCK_SIZE):
+        block = np.asarray(labels[start:start + EXACT_BLOCK_SIZE], dtype=np.int64)
+        distances, positions = _knn(vectors, reconstruct_labels(index, block), min(k, len(block)))
+        merged_d = np.hstack([best_d, distances])
+        merged_l = np.hstack([best_l, np.where(positions >= 0, block[np.clip(positions, 0, None)], -1)])
+        order = np.argsort(merged_d, axis=1, kind="stable")[:, :k]
+        best_d = np.take_along_axis(merged_d, order, axis=1)
+        best_l = np.take_along_axis(merged_l, order, axis=1)
+    return best_d, best_l
+
+
+def selector_params(index: faiss.Index, selector):
+    # Параметры поиска с селектором заменяют выставленные в индексе nprobe / efSearch - переносим их
+    if hasattr(index, "hnsw"):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    try:
+        ivf = faiss.extract_index_ivf(index)
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    except RuntimeError:
+        return faiss.SearchParameters(sel=selector)
+
+
+def filtered_search(index: faiss.Index, vectors: np.ndarray, k: int,
+                    labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Поиск только среди меток labels: min(k, len(labels)) результатов на каждый запрос.
+
+    Пустые места в выдаче - метка -1, как у index.search.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if len(labels) == 0 or k <= 0:
+        return (np.full((len(vectors), max(k, 0)), np.inf, dtype=np.float32),
+                np.full((len(vectors), max(k, 0)), -1, dtype=np.int64))
+    if len(labels) <= EXACT_SUBSET_LIMIT or not HAS_SEARCH_PARAMS:
+        return exact_subset_search(index, vectors, k, labels)
+    selector = faiss.IDSelectorBatch(np.ascontiguousarray(labels, dtype=np.int64))
+    distances, found = index.search(vectors, k, params=selector_params(index, selector))
+    # IVF и HNSW с избирательным фильтром могут найти меньше k - такие запросы дорешиваются точно
+    short = np.flatnonzero((found >= 0).sum(axis=1) < min(k, len(labels)))
+    if len(short):
+        distances[short], found[short] = exact_subset_search(index, vectors[short], k, labels)
+    return distances, found
+
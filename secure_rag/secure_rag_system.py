@@ -3,32 +3,70 @@
 import os
 import sys
 import yaml
-import pickle
+import json
 import numpy as np
 import uvicorn
 import time
 import hashlib
-from fastapi import FastAPI, HTTPException, Depends, Security, status
+import threading
+import asyncio
+import uuid
+from fastapi import FastAPI, HTTPException, Depends, Security, status, Response
 from fastapi.security import APIKeyHeader
 from pydantic import BaseModel
 from typing import List, Optional, Tuple
 from langchain_community.document_loaders import DirectoryLoader, TextLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_ollama import OllamaEmbeddings
 from langchain_community.vectorstores import FAISS
-from rank_bm25 import BM25Okapi
 from cryptography.fernet import Fernet
 
+# Общие модули из каталога scripts/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+from hybrid_fusion import FusionIndex, fuse, FUSION_METHODS
+from embedding_cache import EmbeddingCache, CachedEmbeddings
+from query_cache import QueryCaches
+from ann_index import (MAX_TOMBSTONE_FRACTION, IndexConfig, add_vectors, build_vector_db, drop_tombstones,
+                       load_index_config, load_vector_db, remove_vectors, save_vector_db, tombstone_fraction)
+from process_memory import process_memory, format_memory
+from source_index import SourceIndex
+from lexical_index import LexicalIndex
+from reranker import CrossEncoderReranker
+from embedding_backend import BucketedEmbeddings, create_embeddings, embedding_model_id
+from request_metrics import instrument, span
+
 # Конфигурация (замените `your_user` на ваше имя пользователя в Linux!)
 CONFIG = {
     "documents_path": "/home/user/secure_rag/documents",
     "vector_db_path": "/home/user/secure_rag/vector_db",
-    "embedding_model": "bge-m3:567m",  # Модель для эмбеддингов
+    "embedding_backend": "ollama",  # ollama | sentence-transformers | int8 | onnx | fake (см. embedding_backend.py)
+    "embedding_model": "bge-m3:567m",  # Имя модели Ollama или путь к локальной модели
+    "embedding_batch_size": 32,
+    "embedding_threads": 0,  # Потоков CPU для локальных бэкендов; 0 - по числу ядер
+    "embedding_cache_dir": "/home/user/secure_rag/embedding_cache",  # Общий кэш эмбеддингов чанков
     "chunk_size": 512,
     "chunk_overlap": 128,
     "host": "127.0.0.1",
     "port": 9000,
     "encrypt_content": False,  # Шифрование отключено!
+    "fusion_method": "weighted",  # weighted | rrf
+    "semantic_weight": 0.7,  # Вес семантической оценки для weighted
+    "candidate_factor": 4,  # Кандидатов от каждого ретривера: k * candidate_factor
+    "max_batch_queries": 128,  # Предел запросов в /search/batch
+    "query_cache_size": 10000,  # Векторов запросов в LRU-кэше
+    "result_cache_size": 5000,  # Ранжированных выдач в TTL-кэше
+    "result_cache_ttl": 300,  # Время жизни выдачи в кэше, секунд
+    "index_type": "flat",  # flat (точный) | ivf | hnsw; смена типа вызывает полную переиндексацию
+    "ivf_nlist": 0,  # Центроидов IVF; 0 - 4 * sqrt(число чанков)
+    "ivf_nprobe": 16,  # Просматриваемых кластеров IVF при поиске
+    "hnsw_m": 32,
+    "hnsw_ef_construction": 200,
+    "hnsw_ef_search": 64,
+    "mmap_index": True,  # index.faiss отображается в память только для чтения и делится между процессами
+    "rerank_enabled": False,  # Переранжирование кросс-энкодером по умолчанию (запрос может переопределить)
+    "rerank_model": "/home/user/models/reranker/BAAI-bge-reranker-v2-m3",
+    "rerank_candidates": 20,  # Кандидатов после слияния, которые оценивает кросс-энкодер
+    "rerank_batch_size": 16,
+    "rerank_budget_ms": 300,  # Не уложились - выдача в порядке слияния
     "log_file": "/home/user/secure_rag/logs/rag_system.log"
 }
 
@@ -43,12 +81,18 @@ class SearchResult(BaseModel):
     content: str
     source: str
     score: float
+    rerank_score: Optional[float] = None
     is_encrypted: bool = False
 
 class SearchRequest(BaseModel):
     query: str
     k: int = 3
     source_filter: Optional[str] = None
+    fusion: Optional[str] = None  # weighted | rrf, по умолчанию из CONFIG
+    rerank: Optional[bool] = None  # Переранжировать кросс-энкодером, по умолчанию из CONFIG
+
+class BatchSearchRequest(BaseModel):
+    queries: List[SearchRequest]
 
 # Инициализация приложения
 app = FastAPI(
@@ -56,6 +100,8 @@ app = FastAPI(
     description="RAG-система для интеграции с OpenWebUI",
     version="3.0"
 )
+# /metrics (гистограммы этапов в формате Prometheus) и trace id из заголовка X-Trace-Id
+instrument(app)
 
 # Аутентификация
 api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
@@ -68,15 +114,137 @@ def get_api_key(api_key: str = Security(api_key_header)):
         )
     return api_key
 
-# Загрузка и индексация документов
-def load_and_index_documents(reindex: bool = False):
-    """Загрузка документов и создание индексов (FAISS + BM25)"""
-    if not reindex and os.path.exists(CONFIG['vector_db_path']):
-        return
-    
-    print("⚙️ Начало индексации документов...")
-    
-    # Загрузка документов
+def get_admin_key(api_key: str = Security(api_key_header)):
+    if api_key != API_KEYS["admin"]:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin API Key required"
+        )
+    return api_key
+
+# Резидентный кэш индексов
+class IndexSnapshot:
+    """Неизменяемое поколение индексов (FAISS + docstore + BM25), которым обслуживаются запросы"""
+    def __init__(self, vector_db: FAISS, bm25_index: LexicalIndex, source_index: Optional[SourceIndex] = None):
+        self.generation = 0  # Назначается при публикации
+        self.vector_db = vector_db
+        self.bm25_index = bm25_index
+        self.fusion = FusionIndex(vector_db, bm25_index, source_index)
+        self.loaded_at = time.time()
+
+class IndexHolder:
+    """Держит индексы в памяти процесса и атомарно подменяет их после переиндексации.
+
+    Запрос берет ссылку на текущий снимок один раз в начале обработки, поэтому
+    подмена поколения не затрагивает уже выполняющиеся запросы.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot: Optional[IndexSnapshot] = None
+        self._generation = 0
+        self._embeddings: Optional[BucketedEmbeddings] = None
+
+    @property
+    def embeddings(self) -> BucketedEmbeddings:
+        # Бэкенд эмбеддингов создается один раз на процесс
+        with self._lock:
+            if self._embeddings is None:
+                self._embeddings = create_embeddings(CONFIG['embedding_backend'], CONFIG['embedding_model'],
+                                                     batch_size=CONFIG['embedding_batch_size'],
+                                                     threads=CONFIG['embedding_threads'])
+            return self._embeddings
+
+    def publish(self, vector_db: FAISS, bm25_index: LexicalIndex,
+                source_index: Optional[SourceIndex] = None) -> IndexSnapshot:
+        """Публикует новое поколение индексов"""
+        # Выравнивание строится до захвата блокировки, чтобы не задерживать читателей
+        snapshot = IndexSnapshot(vector_db, bm25_index, source_index)
+        with self._lock:
+            self._generation += 1
+            snapshot.generation = self._generation
+            self._snapshot = snapshot
+        # Кэши запросов сбрасываются вместе с публикацией нового поколения
+        query_caches.sync_generation(snapshot.generation)
+        print(f"🔁 Опубликовано поколение индекса #{snapshot.generation} "
+              f"(векторов: {vector_db.index.ntotal})")
+        print(f"📊 Память: {format_memory(process_memory())}")
+        return snapshot
+
+    def reload(self) -> IndexSnapshot:
+        """Читает индексы с диска и публикует их как новое поколение"""
+        vector_db, _ = load_vector_db(CONFIG['vector_db_path'], self.embeddings, mmap=CONFIG['mmap_index'])
+        # Базы со старым bm25_index.pkl получают лексический индекс, построенный по docstore
+        bm25_index = LexicalIndex.load(CONFIG['vector_db_path'], vector_db)
+        source_index = SourceIndex.load(CONFIG['vector_db_path'], vector_db)
+        return self.publish(vector_db, bm25_index, source_index)
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def current(self) -> IndexSnapshot:
+        snapshot = self._snapshot
+        if snapshot is None:
+            raise RuntimeError("Индекс еще не загружен")
+        return snapshot
+
+index_holder = IndexHolder()
+query_caches = QueryCaches(CONFIG['query_cache_size'], CONFIG['result_cache_size'], CONFIG['result_cache_ttl'])
+reranker = CrossEncoderReranker(CONFIG['rerank_model'], batch_size=CONFIG['rerank_batch_size'])
+reindex_lock = threading.Lock()
+
+# Манифест индекса: какие чанки построены из какой версии каждого файла
+MANIFEST_FILE = "index_manifest.json"
+
+def manifest_path() -> str:
+    return os.path.join(CONFIG['vector_db_path'], MANIFEST_FILE)
+
+def load_manifest() -> Optional[dict]:
+    """Читает манифест; None, если его нет или он построен с другими параметрами"""
+    path = manifest_path()
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"⚠ Манифест индекса поврежден ({e}), будет полная переиндексация")
+        return None
+    # Чанки, нарезанные или эмбеддированные иначе, переиспользовать нельзя
+    for key in ("embedding_model", "chunk_size", "chunk_overlap"):
+        if manifest.get(key) != CONFIG[key]:
+            return None
+    # Манифесты до выбора бэкенда строились через Ollama
+    if manifest.get("embedding_backend", "ollama") != CONFIG['embedding_backend']:
+        return None
+    return manifest
+
+def save_manifest(files: dict):
+    manifest = {
+        "embedding_backend": CONFIG['embedding_backend'],
+        "embedding_model": CONFIG['embedding_model'],
+        "chunk_size": CONFIG['chunk_size'],
+        "chunk_overlap": CONFIG['chunk_overlap'],
+        "files": files
+    }
+    tmp_path = manifest_path() + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path())
+
+def index_config() -> IndexConfig:
+    """Параметры индекса FAISS из CONFIG"""
+    return IndexConfig(
+        index_type=CONFIG['index_type'],
+        nlist=CONFIG['ivf_nlist'],
+        nprobe=CONFIG['ivf_nprobe'],
+        hnsw_m=CONFIG['hnsw_m'],
+        ef_construction=CONFIG['hnsw_ef_construction'],
+        ef_search=CONFIG['hnsw_ef_search'],
+    )
+
+def load_documents() -> list:
+    """Загрузка документов с метаданными (источник, sha256, время)"""
     loader = DirectoryLoader(
         CONFIG['documents_path'],
         glob="**/*.md",
@@ -95,90 +263,287 @@ def load_and_index_documents(reindex: bool = False):
             "hash": hashlib.sha256(doc.page_content.encode()).hexdigest(),
             "timestamp": time.time()
         }
-    
-    # Разделение на чанки
+    return documents
+
+def split_documents(documents: list) -> Tuple[list, List[str], dict]:
+    """Разделение на чанки; возвращает чанки, их id и записи манифеста по файлам"""
     splitter = RecursiveCharacterTextSplitter(
         chunk_size=CONFIG['chunk_size'],
         chunk_overlap=CONFIG['chunk_overlap'],
         separators=["\n\n", "\n", " ", ""]
     )
     chunks = splitter.split_documents(documents)
+    chunk_ids = [str(uuid.uuid4()) for _ in chunks]
+    
+    files = {doc.metadata['source']: {"hash": doc.metadata['hash'], "chunk_ids": []} for doc in documents}
+    for chunk, chunk_id in zip(chunks, chunk_ids):
+        files[chunk.metadata['source']]["chunk_ids"].append(chunk_id)
+    return chunks, chunk_ids, files
+
+# Загрузка и индексация документов
+def load_and_index_documents(reindex: bool = False, full: bool = False):
+    """Загрузка документов и создание индексов (FAISS + BM25).
+
+    При reindex=True база синхронизируется с documents_path: заново эмбеддируются
+    только добавленные и измененные файлы, чанки удаленных файлов вычищаются.
+    full=True принудительно пересоздает индекс целиком.
+    """
+    if not reindex and os.path.exists(CONFIG['vector_db_path']):
+        index_holder.reload()
+        return
+    
+    print("⚙️ Начало индексации документов...")
+    started = time.time()
+    documents = load_documents()
     
-    # Создание векторной базы
-    embeddings = OllamaEmbeddings(model=CONFIG['embedding_model'])
-    vector_db = FAISS.from_documents(chunks, embeddings)
+    manifest = None if full else load_manifest()
+    if manifest is None or not os.path.exists(os.path.join(CONFIG['vector_db_path'], "index.faiss")):
+        full = True
+    elif load_index_config(CONFIG['vector_db_path']).index_type != CONFIG['index_type']:
+        print(f"🔁 Тип индекса изменен на {CONFIG['index_type']}, требуется полная переиндексация")
+        full = True
+    
+    cache = EmbeddingCache(embedding_model_id(CONFIG['embedding_backend'], CONFIG['embedding_model']),
+                           CONFIG['embedding_cache_dir'])
+    build_embeddings = CachedEmbeddings(index_holder.embeddings, cache)
+    try:
+        vector_db, files, built_config = update_vector_db(documents, manifest, build_embeddings, full)
+    finally:
+        cache.close()
+    print(f"📦 {cache.report()}")
+    if vector_db is None:
+        if index_holder.generation == 0:
+            index_holder.reload()
+        print(f"✅ Индекс актуален ({time.time() - started:.1f} с)")
+        return
+    vector_db.embedding_function = index_holder.embeddings
     
     # Сохранение
     os.makedirs(CONFIG['vector_db_path'], exist_ok=True)
-    vector_db.save_local(CONFIG['vector_db_path'])
+    save_vector_db(vector_db, CONFIG['vector_db_path'], built_config)
+    if CONFIG['mmap_index']:
+        # Построенная в куче копия заменяется отображением только что записанного файла
+        vector_db, _ = load_vector_db(CONFIG['vector_db_path'], index_holder.embeddings, mmap=True)
     
-    # Индекс BM25
-    bm25_index = BM25Okapi([c.page_content for c in chunks])
-    with open(os.path.join(CONFIG['vector_db_path'], "bm25_index.pkl"), "wb") as f:
-        pickle.dump(bm25_index, f)
+    # Индекс BM25 пересобирается из docstore: это дешево по сравнению с эмбеддингами
+    bm25_index = LexicalIndex.build(vector_db)
+    bm25_index.save(CONFIG['vector_db_path'])
+    legacy_bm25 = os.path.join(CONFIG['vector_db_path'], "bm25_index.pkl")
+    if os.path.exists(legacy_bm25):
+        os.remove(legacy_bm25)  # Прежний формат (pickle BM25Okapi) больше не читается
+    save_manifest(files)
     
-    print(f"✅ База данных сохранена в {CONFIG['vector_db_path']}")
+    print(f"✅ База данных сохранена в {CONFIG['vector_db_path']} ({time.time() - started:.1f} с)")
+    
+    # Новое поколение становится видимым только после полной записи на диск
+    index_holder.publish(vector_db, bm25_index, SourceIndex.load(CONFIG['vector_db_path'], vector_db))
+
+def update_vector_db(documents: list, manifest: Optional[dict], embeddings: CachedEmbeddings,
+                     full: bool) -> Tuple[Optional[FAISS], Optional[dict], Optional[IndexConfig]]:
+    """Строит или обновляет FAISS; возвращает базу, записи манифеста и параметры индекса
+    либо (None, None, None), если изменений нет"""
+    if full:
+        # Полная переиндексация
+        chunks, chunk_ids, files = split_documents(documents)
+        vector_db, built_config = build_vector_db(chunks, embeddings, index_config(), ids=chunk_ids)
+    else:
+        old_files = manifest["files"]
+        current = {doc.metadata['source']: doc for doc in documents}
+        changed_docs = [doc for source, doc in current.items()
+                        if old_files.get(source, {}).get("hash") != doc.metadata['hash']]
+        removed_sources = [source for source in old_files
+                           if source not in current or current[source].metadata['hash'] != old_files[source]["hash"]]
+        print(f"📋 Изменения: новых/измененных файлов {len(changed_docs)}, "
+              f"устаревших версий {len(removed_sources)}, без изменений "
+              f"{len(current) - len(changed_docs)}")
+        
+        if not changed_docs and not removed_sources:
+            return None, None, None
+        
+        # Загружаем отдельную копию с диска: опубликованный снимок не изменяется
+        vector_db, built_config = load_vector_db(CONFIG['vector_db_path'], embeddings)
+        files = {source: entry for source, entry in old_files.items() if source not in removed_sources}
+        stale_ids = [chunk_id for source in removed_sources for chunk_id in old_files[source]["chunk_ids"]]
+        # Старые чанки удаляются по меткам (IndexIDMap2 / IVF), остальные векторы не трогаются
+        removed = remove_vectors(vector_db, stale_ids)
+        if tombstone_fraction(vector_db) > MAX_TOMBSTONE_FRACTION:
+            print(f"🔁 В графе {built_config.index_type} накопилось много удаленных векторов, граф перестраивается")
+            drop_tombstones(vector_db, built_config)
+        chunk_ids = []
+        if changed_docs:
+            chunks, chunk_ids, new_files = split_documents(changed_docs)
+            texts = [chunk.page_content for chunk in chunks]
+            add_vectors(vector_db, texts, embeddings.embed_documents(texts),
+                        [chunk.metadata for chunk in chunks], chunk_ids)
+            files.update(new_files)
+        print(f"🧹 Чанков удалено: {removed}, добавлено: {len(chunk_ids)}")
+    return vector_db, files, built_config
 
 # Инициализация при запуске
 @app.on_event("startup")
 def startup_event():
-    print("🔍 Принудительная переиндексация...")
-    load_and_index_documents(reindex=True)  # Всегда пересоздаем индекс
+    print("🔍 Синхронизация индекса с документами...")
+    load_and_index_documents(reindex=True)  # Переэмбеддируются только изменившиеся файлы
+    if CONFIG['rerank_enabled']:
+        reranker.model  # Загрузка модели не должна съедать бюджет первого запроса
 
 # API Endpoints
+def embed_queries(queries: List[str]) -> List[List[float]]:
+    if len(queries) == 1:
+        return [index_holder.embeddings.embed_query(queries[0])]
+    return index_holder.embeddings.embed_documents(queries)
+
+async def hybrid_search(snapshot: IndexSnapshot, requests: List[SearchRequest]) -> List[List[SearchResult]]:
+    """Гибридный поиск для одного или нескольких запросов на одном снимке индекса"""
+    methods = [request.fusion or CONFIG['fusion_method'] for request in requests]
+    for method in methods:
+        if method not in FUSION_METHODS:
+            raise HTTPException(status_code=400, detail=f"Неизвестный метод слияния: {method}")
+    
+    reranks = [CONFIG['rerank_enabled'] if r.rerank is None else r.rerank for r in requests]
+    keys = [query_caches.result_key(snapshot.generation, r.query, r.k, r.source_filter, method, rerank)
+            for r, method, rerank in zip(requests, methods, reranks)]
+    all_results = [query_caches.results.get(key) for key in keys]
+    pending = [i for i, cached in enumerate(all_results) if cached is None]
+    if not pending:
+        return all_results
+    
+    fusion_index = snapshot.fusion
+    pending_requests = [requests[i] for i in pending]
+    # Для переранжирования слияние отдает не k, а rerank_candidates лучших строк
+    limits = [max(requests[i].k, CONFIG['rerank_candidates']) if reranks[i] else requests[i].k for i in pending]
+    ns = [max(request.k * CONFIG['candidate_factor'], limit) for request, limit in zip(pending_requests, limits)]
+    
+    def semantic_search():
+        # Все запросы пакета эмбеддируются одним вызовом модели и ищутся одной матрицей
+        with span("query_embedding"):
+            query_vectors = query_caches.embed_queries([r.query for r in pending_requests], embed_queries)
+        with span("faiss_search"):
+            return fusion_index.semantic_batch(query_vectors, ns, [r.source_filter for r in pending_requests])
+    
+    def lexical_search():
+        with span("bm25_scoring"):
+            return [fusion_index.lexical(r.query, n, r.source_filter) for r, n in zip(pending_requests, ns)]
+    
+    # Семантический и лексический поиск выполняются параллельно
+    semantic, lexical = await asyncio.gather(
+        asyncio.to_thread(semantic_search),
+        asyncio.to_thread(lexical_search)
+    )
+    
+    # Комбинирование результатов
+    with span("fusion"):
+        fused_hits = [fuse(semantic_hits, lexical_hits, limit, method=methods[i],
+                           semantic_weight=CONFIG['semantic_weight'])
+                      for i, semantic_hits, lexical_hits, limit in zip(pending, semantic, lexical, limits)]
+    
+    # Переранжирование: пары всех запросов пакета оцениваются кросс-энкодером вместе
+    rerank_rows = [j for j, i in enumerate(pending) if reranks[i] and fused_hits[j]]
+    rerank_scores = {}
+    if rerank_rows:
+        with span("rerank"):
+            scores = await asyncio.to_thread(
+                reranker.score_batch,
+                [pending_requests[j].query for j in rerank_rows],
+                [[fusion_index.document(row).page_content for row, _ in fused_hits[j]] for j in rerank_rows],
+                CONFIG['rerank_budget_ms'] / 1000
+            )
+        rerank_scores = dict(zip(rerank_rows, scores))
+    
+    for j, (i, fused) in enumerate(zip(pending, fused_hits)):
+        row_scores = rerank_scores.get(j)
+        if row_scores is not None:
+            order = np.argsort(-row_scores, kind="stable")[:requests[i].k]
+            hits = [(fused[o][0], fused[o][1], float(row_scores[o])) for o in order]
+        else:
+            hits = [(row, score, None) for row, score in fused[:requests[i].k]]
+        results = []
+        for row, score, rerank_score in hits:
+            doc = fusion_index.document(row)  # Контент уже не зашифрован
+            results.append(SearchResult(
+                content=doc.page_content[:1000],
+                source=doc.metadata['source'],
+                score=score,
+                rerank_score=rerank_score,
+                is_encrypted=False
+            ))
+        # Выдача в порядке слияния из-за исчерпанного бюджета не кэшируется
+        if not (j in rerank_scores and row_scores is None):
+            query_caches.results.put(keys[i], results)
+        all_results[i] = results
+    return all_results
+
 @app.post("/search", response_model=List[SearchResult])
 async def secure_search(
     request: SearchRequest,
+    response: Response,
     api_key: str = Security(get_api_key)
 ):
     """Гибридный поиск (семантический + BM25)"""
     try:
-        # Загрузка FAISS
-        embeddings = OllamaEmbeddings(model=CONFIG['embedding_model'])
-        vector_db = FAISS.load_local(
-            CONFIG['vector_db_path'],
-            embeddings,
-            allow_dangerous_deserialization=True
-        )
-        
-        # Семантический поиск
-        semantic_results = vector_db.similarity_search_with_score(
-            request.query, 
-            k=request.k * 2,
-            filter={"source": request.source_filter} if request.source_filter else None
-        )
-        
-        # BM25
-        with open(os.path.join(CONFIG['vector_db_path'], "bm25_index.pkl"), "rb") as f:
-            bm25_index = pickle.load(f)
-        
-        # Комбинирование результатов
-        combined_results = []
-        for doc, score in semantic_results:
-            bm25_score = bm25_index.get_scores(request.query)[0]
-            combined_score = (1 - score) * 0.7 + bm25_score * 0.3
-            
-            combined_results.append({
-                "doc": doc,
-                "score": combined_score,
-                "content": doc.page_content  # Контент уже не зашифрован
-            })
-        
-        # Топ результатов
-        combined_results.sort(key=lambda x: x['score'], reverse=True)
-        return [SearchResult(
-            content=r['content'][:1000],
-            source=r['doc'].metadata['source'],
-            score=r['score'],
-            is_encrypted=False
-        ) for r in combined_results[:request.k]]
-        
+        # Снимок индексов фиксируется на весь запрос
+        snapshot = index_holder.current()
+        response.headers["X-Index-Generation"] = str(snapshot.generation)
+        return (await hybrid_search(snapshot, [request]))[0]
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка поиска: {str(e)}")
+
+@app.post("/search/batch", response_model=List[List[SearchResult]])
+async def secure_search_batch(
+    request: BatchSearchRequest,
+    response: Response,
+    api_key: str = Security(get_api_key)
+):
+    """Пакетный гибридный поиск: результаты возвращаются в порядке запросов"""
+    if len(request.queries) > CONFIG['max_batch_queries']:
+        raise HTTPException(status_code=400,
+                            detail=f"Слишком много запросов в пакете (максимум {CONFIG['max_batch_queries']})")
+    if not request.queries:
+        return []
+    try:
+        snapshot = index_holder.current()
+        response.headers["X-Index-Generation"] = str(snapshot.generation)
+        return await hybrid_search(snapshot, request.queries)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка поиска: {str(e)}")
 
+@app.post("/reindex")
+def reindex(full: bool = False, api_key: str = Security(get_admin_key)):
+    """Переиндексация без остановки сервера: запросы обслуживаются старым поколением до подмены"""
+    if not reindex_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Индексация уже выполняется")
+    try:
+        load_and_index_documents(reindex=True, full=full)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка индексации: {str(e)}")
+    finally:
+        reindex_lock.release()
+    return {"status": "reindexed", "generation": index_holder.current().generation}
+
+@app.get("/cache/stats")
+async def cache_stats(api_key: str = Security(get_api_key)):
+    """Доля попаданий и занимаемая память кэшей запросов и кэша оценок переранжирования"""
+    stats = query_caches.stats()
+    stats["reranker"] = reranker.stats()
+    return stats
+
 @app.get("/health")
 async def health_check():
-    return {"status": "active", "model": CONFIG['embedding_model']}
+    try:
+        snapshot = index_holder.current()
+        index_info = {
+            "generation": snapshot.generation,
+            "vectors": snapshot.vector_db.index.ntotal,
+            "loaded_at": snapshot.loaded_at
+        }
+    except RuntimeError:
+        index_info = None
+    return {"status": "active", "model": CONFIG['embedding_model'], "index": index_info,
+            "memory": process_memory()}
 
 # Запуск
 if __name__ == "__main__":
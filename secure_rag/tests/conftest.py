@@ -0,0 +1,30 @@
+# conftest.py - Общие фикстуры тестов: модули из scripts/ и детерминированный бэкенд эмбеддингов без модели
+import os
+import sys
+
+import pytest
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+if SCRIPTS_DIR not in sys.path:
+    sys.path.insert(0, SCRIPTS_DIR)
+
+from langchain_core.documents import Document  # noqa: E402
+
+from embedding_backend import create_embeddings  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def embeddings():
+    return create_embeddings("fake")
+
+
+def make_documents(n: int, sources: int = 4):
+    """n чанков из sources файлов; чанки одного файла делят слово, поэтому близки друг к другу"""
+    return [Document(page_content=f"слово{i} книга{i % sources} общее{i % 7}",
+                     metadata={"source": f"book{i % sources}.md"})
+            for i in range(n)]
+
+
+@pytest.fixture
+def documents():
+    return make_documents(200)
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from hybrid_fusion import RRF_K, fuse, top_k_indices
+
+
+def ranked(rows, scores):
+    return np.asarray(rows, dtype=np.int64), np.asarray(scores, dtype=np.float32)
+
+
+def test_top_k_indices_sorted_descending():
+    scores = np.array([0.1, 0.9, 0.5, 0.7], dtype=np.float32)
+    assert top_k_indices(scores, 3).tolist() == [1, 3, 2]
+    assert top_k_indices(scores, 10).tolist() == [1, 3, 2, 0]
+    assert top_k_indices(scores, 0).size == 0
+
+
+def test_weighted_fuse_combines_both_retrievers():
+    semantic = ranked([1, 2, 3], [0.9, 0.5, 0.1])
+    lexical = ranked([3, 4], [10.0, 2.0])
+    fused = fuse(semantic, lexical, k=4, method="weighted", semantic_weight=0.7)
+    rows = [row for row, _ in fused]
+    assert rows[0] == 1  # Лучшая семантическая оценка: 0.7 * 1.0
+    assert set(rows) == {1, 2, 3, 4}
+    scores = dict(fused)
+    assert scores[1] == pytest.approx(0.7)
+    assert scores[3] == pytest.approx(0.3)  # Худший семантический (0), лучший лексический
+    assert scores[4] == pytest.approx(0.0)
+
+
+def test_rrf_fuse_rewards_agreement():
+    semantic = ranked([5, 6, 7], [0.9, 0.8, 0.7])
+    lexical = ranked([7, 8], [3.0, 1.0])
+    fused = fuse(semantic, lexical, k=2, method="rrf")
+    assert [row for row, _ in fused] == [7, 5]
+    assert fused[0][1] == pytest.approx(1.0 / (RRF_K + 3) + 1.0 / (RRF_K + 1))
+
+
+def test_fuse_empty_and_unknown_method():
+    empty = ranked([], [])
+    assert fuse(empty, empty, k=5) == []
+    with pytest.raises(ValueError):
+        fuse(empty, empty, k=5, method="max")
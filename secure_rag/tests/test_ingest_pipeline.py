@@ -0,0 +1,88 @@
+import json
+import os
+
+import pytest
+from langchain_core.documents import Document
+
+from ann_index import IndexConfig, load_vector_db
+from ingest_pipeline import CHECKPOINT_DIR, IngestCheckpoint, ingest
+
+PARAMS = {"source_dir": "corpus", "chunk_size": 100}
+
+
+class Crash(Exception):
+    pass
+
+
+def corpus(n_files: int = 12, chunks_per_file: int = 5):
+    return {f"file{f}.md": [Document(page_content=f"файл{f} чанк{c} общее{c}", metadata={"source": f"file{f}.md"})
+                            for c in range(chunks_per_file)]
+            for f in range(n_files)}
+
+
+def split_stream_factory(files, crash_after=None, seen=None):
+    def split_stream(remaining):
+        for count, path in enumerate(remaining):
+            if crash_after is not None and count == crash_after:
+                raise Crash(path)
+            if seen is not None:
+                seen.append(path)
+            yield path, files[path]
+    return split_stream
+
+
+@pytest.mark.parametrize("index_type", ["flat", "hnsw"])
+def test_resume_after_crash_skips_finished_files(tmp_path, embeddings, index_type):
+    files = corpus()
+    db_path = str(tmp_path / "db")
+    config = IndexConfig(index_type=index_type)
+    with pytest.raises(Crash):
+        ingest(list(files), split_stream_factory(files, crash_after=7), embeddings, db_path, PARAMS, config,
+               batch_chunks=10)
+
+    checkpoint = IngestCheckpoint(db_path, PARAMS)
+    # Пакеты по 10 чанков = 2 файла: целых шардов 3, последний неполный пакет (файл 6) потерян
+    assert checkpoint.load() == [f"file{f}.md" for f in range(6)]
+    assert checkpoint.shards == 3
+    # След обрыва после state.json: шард с номером больше записанного удаляется при загрузке
+    os.makedirs(checkpoint.shard_path(4))
+    assert len(checkpoint.load()) == 6
+    assert not os.path.exists(checkpoint.shard_path(4))
+
+    seen = []
+    result = ingest(list(files), split_stream_factory(files, seen=seen), embeddings, db_path, PARAMS, config,
+                    batch_chunks=10)
+    assert seen == [f"file{f}.md" for f in range(6, 12)]
+    assert result.resumed_files == 6
+    assert result.files == 12
+    assert result.chunks == 60
+    assert not os.path.exists(os.path.join(db_path, CHECKPOINT_DIR))
+
+    vector_db, _ = load_vector_db(db_path, embeddings)
+    texts = sorted(doc.page_content for doc in vector_db.docstore._dict.values())
+    assert texts == sorted(doc.page_content for chunks in files.values() for doc in chunks)
+    hits = vector_db.similarity_search("файл9 чанк3 общее3", k=1)
+    assert hits[0].page_content == "файл9 чанк3 общее3"
+
+
+def test_checkpoint_with_other_params_is_discarded(tmp_path, embeddings):
+    files = corpus(4)
+    db_path = str(tmp_path / "db")
+    with pytest.raises(Crash):
+        ingest(list(files), split_stream_factory(files, crash_after=3), embeddings, db_path, PARAMS,
+               IndexConfig(), batch_chunks=5)
+    assert len(IngestCheckpoint(db_path, PARAMS).load()) == 3
+
+    other = IngestCheckpoint(db_path, dict(PARAMS, chunk_size=200))
+    assert other.load() == []
+    assert not other.exists()
+
+
+def test_append_writes_batch_shards(tmp_path):
+    checkpoint = IngestCheckpoint(str(tmp_path), PARAMS)
+    checkpoint.append(None, [], [], [], ["empty.md"])  # Файл без текста тоже отмечается готовым
+    with open(checkpoint.state_path, "r", encoding="utf-8") as f:
+        assert json.load(f) == {"params": PARAMS, "shards": 1}
+    assert IngestCheckpoint(str(tmp_path), PARAMS).load() == ["empty.md"]
+    vector_db, _ = checkpoint.assemble(None, IndexConfig())
+    assert vector_db is None
@@ -0,0 +1,99 @@
+import asyncio
+import threading
+
+import pytest
+
+from micro_batcher import MicroBatcher
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_concurrent_requests_share_batches():
+    sizes = []
+
+    def process(items):
+        sizes.append(len(items))
+        return [item * 2 for item in items]
+
+    async def scenario():
+        batcher = MicroBatcher(process, max_batch_size=8, max_wait_ms=20)
+        await batcher.start()
+        try:
+            return await asyncio.gather(*(batcher.submit(i) for i in range(20))), batcher.stats()
+        finally:
+            await batcher.stop()
+
+    results, stats = run(scenario())
+    assert results == [i * 2 for i in range(20)]
+    assert max(sizes) <= 8
+    assert stats["items"] == 20
+    assert stats["batches"] == len(sizes) < 20
+
+
+def test_result_count_mismatch_fails_every_request():
+    async def scenario():
+        batcher = MicroBatcher(lambda items: items[:-1], max_batch_size=4, max_wait_ms=20)
+        await batcher.start()
+        try:
+            return await asyncio.wait_for(
+                asyncio.gather(*(batcher.submit(i) for i in range(4)), return_exceptions=True), 5)
+        finally:
+            await batcher.stop()
+
+    results = run(scenario())
+    assert len(results) == 4
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_processing_error_propagates():
+    def process(items):
+        raise ValueError("сбой модели")
+
+    async def scenario():
+        batcher = MicroBatcher(process, max_wait_ms=1)
+        await batcher.start()
+        try:
+            await batcher.submit(1)
+        finally:
+            await batcher.stop()
+
+    with pytest.raises(ValueError):
+        run(scenario())
+
+
+def test_stop_fails_pending_requests_and_restart_works():
+    release = threading.Event()
+
+    def process(items):
+        release.wait(5)
+        return items
+
+    async def scenario():
+        batcher = MicroBatcher(process, max_batch_size=1, max_wait_ms=1, workers=1)
+        await batcher.start()
+        first = asyncio.ensure_future(batcher.submit("a"))
+        await asyncio.sleep(0.05)  # "a" занял единственный слот пула
+        queued = [asyncio.ensure_future(batcher.submit(item)) for item in ("b", "c")]
+        await asyncio.sleep(0.05)
+        await batcher.stop()
+        release.set()
+        queued_results = await asyncio.wait_for(asyncio.gather(*queued, return_exceptions=True), 5)
+        await first
+        with pytest.raises(RuntimeError):
+            await batcher.submit("d")
+        with pytest.raises(RuntimeError):
+            await batcher.run(len, "d")
+
+        # Повторный запуск создает новый пул вместо остановленного
+        await batcher.start()
+        try:
+            return queued_results, await batcher.submit("e"), await batcher.run(len, "abc")
+        finally:
+            await batcher.stop()
+
+    queued_results, restarted, direct = run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in queued_results)
+    assert restarted == "e"
+    assert direct == 3
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+
+import ann_index
+from ann_index import (IndexConfig, build_vector_db, drop_tombstones, remove_vectors, search_live,
+                       tombstone_fraction)
+from conftest import make_documents
+from delta_segments import SegmentedStore
+
+
+def build(documents, embeddings, index_type):
+    ids = [str(i) for i in range(len(documents))]
+    vector_db, config = build_vector_db(documents, embeddings, IndexConfig(index_type=index_type), ids=ids)
+    return vector_db, config
+
+
+def doc_ids(vector_db, hits):
+    by_content = {doc.page_content: doc_id for doc_id, doc in vector_db.docstore._dict.items()}
+    return [by_content[doc.page_content] for doc, _ in hits]
+
+
+@pytest.mark.parametrize("index_type", ["flat", "hnsw"])
+def test_removed_documents_never_returned(documents, embeddings, index_type):
+    vector_db, _ = build(documents, embeddings, index_type)
+    removed = {str(i) for i in range(0, len(documents), 2)}
+    assert remove_vectors(vector_db, removed) == len(removed)
+    assert remove_vectors(vector_db, removed) == 0
+    if index_type == "hnsw":
+        assert tombstone_fraction(vector_db) == pytest.approx(0.5)
+
+    store = SegmentedStore(vector_db)
+    queries = np.asarray(embeddings.embed_documents([doc.page_content for doc in documents[:20]]), dtype=np.float32)
+    k = 10
+    for row, hits in enumerate(store.search(queries, k)):
+        # Надгробия HNSW не занимают мест в выдаче: k живых документов на каждый запрос
+        assert len(hits) == k
+        found = doc_ids(vector_db, hits)
+        assert not removed & set(found)
+        distances = [distance for _, distance in hits]
+        assert distances == sorted(distances)
+        if str(row) not in removed:
+            assert found[0] == str(row)
+
+
+@pytest.mark.parametrize("has_search_params", [True, False])
+def test_search_live_excludes_tombstones_at_depth_k(documents, embeddings, monkeypatch, has_search_params):
+    # False - путь FAISS 1.7.2: надгробия вычеркиваются из выдачи, недобор дорешивается точно
+    monkeypatch.setattr(ann_index, "HAS_SEARCH_PARAMS", ann_index.HAS_SEARCH_PARAMS and has_search_params)
+    vector_db, _ = build(documents, embeddings, "hnsw")
+    remove_vectors(vector_db, [str(i) for i in range(150)])
+    queries = np.asarray(embeddings.embed_documents(["слово1 книга1"]), dtype=np.float32)
+    _, labels = search_live(vector_db, queries, 10)
+    assert labels.shape == (1, 10)
+    assert all(int(label) in vector_db.index_to_docstore_id for label in labels[0])
+
+
+def test_drop_tombstones_keeps_results(documents, embeddings):
+    vector_db, config = build(documents, embeddings, "hnsw")
+    remove_vectors(vector_db, [str(i) for i in range(0, len(documents), 3)])
+    queries = np.asarray(embeddings.embed_documents([doc.page_content for doc in documents[:10]]), dtype=np.float32)
+    before = [doc_ids(vector_db, hits) for hits in SegmentedStore(vector_db).search(queries, 5)]
+    dropped = drop_tombstones(vector_db, config)
+    assert dropped == len(range(0, len(documents), 3))
+    assert vector_db.index.ntotal == len(vector_db.index_to_docstore_id)
+    assert tombstone_fraction(vector_db) == 0.0
+    after = [doc_ids(vector_db, hits) for hits in SegmentedStore(vector_db).search(queries, 5)]
+    assert [row[0] for row in after] == [row[0] for row in before]
+
+
+def test_delta_segment_merged_by_distance(embeddings):
+    base_docs = make_documents(50)
+    delta_docs = [Document(page_content=f"новое{i} книга9", metadata={"source": "book9.md"}) for i in range(5)]
+    base, _ = build(base_docs, embeddings, "flat")
+    delta, _ = build(delta_docs, embeddings, "flat")
+    store = SegmentedStore(base, [("delta-1", delta)])
+    assert store.ntotal == 55
+    queries = np.asarray(embeddings.embed_documents(["новое3 книга9", "слово7 книга3"]), dtype=np.float32)
+    hits = store.search(queries, 3)
+    assert hits[0][0][0].page_content == "новое3 книга9"
+    assert hits[1][0][0].page_content == base_docs[7].page_content
+    filtered = store.search(queries, 3, source_filters=[None, ["book9.md"]])
+    assert all(doc.metadata["source"] == "book9.md" for doc, _ in filtered[1])
+    assert len(filtered[1]) == 3
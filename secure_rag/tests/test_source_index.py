@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+import source_index
+from ann_index import IndexConfig, build_vector_db, remove_vectors
+from source_index import SourceIndex, filtered_search
+
+
+@pytest.fixture(params=["flat", "ivf", "hnsw"])
+def vector_db(request, documents, embeddings):
+    config = IndexConfig(index_type=request.param, nlist=4)
+    vector_db, _ = build_vector_db(documents, embeddings, config, ids=[str(i) for i in range(len(documents))])
+    return vector_db
+
+
+def test_build_groups_labels_by_source(vector_db):
+    index = SourceIndex.build(vector_db)
+    assert index.sources == ["book0.md", "book1.md", "book2.md", "book3.md"]
+    labels = index.labels_for(["book1.md"])
+    assert len(labels) == 50
+    assert all(vector_db.docstore.search(vector_db.index_to_docstore_id[int(label)]).metadata["source"] == "book1.md"
+               for label in labels)
+    assert len(index.labels_for(["book1.md", "book2.md", "missing.md"])) == 100
+    assert len(index.labels_for(["missing.md"])) == 0
+
+
+def test_save_load_roundtrip_and_stale_rebuild(vector_db, tmp_path):
+    SourceIndex.build(vector_db).save(str(tmp_path))
+    loaded = SourceIndex.load(str(tmp_path), vector_db)
+    assert loaded.sources == SourceIndex.build(vector_db).sources
+    assert np.array_equal(np.sort(loaded.labels_for(["book0.md"])), np.sort(SourceIndex.build(vector_db).labels_for(["book0.md"])))
+    # После удаления отпечаток не совпадает: индекс с диска не используется, а строится заново
+    remove_vectors(vector_db, ["0", "4"])
+    rebuilt = SourceIndex.load(str(tmp_path), vector_db)
+    assert len(rebuilt.labels_for(["book0.md"])) == 48
+
+
+@pytest.mark.parametrize("exact_limit", [0, source_index.EXACT_SUBSET_LIMIT])
+def test_filtered_search_returns_k_hits_from_subset(vector_db, embeddings, monkeypatch, exact_limit):
+    # exact_limit=0 направляет поиск через селектор FAISS (если версия его поддерживает)
+    monkeypatch.setattr(source_index, "EXACT_SUBSET_LIMIT", exact_limit)
+    labels = SourceIndex.build(vector_db).labels_for(["book2.md"])
+    queries = np.asarray(embeddings.embed_documents(["слово5 книга1", "слово6 книга2"]), dtype=np.float32)
+    k = 10
+    distances, found = filtered_search(vector_db.index, queries, k, labels)
+    assert found.shape == (2, k)
+    assert np.isin(found, labels).all()
+    assert (np.diff(distances, axis=1) >= -1e-5).all()
+    assert int(found[1, 0]) == 6  # Чанк самого запроса ближе всех
+
+    # Точный перебор подмножества дает тех же соседей
+    _, exact = source_index.exact_subset_search(vector_db.index, queries, k, labels)
+    assert (found[:, 0] == exact[:, 0]).all()
+
+
+def test_filtered_search_short_subset_pads_with_minus_one(vector_db, embeddings):
+    queries = np.asarray(embeddings.embed_documents(["слово1"]), dtype=np.float32)
+    distances, found = filtered_search(vector_db.index, queries, 5, np.array([1, 2], dtype=np.int64))
+    assert sorted(found[0, :2].tolist()) == [1, 2]
+    assert (found[0, 2:] == -1).all()
+    _, found = filtered_search(vector_db.index, queries, 5, np.empty(0, dtype=np.int64))
+    assert (found == -1).all()